@@ -0,0 +1,212 @@
+#! /usr/bin/env python
+
+""" 在同一进程中管理多个账户, 共享连接池, 工作线程与事件流 """
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from rest import Api, RequestScheduler, TokenBucket, RATE_LIMIT
+from stream import Stream
+
+
+class HostedAccount:
+    """ An account hosted by an AccountManager: its Api, scheduling weight and event subscribers """
+    def __init__(self, account_id, access_token, api, weight):
+        self.account_id = account_id
+        self.access_token = access_token
+        self.api = api
+        self.weight = weight
+        self.current = 0
+        self.served = 0
+        self.subscribers = []
+
+
+class AccountManager:
+    """ Hosts many accounts and access tokens in one process
+        Every account gets its own rest.Api and request queue, but all of them share one HTTP session, one set of
+        worker threads and one global rate limit: an account costs a queue instead of threads and connections.
+        The workers always serve the highest priority request pending in any account, trades first, and pick among
+        the accounts with such a request by smooth weighted round-robin, so a busy account can not starve the others.
+        Accounts sharing an access token also share one events stream
+    """
+    def __init__(self, environment='practice', pool_size=8, rate_limit=RATE_LIMIT, metrics=None):
+        """ Instantiates a manager
+            :param environment: 模拟或真实环境
+            :param pool_size: Number of worker threads, also the size of the shared HTTP connection pool. Default: 8
+            :param rate_limit: Maximum requests per second sent to the server by all the accounts together, None for
+                               no limit. Default: RATE_LIMIT
+            :param metrics: [Optional] A metrics.Metrics given to the Api of every account. Default: None
+        """
+        self.environment = environment
+        self.pool_size = pool_size
+        self.metrics = metrics
+        self.limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.condition = threading.Condition()
+        self.accounts = dict()
+        self.schedule = []
+        self.streams = []
+        self.threads = []
+        # Requests promised to workers waiting for their rate limit token
+        self.reserved = 0
+        self.working = False
+
+    def add_account(self, account_id, access_token, weight=1, **params):
+        """ Host an account, returns its rest.Api, initialized if the manager is
+            :param account_id: Required The account id
+            :param access_token: Required oanda REST API access token of the account
+            :param weight: [Optional] Share of the requests of the account when several accounts are busy. Default: 1
+            :param params: [Optional] Other parameters of the Api, e.g. coalesce or cache
+        """
+        api = Api(self.environment, access_token, pool_size=0, rate_limit=None, metrics=self.metrics,
+                  session=self.session, scheduler=RequestScheduler(condition=self.condition), **params)
+        with self.condition:
+            self.accounts[account_id] = HostedAccount(account_id, access_token, api, weight)
+            self.schedule = list(self.accounts.values())
+        if self.working:
+            api.init()
+        return api
+
+    def remove_account(self, account_id):
+        """ Stop hosting an account. Its pending requests are still processed """
+        with self.condition:
+            account = self.accounts.pop(account_id, None)
+        if account is None:
+            return
+        account.api.deinit()
+        with self.condition:
+            # The account stays in the schedule until the workers drained its queue
+            while self.working and not account.api.request_queue.empty():
+                self.condition.wait(0.05)
+            self.schedule = list(self.accounts.values())
+
+    def get_api(self, account_id):
+        """ The rest.Api of a hosted account """
+        return self.accounts[account_id].api
+
+    def init(self):
+        """ Initialize the Api of every account and start the worker threads """
+        self.working = True
+        for account in list(self.accounts.values()):
+            account.api.init()
+        self.threads = [threading.Thread(target=self.__thread_request) for _ in range(self.pool_size)]
+        for thread in self.threads:
+            thread.start()
+
+    def deinit(self):
+        """ Stop the events streams and refuse new requests. The queued ones are still processed before the worker
+            threads exit
+        """
+        self.stop_events()
+        for account in list(self.accounts.values()):
+            account.api.deinit()
+        self.working = False
+        with self.condition:
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stats(self):
+        """ Requests served and pending per priority lane of each account """
+        with self.condition:
+            return {account_id: {'served': account.served, 'pending': account.api.request_queue.depths()}
+                    for account_id, account in self.accounts.items()}
+
+    def subscribe_events(self, account_id, on_stream):
+        """ Deliver the transactions of an account, and the heartbeats of its stream, to a callback. Subscribe before
+            start_events
+            :param account_id: Required A hosted account id
+            :param on_stream: Required Callback function, invoked with each message as by a Stream
+        """
+        self.accounts[account_id].subscribers.append(on_stream)
+
+    def start_events(self, on_error=None, **params):
+        """ Open one events stream per access token, covering every account of the token that has subscribers
+            :param on_error: [Optional] Callback function, invoked when a stream reports an error
+            :param params: Other parameters of the streams
+        """
+        tokens = dict()
+        for account in self.accounts.values():
+            if account.subscribers:
+                tokens.setdefault(account.access_token, []).append(account)
+        for access_token, accounts in tokens.items():
+            routes = {str(account.account_id): account.subscribers for account in accounts}
+            # Any Api of the token can fetch the missed transactions of all its accounts after a reconnection
+            stream = Stream(self.environment, access_token, False, api=accounts[0].api)
+            stream.start(self.__route(routes), on_error,
+                         accountIds=','.join(str(account.account_id) for account in accounts), **params)
+            self.streams.append(stream)
+
+    def stop_events(self):
+        """ Close the events streams """
+        for stream in self.streams:
+            stream.stop()
+        self.streams = []
+
+    @staticmethod
+    def __route(routes):
+        """ Stream callback dispatching each transaction to the subscribers of its account, heartbeats to everyone """
+        everyone = [subscriber for subscribers in routes.values() for subscriber in subscribers]
+
+        def route(data):
+            transaction = data.get('transaction')
+            subscribers = everyone if transaction is None else routes.get(str(transaction.get('accountId')), ())
+            for subscriber in subscribers:
+                subscriber(data)
+        return route
+
+    def __pick(self):
+        """ Account whose request is served next, None if nothing is pending. Called with condition held """
+        best = None
+        candidates = []
+        for account in self.schedule:
+            priority = account.api.request_queue.head_priority()
+            if priority is None:
+                continue
+            if best is None or priority < best:
+                best = priority
+                candidates = [account]
+            elif priority == best:
+                candidates.append(account)
+        if not candidates:
+            return None
+        total = 0
+        chosen = None
+        for account in candidates:
+            account.current += account.weight
+            total += account.weight
+            if chosen is None or account.current > chosen.current:
+                chosen = account
+        chosen.current -= total
+        chosen.served += 1
+        return chosen
+
+    def __unreserved(self):
+        """ Whether a request is pending that no worker reserved. Called with condition held """
+        return sum(account.api.request_queue.qsize() for account in self.schedule) > self.reserved
+
+    def __thread_request(self):
+        """ Worker thread, keeps serving the accounts until the manager is de-initialized and every queue is drained
+            The account and request are only picked once the rate limit token is there, so that a trade queued while
+            the worker waited for it goes first
+        """
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(self.__unreserved, 1):
+                    if self.working:
+                        continue
+                    break
+                self.reserved += 1
+            if self.limiter:
+                self.limiter.acquire()
+            with self.condition:
+                self.reserved -= 1
+                account = self.__pick()
+                if account is None:
+                    continue
+                req = account.api.request_queue.get(block=False)
+            account.api.execute(req)
@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+
+""" 由事件流增量更新的账户, 订单, 交易与持仓的本地镜像 """
+
+import time
+import threading
+
+# Order types of the v1 order creation transactions
+ORDER_CREATE_TYPES = {'LIMIT_ORDER_CREATE': 'limit', 'STOP_ORDER_CREATE': 'stop',
+                      'MARKET_IF_TOUCHED_ORDER_CREATE': 'marketIfTouched'}
+# Transactions closing a whole trade
+TRADE_CLOSE_TYPES = ('TRADE_CLOSE', 'MIGRATE_TRADE_CLOSE', 'STOP_LOSS_FILLED', 'TAKE_PROFIT_FILLED',
+                     'TRAILING_STOP_FILLED', 'MARGIN_CLOSEOUT')
+# Transaction fields and the order or trade fields they set
+ORDER_FIELDS = (('units', 'units'), ('price', 'price'), ('expiry', 'expiry'), ('upperBound', 'upperBound'),
+                ('lowerBound', 'lowerBound'), ('takeProfitPrice', 'takeProfit'), ('stopLossPrice', 'stopLoss'),
+                ('trailingStopLossDistance', 'trailingStop'))
+TRADE_FIELDS = (('takeProfitPrice', 'takeProfit'), ('stopLossPrice', 'stopLoss'),
+                ('trailingStopLossDistance', 'trailingStop'))
+# Seconds before retaking a snapshot overtaken by a transaction, doubled each time up to retry_interval, so that a
+# busy account does not use up the request budget shared with trading
+OVERTAKEN_DELAY = 0.05
+
+
+class OutOfSync(Exception):
+    """ A transaction refers to an order or a trade the mirror does not know """
+
+
+class AccountMirror:
+    """ In-memory copy of the state of an account, kept up to date by the transactions of the events stream
+        One snapshot is taken through get_account, get_orders, get_trades and get_positions, then every transaction
+        is applied incrementally: order creations, updates, cancellations and fills, trade openings, reductions,
+        updates and closes (stop loss, take profit, trailing stop, margin closeout included), balance, margin rate
+        and margin call changes. Positions are derived from the open trades. Reads are served from memory
+        Fields depending on market prices, unrealizedPl, marginUsed and marginAvail, are those of the last
+        snapshot. status() tells how current the mirror is. A new snapshot is taken in the background whenever a
+        transaction does not match the mirror, a transaction id is skipped with strict_sequence, or the stream
+        reconnects without a rest.Api to recover the transactions missed meanwhile
+    """
+    def __init__(self, api, account_id, strict_sequence=False, retry_interval=1.0):
+        """ Instantiates a mirror
+            :param api: An initialized rest.Api used for the snapshots
+            :param account_id: The account to mirror
+            :param strict_sequence: [Optional] Treat any skipped transaction id as a gap. Only valid when the ids of
+                                    the account are consecutive, in v1 they are shared by all accounts. Default: False
+            :param retry_interval: [Optional] Seconds between two attempts of a failed snapshot. Default: 1
+        """
+        self.api = api
+        self.account_id = account_id
+        self.strict_sequence = strict_sequence
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.account = dict()
+        self.orders = dict()
+        self.trades = dict()
+        self.positions = dict()
+        self.sequence = 0
+        self.snapshot_time = None
+        self.heard = None
+        self.syncing = False
+        self.pending = None
+        self.resyncs = 0
+        self.connects = 0
+        self.stream = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self, stream, on_error=None, **params):
+        """ Take the snapshot and follow the events stream. Returns once the snapshot is in place
+            :param stream: An events stream.Stream, not started yet
+            :param on_error: [Optional] Callback function, invoked when the stream reports an error
+            :param params: Other parameters of the stream
+        """
+        self.stop_event.clear()
+        with self.lock:
+            self.syncing = True
+            self.pending = []
+        self.stream = stream
+        # The stream starts first, so that the transactions made while the snapshot is taken are buffered
+        stream.start(self.update, on_error, on_connect=self.__on_connect, accountIds=self.account_id, **params)
+        self.__sync()
+
+    def stop(self):
+        """ Stop following the events stream """
+        self.stop_event.set()
+        if self.stream:
+            self.stream.stop()
+            self.stream = None
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def resync(self):
+        """ Take a new snapshot in the background. Transactions received meanwhile are applied on top of it """
+        with self.lock:
+            if self.syncing:
+                return
+            self.syncing = True
+            self.pending = []
+        self.thread = threading.Thread(target=self.__sync)
+        self.thread.start()
+
+    def update(self, data):
+        """ Apply a message of the events stream. Can be given directly as the on_stream callback of the stream """
+        if 'heartbeat' in data:
+            self.heard = time.monotonic()
+            return
+        transaction = data.get('transaction')
+        if transaction is None or str(transaction.get('accountId', self.account_id)) != str(self.account_id):
+            return
+        with self.lock:
+            self.heard = time.monotonic()
+            if self.syncing:
+                self.pending.append(transaction)
+                return
+            try:
+                self.__apply(transaction, True)
+                return
+            except OutOfSync:
+                pass
+        self.resync()
+
+    def status(self):
+        """ How current the mirror is: id of the last transaction applied, seconds since the last message of the stream
+            or snapshot, seconds since the last snapshot, whether a snapshot is being taken, and number of resyncs
+        """
+        now = time.monotonic()
+        with self.lock:
+            return {'sequence': self.sequence, 'age': None if self.heard is None else now - self.heard,
+                    'snapshot_age': None if self.snapshot_time is None else now - self.snapshot_time,
+                    'syncing': self.syncing, 'resyncs': self.resyncs}
+
+    def get_account(self):
+        """ Account information, in the format of Api.get_account """
+        with self.lock:
+            return dict(self.account)
+
+    def get_orders(self):
+        """ Pending orders, in the format of the orders of Api.get_orders """
+        with self.lock:
+            return [dict(order) for order in self.orders.values()]
+
+    def get_order(self, order_id):
+        """ A pending order, or None """
+        with self.lock:
+            order = self.orders.get(int(order_id))
+            return dict(order) if order is not None else None
+
+    def get_trades(self):
+        """ Open trades, in the format of the trades of Api.get_trades """
+        with self.lock:
+            return [dict(trade) for trade in self.trades.values()]
+
+    def get_trade(self, trade_id):
+        """ An open trade, or None """
+        with self.lock:
+            trade = self.trades.get(int(trade_id))
+            return dict(trade) if trade is not None else None
+
+    def get_positions(self):
+        """ Open positions, in the format of the positions of Api.get_positions """
+        with self.lock:
+            return [dict(position) for position in self.positions.values()]
+
+    def get_position(self, instrument):
+        """ The open position of an instrument, or None """
+        with self.lock:
+            position = self.positions.get(instrument)
+            return dict(position) if position is not None else None
+
+    def __on_connect(self):
+        """ Stream (re)connected. Without an Api the stream can not recover the transactions missed meanwhile """
+        self.connects += 1
+        if self.connects > 1 and self.stream is not None and self.stream.api is None:
+            self.resync()
+
+    def __last_id(self):
+        response = self.api.get_transaction_history(self.account_id, False, count=1)
+        if response is None:
+            return None
+        transactions = response.get('transactions', [])
+        return transactions[0]['id'] if transactions else 0
+
+    def __sync(self):
+        """ Take a snapshot, retrying until it succeeds or the mirror is stopped, then apply the buffered transactions
+            The last transaction id is read before and after the snapshot, which is taken again until both match: a
+            transaction made meanwhile may or may not be part of it, and applying a trade reduction or a realized
+            profit twice would silently corrupt the mirror
+        """
+        overtaken = 0
+        while True:
+            before = self.__last_id()
+            reqs = [self.api.get_account(self.account_id, True), self.api.get_orders(self.account_id, True, count=500),
+                    self.api.get_trades(self.account_id, True, count=500),
+                    self.api.get_positions(self.account_id, True)]
+            responses = [r.wait_for_complete() if r else None for r in reqs]
+            after = self.__last_id()
+            complete = before is not None and after is not None and all(r is not None for r in responses)
+            if complete and before == after:
+                break
+            delay = self.retry_interval
+            if complete:
+                delay = min(delay, OVERTAKEN_DELAY * 2 ** overtaken)
+                overtaken += 1
+            if self.stop_event.wait(delay):
+                with self.lock:
+                    self.syncing = False
+                    self.pending = None
+                return
+        account, orders, trades, positions = responses
+        with self.lock:
+            self.account = account
+            self.orders = {order['id']: order for order in orders.get('orders', [])}
+            self.trades = {trade['id']: trade for trade in trades.get('trades', [])}
+            self.positions = {position['instrument']: position for position in positions.get('positions', [])}
+            self.sequence = before
+            self.snapshot_time = self.heard = time.monotonic()
+            self.resyncs += 1
+            consistent = True
+            for transaction in sorted(self.pending, key=lambda t: t['id']):
+                try:
+                    self.__apply(transaction, True)
+                except OutOfSync:
+                    consistent = False
+                    break
+            self.syncing = False
+            self.pending = None
+        if not consistent:
+            self.resync()
+
+    def __apply(self, transaction, strict):
+        """ Apply a transaction to the mirror. Called with lock held
+            :param strict: Raise OutOfSync when the transaction does not match the mirror
+        """
+        transaction_id = transaction['id']
+        if transaction_id <= self.sequence:
+            return
+        if strict and self.strict_sequence and transaction_id != self.sequence + 1:
+            raise OutOfSync(transaction_id)
+        kind = transaction.get('type')
+        instruments = set()
+        if kind in ORDER_CREATE_TYPES:
+            order = {'id': transaction_id, 'instrument': transaction['instrument'], 'units': transaction['units'],
+                     'side': transaction['side'], 'type': ORDER_CREATE_TYPES[kind], 'time': transaction['time'],
+                     'price': transaction.get('price'), 'expiry': transaction.get('expiry'),
+                     'upperBound': transaction.get('upperBound', 0), 'lowerBound': transaction.get('lowerBound', 0),
+                     'takeProfit': transaction.get('takeProfitPrice', 0),
+                     'stopLoss': transaction.get('stopLossPrice', 0),
+                     'trailingStop': transaction.get('trailingStopLossDistance', 0)}
+            self.orders[transaction_id] = order
+        elif kind == 'ORDER_UPDATE':
+            order = self.__find(self.orders, transaction['orderId'], strict)
+            if order is not None:
+                for source, target in ORDER_FIELDS:
+                    if source in transaction:
+                        order[target] = transaction[source]
+        elif kind == 'ORDER_CANCEL':
+            if self.orders.pop(transaction['orderId'], None) is None and strict:
+                raise OutOfSync(transaction_id)
+        elif kind in ('MARKET_ORDER_CREATE', 'ORDER_FILLED', 'MIGRATE_TRADE_OPEN'):
+            order = None
+            if kind == 'ORDER_FILLED':
+                order = self.orders.pop(transaction['orderId'], None)
+                if order is None and strict:
+                    raise OutOfSync(transaction_id)
+            instruments.add(transaction['instrument'])
+            self.__fill(transaction, order or dict(), strict)
+        elif kind == 'TRADE_UPDATE':
+            trade = self.__find(self.trades, transaction['tradeId'], strict)
+            if trade is not None:
+                for source, target in TRADE_FIELDS:
+                    if source in transaction:
+                        trade[target] = transaction[source]
+        elif kind in TRADE_CLOSE_TYPES:
+            trade = self.trades.pop(transaction['tradeId'], None)
+            if trade is None and strict:
+                raise OutOfSync(transaction_id)
+            instruments.add(transaction.get('instrument') or (trade or dict()).get('instrument'))
+        elif kind == 'SET_MARGIN_RATE':
+            self.account['marginRate'] = transaction['rate']
+        elif kind in ('MARGIN_CALL_ENTER', 'MARGIN_CALL_EXIT'):
+            self.account['marginCall'] = kind == 'MARGIN_CALL_ENTER'
+
+        if 'accountBalance' in transaction:
+            self.account['balance'] = transaction['accountBalance']
+        if 'pl' in transaction and 'realizedPl' in self.account:
+            self.account['realizedPl'] += transaction['pl']
+        self.account['openOrders'] = len(self.orders)
+        self.account['openTrades'] = len(self.trades)
+        for instrument in instruments:
+            if instrument is not None:
+                self.__update_position(instrument)
+        self.sequence = transaction_id
+
+    def __fill(self, transaction, order, strict):
+        """ Apply the trades opened, reduced and closed by a market order or a filled order """
+        opened = transaction.get('tradeOpened')
+        if opened:
+            self.trades[opened['id']] = {
+                'id': opened['id'], 'units': opened['units'], 'side': transaction['side'],
+                'instrument': transaction['instrument'], 'time': transaction['time'], 'price': transaction['price'],
+                'takeProfit': transaction.get('takeProfitPrice', order.get('takeProfit', 0)),
+                'stopLoss': transaction.get('stopLossPrice', order.get('stopLoss', 0)),
+                'trailingStop': transaction.get('trailingStopLossDistance', order.get('trailingStop', 0)),
+                'trailingAmount': 0}
+        reduced = transaction.get('tradeReduced')
+        if reduced:
+            trade = self.__find(self.trades, reduced['id'], strict)
+            if trade is not None:
+                trade['units'] -= reduced['units']
+                if trade['units'] <= 0:
+                    del self.trades[reduced['id']]
+        for closed in transaction.get('tradesClosed', []):
+            if self.trades.pop(closed['id'], None) is None and strict:
+                raise OutOfSync(transaction['id'])
+
+    def __update_position(self, instrument):
+        """ Derive the position of an instrument from its open trades """
+        trades = [trade for trade in self.trades.values() if trade['instrument'] == instrument]
+        units = sum(trade['units'] for trade in trades)
+        if not units:
+            self.positions.pop(instrument, None)
+            return
+        self.positions[instrument] = {'instrument': instrument, 'units': units, 'side': trades[0]['side'],
+                                      'avgPrice': sum(trade['units'] * trade['price'] for trade in trades) / units}
+
+    @staticmethod
+    def __find(items, item_id, strict):
+        item = items.get(item_id)
+        if item is None and strict:
+            raise OutOfSync(item_id)
+        return item
@@ -0,0 +1,275 @@
+#! /usr/bin/env python
+
+import json
+import asyncio
+import aiohttp
+from rest import API_URLS
+from exceptions import BadEnvironment
+
+
+class AsyncApi:
+    """
+        Oanda REST API 的asyncio封装, 提供与rest.Api相同的接口, 所有api函数都是协程
+        请求直接在事件循环中通过一个keep-alive连接池发送, 不经过工作线程
+        多个请求可以用asyncio.gather并发执行, 并发数量受连接池大小pool_size限制
+        请求成功时返回Oanda Web Server返回的结果, 失败时为None, 注意检查返回值
+    """
+    def __init__(self, environment="practice", access_token=None, headers=None, pool_size=10, keepalive_timeout=30):
+        """ Instantiates a asyncio API wrapper
+            :param environment: 模拟或真实环境
+            :param access_token: oanda REST API access token
+            :param headers:
+            :param pool_size: Maximum number of simultaneous connections. Default: 10
+            :param keepalive_timeout: Seconds an idle connection is kept open for reuse. Default: 30
+        """
+        if environment not in API_URLS:
+            raise BadEnvironment(environment)
+        self.api_url = API_URLS[environment]
+        self.access_token = access_token
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.headers = dict()
+        self.client = None
+        if self.access_token:
+            self.headers['Authorization'] = 'Bearer ' + self.access_token
+        if headers:
+            self.headers.update(headers)
+
+    async def __aenter__(self):
+        await self.init()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.deinit()
+
+    async def init(self):
+        """ Initialize account module, open the connection pool. Must be called inside the event loop """
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+        self.client = aiohttp.ClientSession(connector=connector, headers=self.headers)
+
+    async def deinit(self):
+        """ De-initialize account module, close the connection pool """
+        if self.client:
+            await self.client.close()
+            self.client = None
+
+    async def __request(self, endpoint, method='GET', params=None):
+        """ Send a request and decode the response
+            :param endpoint: Endpoint of the request, e.g. 'v1/candles'
+            :param method: HTTP method of the request
+            :param params: Query parameters for GET, form data for other methods
+        """
+        if not self.client:
+            return None
+        requests_args = dict()
+        requests_args['params' if method == 'GET' else 'data'] = self.__encode(params or dict())
+        try:
+            async with self.client.request(method, '{0}/{1}'.format(self.api_url, endpoint), **requests_args) as r:
+                content = json.loads((await r.read()).decode('utf-8'))
+                if r.status >= 400:
+                    print("OandaError: {0:d} - {1}".format(r.status, str(content)))
+                    return None
+                return content
+        except aiohttp.ClientError as e:
+            print("ClientError: " + str(e))
+        except json.JSONDecodeError as e:
+            print("JSONDecodeError: " + str(e))
+        except asyncio.TimeoutError:
+            print("TimeoutError: {0} {1}".format(method, endpoint))
+        return None
+
+    @staticmethod
+    def __encode(params):
+        """ Parameters as requests sends them, which aiohttp does not do by itself: None values are left out and
+            booleans become 'True' or 'False'
+        """
+        return {key: str(value) if isinstance(value, bool) else value for key, value in params.items()
+                if value is not None}
+
+
+    async def get_instruments(self, account_id, **params):
+        """ Get a list of trade-able instruments (currency pairs, CFDs, and commodities) that are available for
+            trading with the account specified.
+            :param account_id: Required The account id to fetch the list of trade-able instruments for
+            :param params: Docs: http://developer.oanda.com/rest-live/rates
+        """
+        params['accountId'] = account_id
+        return await self.__request('v1/instruments', params=params)
+
+    async def get_prices(self, **params):
+        """ Fetch live prices for specified instruments that are available on the OANDA platform
+            :param params: Docs: http://developer.oanda.com/rest-live/rates
+        """
+        return await self.__request('v1/prices', params=params)
+
+    async def get_history(self, **params):
+        """ Get historical information on an instrument
+            :param params: Docs: http://developer.oanda.com/rest-live/rates
+        """
+        return await self.__request('v1/candles', params=params)
+
+
+    async def create_account(self, **params):
+        """ Create an account. Valid only in sandbox.
+            :param params: Docs: http://developer.oanda.com/rest-live/accounts
+        """
+        return await self.__request('v1/accounts', method='POST', params=params)
+
+    async def get_accounts(self, **params):
+        """ Get a list of accounts owned by the user.
+            :param params: Docs: http://developer.oanda.com/rest-live/accounts
+        """
+        return await self.__request('v1/accounts', params=params)
+
+    async def get_account(self, account_id, **params):
+        """ Get account information.
+            :param account_id: Required The account id to fetch the information for
+            :param params: Docs: http://developer.oanda.com/rest-live/accounts
+        """
+        return await self.__request('v1/accounts/{0}'.format(account_id), params=params)
+
+
+    async def get_orders(self, account_id, **params):
+        """ This will return all pending orders for an account.
+            :param account_id: Required The account id to fetch the orders
+            :param params: Docs: http://developer.oanda.com/rest-live/orders
+        """
+        return await self.__request('v1/accounts/{0}/orders'.format(account_id), params=params)
+
+    async def create_order(self, account_id, **params):
+        """ Create a new order.
+            :param account_id: Required The account id to create the order
+            :param params: Docs: http://developer.oanda.com/rest-live/orders
+        """
+        return await self.__request('v1/accounts/{0}/orders'.format(account_id), method='POST', params=params)
+
+    async def get_order(self, account_id, order_id, **params):
+        """ Get information for an order.
+            :param account_id: Required The account id to fetch the order information for
+            :param order_id: Required The order identification
+            :param params: Docs: http://developer.oanda.com/rest-live/orders
+        """
+        return await self.__request('v1/accounts/{0}/orders/{1}'.format(account_id, order_id), params=params)
+
+    async def modify_order(self, account_id, order_id, **params):
+        """ Modify an existing order.
+            :param account_id: Required The account id to modify the order
+            :param order_id: Required The order identification
+            :param params: Docs: http://developer.oanda.com/rest-live/orders
+        """
+        return await self.__request('v1/accounts/{0}/orders/{1}'.format(account_id, order_id), method='PATCH',
+                                    params=params)
+
+    async def close_order(self, account_id, order_id, **params):
+        """ Close an existing order.
+            :param account_id: Required The account id to close the order
+            :param order_id: Required The order identification
+            :param params: Docs: http://developer.oanda.com/rest-live/orders
+        """
+        return await self.__request('v1/accounts/{0}/orders/{1}'.format(account_id, order_id), method='DELETE',
+                                    params=params)
+
+
+    async def get_trades(self, account_id, **params):
+        """ Get a list of open trades.
+            :param account_id: Required The account id to fetch trades information
+            :param params: Docs: http://developer.oanda.com/rest-live/trades
+        """
+        return await self.__request('v1/accounts/{0}/trades'.format(account_id), params=params)
+
+    async def get_trade(self, account_id, trade_id, **params):
+        """ Get information on a specific trade.
+            :param account_id: Required The account id to fetch trade information
+            :param trade_id: Required The trade identification
+            :param params: Docs: http://developer.oanda.com/rest-live/trades
+        """
+        return await self.__request('v1/accounts/{0}/trades/{1}'.format(account_id, trade_id), params=params)
+
+    async def modify_trade(self, account_id, trade_id, **params):
+        """ Modify an existing trade.
+            :param account_id: Required The account id to modify trade
+            :param trade_id: Required The trade identification
+            :param params: Docs: http://developer.oanda.com/rest-live/trades
+        """
+        return await self.__request('v1/accounts/{0}/trades/{1}'.format(account_id, trade_id), method='PATCH',
+                                    params=params)
+
+    async def close_trade(self, account_id, trade_id, **params):
+        """ Close an open trade.
+            :param account_id: Required The account id to close trade
+            :param trade_id: Required The trade identification
+            :param params: Docs: http://developer.oanda.com/rest-live/trades
+        """
+        return await self.__request('v1/accounts/{0}/trades/{1}'.format(account_id, trade_id), method='DELETE',
+                                    params=params)
+
+
+    async def get_positions(self, account_id, **params):
+        """ Get a list of all open positions.
+            :param account_id: Required The account id to fetch positions information
+            :param params: Docs: http://developer.oanda.com/rest-live/positions
+        """
+        return await self.__request('v1/accounts/{0}/positions'.format(account_id), params=params)
+
+    async def get_position(self, account_id, instrument, **params):
+        """ Get the position for an instrument.
+            :param account_id: Required The account id to fetch position information
+            :param instrument: Required The instrument
+            :param params: Docs: http://developer.oanda.com/rest-live/positions
+        """
+        return await self.__request('v1/accounts/{0}/positions/{1}'.format(account_id, instrument), params=params)
+
+    async def close_position(self, account_id, instrument, **params):
+        """ Close an existing position.
+            :param account_id: Required The account id to close position
+            :param instrument: Required The instrument
+            :param params: Docs: http://developer.oanda.com/rest-live/positions
+        """
+        return await self.__request('v1/accounts/{0}/positions/{1}'.format(account_id, instrument), method='DELETE',
+                                    params=params)
+
+
+    async def get_transaction_history(self, account_id, **params):
+        """ Get transaction history
+            :param account_id: Required The account id to fetch transaction history
+            :param params: Docs: http://developer.oanda.com/rest-live/transaction-history
+        """
+        return await self.__request('v1/accounts/{0}/transactions'.format(account_id), params=params)
+
+    async def get_transaction(self, account_id, transaction_id):
+        """ Get information for a transaction
+            :param account_id: Required The account id to fetch transaction history
+            :param transaction_id: Required The transaction identification
+        """
+        return await self.__request('v1/accounts/{0}/transactions/{1}'.format(account_id, transaction_id))
+
+
+    async def get_eco_calendar(self, **params):
+        """ Returns up to 1 year of economic calendar info
+            :param params: Docs: http://developer.oanda.com/rest-live/forex-labs/
+        """
+        return await self.__request('labs/v1/calendar', params=params)
+
+    async def get_historical_position_ratios(self, **params):
+        """ Returns up to 1 year of historical position ratios
+            :param params: Docs: http://developer.oanda.com/rest-live/forex-labs/
+        """
+        return await self.__request('labs/v1/historical_position_ratios', params=params)
+
+    async def get_historical_spreads(self, **params):
+        """ Returns up to 1 year of spread information
+            :param params: Docs: http://developer.oanda.com/rest-live/forex-labs/
+        """
+        return await self.__request('labs/v1/spreads', params=params)
+
+    async def get_commitments_of_traders(self, **params):
+        """ Returns up to 4 years of Commitments of Traders data from the CFTC
+            :param params: Docs: http://developer.oanda.com/rest-live/forex-labs/
+        """
+        return await self.__request('labs/v1/commitments_of_traders', params=params)
+
+    async def get_orderbook(self, **params):
+        """ Returns up to 1 year of OANDA Order Book data
+            :param params: Docs: http://developer.oanda.com/rest-live/forex-labs/
+        """
+        return await self.__request('labs/v1/orderbook_data', params=params)
@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+
+""" 离线性能测试, 使用本地模拟的Oanda服务器, 不需要网络
+
+    python benchmark.py                          运行所有测试并输出报告
+    python benchmark.py --json result.json       同时将结果保存为JSON
+    python benchmark.py --compare result.json    与之前保存的结果比较
+"""
+
+import sys
+import json
+import time
+import argparse
+import rest
+import stream
+from fake_server import FakeOanda, INSTRUMENTS, rfc3339
+
+
+def summarize(latencies):
+    """ Mean and percentiles of a list of latencies, in milliseconds """
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+
+    def percentile(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000.0
+
+    return {'mean_ms': sum(ordered) / len(ordered) * 1000.0, 'p50_ms': percentile(0.5), 'p90_ms': percentile(0.9),
+            'p99_ms': percentile(0.99), 'max_ms': ordered[-1] * 1000.0}
+
+
+def bench_rest_throughput(fake, count, pool_size):
+    """ Many concurrent distinct GET requests through rest.Api, without rate limit """
+    api = fake.connect(rest.Api('practice', 'token', pool_size=pool_size, rate_limit=None))
+    api.init()
+    start = time.monotonic()
+    reqs = [api.get_trade('1', i, True) for i in range(count)]
+    for r in reqs:
+        r.wait_for_complete()
+    elapsed = time.monotonic() - start
+    api.deinit()
+    result = {'requests_per_s': count / elapsed, 'errors': sum(1 for r in reqs if r.response is None)}
+    result.update(summarize([r.latency() for r in reqs]))
+    return result
+
+
+def bench_order_latency(fake, backlog, orders, pool_size):
+    """ Latency of orders submitted while a backlog of candle requests is queued """
+    api = fake.connect(rest.Api('practice', 'token', pool_size=pool_size, rate_limit=None))
+    api.init()
+    data = [api.get_history(True, instrument=INSTRUMENTS[i % len(INSTRUMENTS)], granularity='M1', count=500 + i)
+            for i in range(backlog)]
+    result = api.create_orders('1', [{'instrument': 'EUR_USD', 'units': 1000 + i, 'side': 'buy', 'type': 'market'}
+                                     for i in range(orders)])
+    for r in data:
+        r.wait_for_complete()
+    api.deinit()
+    latencies = summarize([item.latency for item in result if item.latency is not None])
+    latencies['batch_ms'] = result.latency * 1000.0
+    return latencies
+
+
+def bench_stream_decode(count):
+    """ Decoding speed of rates stream lines, offline """
+    lines = [json.dumps({'tick': {'instrument': INSTRUMENTS[i % len(INSTRUMENTS)], 'time': rfc3339(1461174064 + i),
+                                  'bid': 1.1 + i % 100 / 10000.0, 'ask': 1.1002 + i % 100 / 10000.0}},
+                        separators=(',', ':')).encode('utf-8') for i in range(count)]
+    result = dict()
+    for name, decode in (('json', stream.decode_line), ('fast', stream.decode_tick)):
+        start = time.perf_counter()
+        for line in lines:
+            decode(line)
+        result[name + '_lines_per_s'] = count / (time.perf_counter() - start)
+    return result
+
+
+def bench_stream_throughput(fake, duration, fast_decode):
+    """ Ticks delivered per second by stream.Stream from a server sending as fast as it can """
+    received = [0]
+
+    def on_stream(data):
+        received[0] += 1
+
+    s = fake.connect(stream.Stream('practice', 'token', True, fast_decode=fast_decode))
+    s.start(on_stream, lambda error: None, instruments=','.join(INSTRUMENTS), ignore_heartbeat=True)
+    time.sleep(duration)
+    count = received[0]
+    s.stop()
+    return {'ticks_per_s': count / duration}
+
+
+def bench_async_throughput(fake, count, pool_size):
+    """ Many concurrent distinct GET requests through async_rest.AsyncApi. Skipped without aiohttp """
+    try:
+        import asyncio
+        import async_rest
+    except ImportError:
+        return None
+
+    async def run():
+        async with fake.connect(async_rest.AsyncApi('practice', 'token', pool_size=pool_size)) as api:
+            api.api_url = fake.rest_url
+            start = time.monotonic()
+            responses = await asyncio.gather(*[api.get_trade('1', i) for i in range(count)])
+            return time.monotonic() - start, responses
+
+    loop = asyncio.new_event_loop()
+    try:
+        elapsed, responses = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    return {'requests_per_s': count / elapsed, 'errors': sum(1 for r in responses if r is None)}
+
+
+def run(args):
+    """ Run every benchmark, returns a dict of benchmark name to dict of measurements """
+    fake = FakeOanda(latency=args.latency, error_rate=args.error_rate, tick_rate=0, seed=1).start()
+    results = dict()
+    try:
+        results['rest_throughput'] = bench_rest_throughput(fake, args.requests, args.pool_size)
+        results['order_latency'] = bench_order_latency(fake, args.backlog, args.orders, args.pool_size)
+        async_result = bench_async_throughput(fake, args.requests, args.pool_size)
+        if async_result is not None:
+            results['async_throughput'] = async_result
+        results['stream_decode'] = bench_stream_decode(args.lines)
+        results['stream_throughput_json'] = bench_stream_throughput(fake, args.duration, False)
+        results['stream_throughput_fast'] = bench_stream_throughput(fake, args.duration, True)
+    finally:
+        fake.stop()
+    return results
+
+
+def report(results, baseline=None, out=sys.stdout):
+    """ Print the results, with the relative change against a baseline when given """
+    for name in sorted(results):
+        for metric in sorted(results[name]):
+            value = results[name][metric]
+            line = '{0:<24} {1:<20} {2:>14.3f}'.format(name, metric, value)
+            previous = (baseline or dict()).get(name, dict()).get(metric)
+            if previous:
+                line += '  {0:+8.1f}%'.format((value - previous) / previous * 100.0)
+            out.write(line + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of rest.Api and stream.Stream')
+    parser.add_argument('--requests', type=int, default=2000, help='REST requests per throughput run')
+    parser.add_argument('--pool-size', type=int, default=8, help='Worker threads / connections of the clients')
+    parser.add_argument('--backlog', type=int, default=200, help='Candle requests queued ahead of the orders')
+    parser.add_argument('--orders', type=int, default=20, help='Orders of the order latency run')
+    parser.add_argument('--lines', type=int, default=200000, help='Lines of the offline decoding run')
+    parser.add_argument('--duration', type=float, default=3.0, help='Seconds of each stream throughput run')
+    parser.add_argument('--latency', type=float, default=0.002, help='Seconds added to each fake REST response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of a fake REST error')
+    parser.add_argument('--json', help='Save the results to this file')
+    parser.add_argument('--compare', help='Compare with the results saved in this file')
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#! /usr/bin/env python
+
+""" 由汇率流实时生成K线 """
+
+import threading
+import collections
+from datetime import datetime, timedelta, timezone
+from stream import Tick
+from columnar import CANDLE_FIELDS
+from timeutil import GRANULARITY_SECONDS, TickTimeParser, from_microseconds, to_epoch
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+
+# Alignment parameters of get_history and their defaults on the server
+DEFAULT_ALIGNMENT = {'dailyAlignment': 17, 'alignmentTimezone': 'America/New_York', 'weeklyAlignment': 'Friday'}
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+
+def get_timezone(name):
+    """ tzinfo of an IANA timezone name, through zoneinfo or else pytz. Without either only UTC is available """
+    if name in ('UTC', 'GMT', 'Etc/UTC'):
+        return timezone.utc
+    if ZoneInfo is not None:
+        return ZoneInfo(name)
+    if pytz is not None:
+        return pytz.timezone(name)
+    raise ValueError("Timezone '{0}' needs the zoneinfo module (Python 3.9+) or pytz".format(name))
+
+
+class CandleAggregator:
+    """ Builds candles of many instruments and granularities at once from the ticks of a rates stream
+        Candles follow the granularity codes, candleFormat and alignment parameters of get_history: seconds and
+        minutes candles are aligned on the hour, hours and daily candles on dailyAlignment in alignmentTimezone,
+        weekly candles on weeklyAlignment and monthly candles on the first day of the month. As on the server, the
+        volume is the number of ticks, and a period without any tick has no candle
+        Each tick updates the in-progress candle of every granularity in constant time, the boundaries of a candle
+        are only computed when it opens. A candle closes with the first tick or heartbeat past its end, on_candle is
+        then invoked with it, and it joins the last completed candles kept in memory
+    """
+    def __init__(self, granularities, on_candle=None, history=100, **params):
+        """ Instantiates an aggregator
+            :param granularities: Granularities to build, e.g. ['M1', 'M5', 'H1']
+            :param on_candle: [Optional] Callback function, invoked as on_candle(instrument, granularity, candle) when
+                              a candle is completed
+            :param history: [Optional] Number of completed candles kept per instrument and granularity. Default: 100
+            :param params: [Optional] Parameters of get_history shaping the candles: candleFormat, dailyAlignment,
+                           alignmentTimezone, weeklyAlignment and dateFormat. Default: the server defaults
+        """
+        for granularity in granularities:
+            if granularity not in GRANULARITY_SECONDS:
+                raise ValueError("Unknown granularity '{0}'".format(granularity))
+        self.granularities = tuple(granularities)
+        self.on_candle = on_candle
+        self.history = history
+        self.params = params
+        self.candle_format = params.get('candleFormat', 'bidask')
+        self.fields = CANDLE_FIELDS[self.candle_format]
+        self.date_format = params.get('dateFormat')
+        self.daily_alignment = int(params.get('dailyAlignment', DEFAULT_ALIGNMENT['dailyAlignment']))
+        self.timezone = get_timezone(params.get('alignmentTimezone', DEFAULT_ALIGNMENT['alignmentTimezone']))
+        self.weekday = WEEKDAYS.index(params.get('weeklyAlignment', DEFAULT_ALIGNMENT['weeklyAlignment']))
+        # (instrument, granularity) -> [start, end, volume, prices...], prices in the order of CANDLE_FIELDS
+        self.candles = dict()
+        self.completed = dict()
+        self.epoch = TickTimeParser()
+        self.lock = threading.Lock()
+        self.stream = None
+
+    def update(self, data):
+        """ Add a tick. Can be given directly as the on_stream callback of a rates stream
+            :param data: A stream.Tick, or a rates stream dict. A heartbeat closes the candles ended before its time
+        """
+        if isinstance(data, Tick):
+            instrument, t, bid, ask = data.instrument, self.epoch(data.time), data.bid, data.ask
+        elif 'tick' in data:
+            tick = data['tick']
+            instrument, t, bid, ask = tick['instrument'], self.epoch(tick['time']), tick['bid'], tick['ask']
+        elif 'heartbeat' in data:
+            self.close(self.epoch(data['heartbeat']['time']))
+            return
+        else:
+            return
+        closed = []
+        with self.lock:
+            candles = self.candles
+            for granularity in self.granularities:
+                key = (instrument, granularity)
+                candle = candles.get(key)
+                if candle is not None and t >= candle[1]:
+                    closed.append(self.__complete(key, candle))
+                    candle = None
+                if candle is None:
+                    start, end = self.bounds(t, granularity)
+                    if self.candle_format == 'midpoint':
+                        mid = (bid + ask) / 2.0
+                        candles[key] = [start, end, 1, mid, mid, mid, mid]
+                    else:
+                        candles[key] = [start, end, 1, bid, ask, bid, ask, bid, ask, bid, ask]
+                elif t >= candle[0]:
+                    candle[2] += 1
+                    if self.candle_format == 'midpoint':
+                        mid = (bid + ask) / 2.0
+                        if mid > candle[4]:
+                            candle[4] = mid
+                        if mid < candle[5]:
+                            candle[5] = mid
+                        candle[6] = mid
+                    else:
+                        if bid > candle[5]:
+                            candle[5] = bid
+                        if ask > candle[6]:
+                            candle[6] = ask
+                        if bid < candle[7]:
+                            candle[7] = bid
+                        if ask < candle[8]:
+                            candle[8] = ask
+                        candle[9] = bid
+                        candle[10] = ask
+        self.__emit(closed)
+
+    def close(self, now):
+        """ Complete the in-progress candles ended before a time, e.g. when no tick arrives for a while
+            :param now: A datetime, an epoch timestamp or an RFC3339 string
+        """
+        now = to_epoch(now)
+        with self.lock:
+            closed = [self.__complete(key, candle) for key, candle in list(self.candles.items()) if candle[1] <= now]
+        self.__emit(closed)
+
+    def current(self, instrument, granularity):
+        """ The in-progress candle of an instrument, in the format of get_history, or None """
+        with self.lock:
+            candle = self.candles.get((instrument, granularity))
+            return self.__format(candle, False) if candle is not None else None
+
+    def completed_candles(self, instrument, granularity):
+        """ The last completed candles of an instrument, oldest first, in the format of get_history """
+        with self.lock:
+            return list(self.completed.get((instrument, granularity), ()))
+
+    def seed(self, api, instruments):
+        """ Load the last candles of every instrument and granularity through get_history, so that the in-progress
+            candles also cover the ticks received before the aggregator started
+            :param api: An initialized rest.Api
+            :param instruments: Instruments to load, a list or a comma separated string
+        """
+        if isinstance(instruments, str):
+            instruments = instruments.split(',')
+        pending = [(instrument, granularity,
+                     api.get_history(True, instrument=instrument, granularity=granularity, count=self.history + 1,
+                                     **self.params))
+                    for instrument in instruments for granularity in self.granularities]
+        for instrument, granularity, r in pending:
+            # None when the Api is no longer working, e.g. a reconnection during deinit
+            response = r.wait_for_complete() if r else None
+            if not response:
+                continue
+            key = (instrument, granularity)
+            completed = collections.deque(maxlen=self.history)
+            candle = None
+            for c in response.get('candles', []):
+                if c.get('complete', True):
+                    completed.append(c)
+                else:
+                    start, end = self.bounds(self.epoch(c['time']), granularity)
+                    candle = [start, end, c['volume']] + [c[field] for field in self.fields]
+            with self.lock:
+                self.completed[key] = completed
+                if candle is not None:
+                    self.candles[key] = candle
+                else:
+                    self.candles.pop(key, None)
+
+    def start(self, stream, api, instruments, on_error=None, **params):
+        """ Follow a rates stream. The aggregator is seeded through get_history each time the stream (re)connects,
+            so that ticks missed while disconnected are accounted for
+            :param stream: A rates stream.Stream, not started yet
+            :param api: An initialized rest.Api used for seeding
+            :param instruments: Instruments to follow, a list or a comma separated string
+            :param on_error: [Optional] Callback function, invoked when the stream reports an error
+            :param params: Other parameters of the stream, e.g. accountId. Keep the heartbeats for timely closing
+        """
+        if not isinstance(instruments, str):
+            instruments = ','.join(instruments)
+        self.stream = stream
+        stream.start(self.update, on_error, on_connect=lambda: self.seed(api, instruments), instruments=instruments,
+                     **params)
+
+    def stop(self):
+        """ Stop following the rates stream """
+        if self.stream:
+            self.stream.stop()
+            self.stream = None
+
+    def bounds(self, t, granularity):
+        """ Start and end, in epoch seconds, of the candle of a granularity containing a time in epoch seconds """
+        seconds = GRANULARITY_SECONDS[granularity]
+        if granularity[0] in 'SM' and granularity != 'M':
+            start = t - t % seconds
+            return start, start + seconds
+        day, start, end = self.__day(t)
+        if granularity[0] == 'H':
+            start += (t - start) // seconds * seconds
+            return start, min(start + seconds, end)
+        if granularity == 'D':
+            return start, end
+        if granularity == 'W':
+            day -= timedelta(days=(day.weekday() - self.weekday) % 7)
+            return self.__local(day), self.__local(day + timedelta(days=7))
+        first = day.replace(day=1)
+        start = self.__local(first)
+        if start > t:
+            first = (first - timedelta(days=1)).replace(day=1)
+            start = self.__local(first)
+        following = (first + timedelta(days=31)).replace(day=1)
+        return start, self.__local(following)
+
+    def __day(self, t):
+        """ Local date, start and end of the trading day containing t, days starting at dailyAlignment """
+        day = datetime.fromtimestamp(t, self.timezone).date()
+        start = self.__local(day)
+        if start > t:
+            day -= timedelta(days=1)
+            start = self.__local(day)
+        return day, start, self.__local(day + timedelta(days=1))
+
+    def __local(self, day):
+        """ Epoch seconds of dailyAlignment o'clock on a local date """
+        naive = datetime(day.year, day.month, day.day, self.daily_alignment)
+        if hasattr(self.timezone, 'localize'):
+            return to_epoch(self.timezone.localize(naive))
+        return to_epoch(naive.replace(tzinfo=self.timezone))
+
+    def __complete(self, key, candle):
+        """ Move an in-progress candle to the completed ones. Called with lock held """
+        del self.candles[key]
+        formatted = self.__format(candle, True)
+        completed = self.completed.get(key)
+        if completed is None:
+            completed = self.completed[key] = collections.deque(maxlen=self.history)
+        completed.append(formatted)
+        return key[0], key[1], formatted
+
+    def __format(self, candle, complete):
+        """ A candle in the format of get_history """
+        microseconds = int(round(candle[0] * 1000000))
+        if self.date_format == 'unix':
+            time = str(microseconds)
+        else:
+            # As formatted by the server, so that seeded and aggregated candles compare equal
+            time = from_microseconds(microseconds).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        formatted = {'time': time}
+        formatted.update(zip(self.fields, candle[3:]))
+        formatted['volume'] = candle[2]
+        formatted['complete'] = complete
+        return formatted
+
+    def __emit(self, closed):
+        if self.on_candle:
+            for instrument, granularity, candle in closed:
+                self.on_candle(instrument, granularity, candle)
@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+
+""" 本地K线缓存, 避免重复下载相同的历史汇率 """
+
+import os
+import json
+import mmap
+import time
+import bisect
+import threading
+from array import array
+from timeutil import GRANULARITY_SECONDS, to_epoch, from_microseconds
+from columnar import CANDLE_FIELDS
+
+# Parameters of get_history that change the content of the candles, and therefore are part of the cache key
+KEY_PARAMS = ('candleFormat', 'dailyAlignment', 'alignmentTimezone', 'weeklyAlignment')
+
+
+class CandleStore:
+    """ Local on-disk cache of candles, used in place of Api.get_history
+        Candles are stored per (instrument, granularity, candleFormat, alignment parameters), one binary file per
+        column (time in epoch microseconds and volume as int64, prices as float64), which are read back through memory
+        mapping. Only complete candles are stored. A request fetches from the server only the parts of the range not
+        covered yet. Each key has its own lock, so that different instruments are refreshed concurrently
+    """
+    def __init__(self, api, directory):
+        """ Instantiates a candle store
+            :param api: rest.Api used to fetch missing candles, must be initialized
+            :param directory: Root directory of the store, created if it does not exist
+        """
+        self.api = api
+        self.directory = directory
+        # Guards locks, the dict of the lock of each key directory
+        self.lock = threading.Lock()
+        self.locks = dict()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_history(self, instrument, granularity, start, end, max_concurrency=4, **params):
+        """ Get historical information on an instrument, from disk when possible. Returns a response in the same
+            format as Api.get_history, or None if fetching a missing range failed
+            :param instrument: Required Name of the instrument
+            :param granularity: Required The time range represented by each candlestick, e.g. 'M1'
+            :param start: Required Start of the range, a datetime, an epoch timestamp or an RFC3339 string
+            :param end: Required End of the range, same types as start
+            :param max_concurrency: Maximum number of requests in flight when fetching missing ranges. Default: 4
+            :param params: Other parameters of get_history except count, start and end
+        """
+        candle_format = params.setdefault('candleFormat', 'bidask')
+        date_format = params.pop('dateFormat', None)
+        begin, finish = to_epoch(start), to_epoch(end)
+        path = self.__path(instrument, granularity, params)
+
+        with self.__lock(path):
+            meta = self.__load_meta(path, candle_format)
+            incomplete = []
+            for missing_begin, missing_end in self.__missing(meta['ranges'], begin, finish):
+                response = self.api.backfill_history(instrument, granularity, missing_begin, missing_end,
+                                                     max_concurrency, dateFormat='unix', **params)
+                if response is None:
+                    return None
+                covered_end = min(missing_end, time.time())
+                complete = []
+                for candle in response['candles']:
+                    if candle['complete']:
+                        complete.append(candle)
+                    else:
+                        incomplete.append(candle)
+                        covered_end = min(covered_end, int(candle['time']) / 1000000.0)
+                self.__merge(path, meta, complete, missing_begin, covered_end)
+
+            candles = self.__read(path, meta, granularity, begin, finish)
+        candles.extend(incomplete)
+        for candle in candles:
+            candle['time'] = self.__format_time(int(candle['time']), date_format)
+        return {'instrument': instrument, 'granularity': granularity, 'candles': candles}
+
+    def columns(self, instrument, granularity, **params):
+        """ Memory mapped columns of all the candles stored for a key, as a dict of column name to memoryview
+            :param instrument: Required Name of the instrument
+            :param granularity: Required The time range represented by each candlestick, e.g. 'M1'
+            :param params: candleFormat and alignment parameters of the key
+        """
+        candle_format = params.setdefault('candleFormat', 'bidask')
+        path = self.__path(instrument, granularity, params)
+        with self.__lock(path):
+            meta = self.__load_meta(path, candle_format)
+            return {name: self.__map(path, name, code) for name, code in meta['columns']}
+
+    def __lock(self, path):
+        """ Lock of a cache key, held while its files are read or written """
+        with self.lock:
+            lock = self.locks.get(path)
+            if lock is None:
+                lock = self.locks[path] = threading.Lock()
+            return lock
+
+    def __path(self, instrument, granularity, params):
+        """ Directory of a cache key """
+        parts = [instrument, granularity] + [str(params.get(name, 'default')).replace('/', '.') for name in KEY_PARAMS]
+        return os.path.join(self.directory, '-'.join(parts))
+
+    @staticmethod
+    def __load_meta(path, candle_format):
+        """ Load the description of a cache key: its columns and the time ranges already covered """
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            columns = [['time', 'q']] + [[name, 'd'] for name in CANDLE_FIELDS[candle_format]] + [['volume', 'q']]
+            return {'columns': columns, 'ranges': []}
+
+    @staticmethod
+    def __missing(ranges, begin, finish):
+        """ Parts of [begin, finish] not covered by the sorted, disjoint ranges """
+        missing = []
+        for covered_begin, covered_end in ranges:
+            if covered_end <= begin:
+                continue
+            if covered_begin >= finish:
+                break
+            if covered_begin > begin:
+                missing.append((begin, covered_begin))
+            begin = max(begin, covered_end)
+        if begin < finish:
+            missing.append((begin, finish))
+        return missing
+
+    @staticmethod
+    def __map(path, name, code):
+        """ Memory map a column file, returns a typed memoryview of it """
+        filename = os.path.join(path, name + '.bin')
+        if not os.path.exists(filename) or not os.path.getsize(filename):
+            return memoryview(array(code))
+        with open(filename, 'rb') as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(code)
+
+    def __merge(self, path, meta, candles, begin, end):
+        """ Merge new complete candles into the column files, and mark [begin, end] as covered """
+        os.makedirs(path, exist_ok=True)
+        rows = []
+        if candles:
+            columns = [(name, array(code, self.__map(path, name, code))) for name, code in meta['columns']]
+            times = columns[0][1]
+            for candle in sorted(candles, key=lambda c: int(c['time'])):
+                t = int(candle['time'])
+                i = bisect.bisect_left(times, t)
+                if not (i < len(times) and times[i] == t):
+                    rows.append((i, t, candle))
+        if rows:
+            if rows[0][0] == rows[-1][0]:
+                # The usual case, all the new candles fill one gap: insert them as a block
+                i = rows[0][0]
+                for name, column in columns:
+                    column[i:i] = array(column.typecode, [t if name == 'time' else c[name] for _, t, c in rows])
+            else:
+                for offset, (i, t, candle) in enumerate(rows):
+                    for name, column in columns:
+                        column.insert(i + offset, t if name == 'time' else candle[name])
+            for name, column in columns:
+                filename = os.path.join(path, name + '.bin')
+                with open(filename + '.tmp', 'wb') as f:
+                    column.tofile(f)
+                os.replace(filename + '.tmp', filename)
+
+        if begin < end:
+            ranges = sorted(meta['ranges'] + [[begin, end]])
+            meta['ranges'] = [ranges[0]]
+            for r in ranges[1:]:
+                if r[0] <= meta['ranges'][-1][1]:
+                    meta['ranges'][-1][1] = max(meta['ranges'][-1][1], r[1])
+                else:
+                    meta['ranges'].append(r)
+        with open(os.path.join(path, 'meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
+
+    def __read(self, path, meta, granularity, begin, finish):
+        """ Stored candles within [begin, finish], as dicts in the get_history format. As on the server, the range
+            starts with the candle containing begin
+        """
+        columns = [(name, self.__map(path, name, code)) for name, code in meta['columns']]
+        times = columns[0][1]
+        first = int(begin * 1000000)
+        lo = bisect.bisect_right(times, first)
+        # Months are up to 31 days long, the other candles as long as their granularity
+        span = 31 * 86400 if granularity == 'M' else GRANULARITY_SECONDS[granularity]
+        if lo and times[lo - 1] + span * 1000000 > first:
+            lo -= 1
+        hi = bisect.bisect_right(times, int(finish * 1000000))
+        candles = []
+        for i in range(lo, hi):
+            candle = {name: column[i] for name, column in columns}
+            candle['complete'] = True
+            candles.append(candle)
+        return candles
+
+    @staticmethod
+    def __format_time(microseconds, date_format):
+        """ Format a stored time the way the server would for the dateFormat of the request """
+        if date_format == 'unix':
+            return str(microseconds)
+        return from_microseconds(microseconds).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
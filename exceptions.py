@@ -5,7 +5,13 @@ class OandaError(Exception):
     """ Generic error class, catches oanda response errors """
     def __init__(self, error_response):
         self.error_response = error_response
-        msg = 'Oanda API returned error code {0} - {1}'.format(error_response['code'], error_response['message'])
+        if isinstance(error_response, dict):
+            self.code = error_response.get('code')
+            message = error_response.get('message')
+        else:
+            self.code = None
+            message = str(error_response)
+        msg = 'Oanda API returned error code {0} - {1}'.format(self.code, message)
         super(OandaError, self).__init__(msg)
 
 
@@ -0,0 +1,304 @@
+#! /usr/bin/env python
+
+""" 本地模拟的Oanda服务器, 用于离线测试与性能测试, 不需要网络, 也不会动用真实账户 """
+
+import re
+import json
+import time
+import random
+import threading
+import socketserver
+from urllib.parse import urlparse, parse_qsl
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from timeutil import GRANULARITY_SECONDS, to_epoch, from_microseconds
+
+
+INSTRUMENTS = ('EUR_USD', 'USD_JPY', 'GBP_USD', 'AUD_USD', 'USD_CAD', 'USD_CHF', 'NZD_USD', 'EUR_JPY')
+
+
+def rfc3339(epoch):
+    """ Format an epoch timestamp the way Oanda does in responses """
+    return from_microseconds(int(epoch * 1000000)).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def fake_transaction(account_id, transaction_id):
+    """ A made up v1 transaction """
+    return {'id': transaction_id, 'accountId': int(account_id), 'time': rfc3339(time.time()),
+            'type': 'DAILY_INTEREST', 'instrument': 'EUR_USD', 'interest': 0.01, 'accountBalance': 100000}
+
+
+class FakeOanda:
+    """ Emulates the v1 REST endpoints and the chunked v1/prices and v1/events streams on two local ports
+        Responses follow the v1 layouts with made up values. Latency, error rate, tick rate and event rate are
+        configurable. Point a client to it with connect()
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, tick_rate=100.0, event_rate=1.0, heartbeat_interval=5.0,
+                 seed=None):
+        """ Instantiates a fake server, not started yet
+            :param latency: Seconds added to every REST response. Default: 0
+            :param error_rate: Probability of a REST request failing with a 500 error. Default: 0
+            :param tick_rate: Price ticks per second on each rates stream, 0 for as fast as possible. Default: 100
+            :param event_rate: Transactions per second on each events stream. Default: 1
+            :param heartbeat_interval: Seconds between heartbeats on the streams. Default: 5
+            :param seed: [Optional] Seed of the random generator, for repeatable runs
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.tick_rate = tick_rate
+        self.event_rate = event_rate
+        self.heartbeat_interval = heartbeat_interval
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.transaction_id = 1000
+        self.requests = 0
+        self.servers = []
+        self.rest_url = None
+        self.stream_url = None
+
+    def start(self):
+        """ Start serving on two free local ports """
+        rest = self.__serve(RestHandler)
+        stream = self.__serve(StreamHandler)
+        self.rest_url = 'http://127.0.0.1:{0}'.format(rest.server_address[1])
+        self.stream_url = 'http://127.0.0.1:{0}'.format(stream.server_address[1])
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+    def connect(self, client):
+        """ Point a rest.Api, async_rest.AsyncApi or stream.Stream to the fake server """
+        client.api_url = self.stream_url if hasattr(client, 'rates_stream') else self.rest_url
+        return client
+
+    def next_transaction_id(self):
+        with self.lock:
+            self.transaction_id += 1
+            return self.transaction_id
+
+    def __serve(self, handler):
+        server = FakeHttpServer(('127.0.0.1', 0), handler)
+        server.fake = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return server
+
+
+class FakeHttpServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connection bursts, the clients then wait a second for the SYN retransmission
+    request_queue_size = 128
+    fake = None
+
+
+class RestHandler(BaseHTTPRequestHandler):
+    """ Answers the v1 REST endpoints """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle would delay the body until the client acknowledges the headers
+    disable_nagle_algorithm = True
+    ROUTES = (
+        ('GET', r'^v1/instruments$', 'instruments'),
+        ('GET', r'^v1/prices$', 'prices'),
+        ('GET', r'^v1/candles$', 'candles'),
+        ('GET', r'^v1/accounts$', 'accounts'),
+        ('POST', r'^v1/accounts$', 'create_account'),
+        ('GET', r'^v1/accounts/(\w+)$', 'account'),
+        ('GET', r'^v1/accounts/(\w+)/(orders|trades|positions|transactions)$', 'collection'),
+        ('POST', r'^v1/accounts/(\w+)/orders$', 'create_order'),
+        ('GET', r'^v1/accounts/(\w+)/(orders|trades|positions|transactions)/(\w+)$', 'item'),
+        ('PATCH', r'^v1/accounts/(\w+)/(orders|trades)/(\w+)$', 'item'),
+        ('DELETE', r'^v1/accounts/(\w+)/(orders|trades|positions)/(\w+)$', 'close'),
+        ('GET', r'^labs/v1/(\w+)$', 'labs'),
+    )
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.__handle()
+
+    def do_POST(self):
+        self.__handle()
+
+    def do_PATCH(self):
+        self.__handle()
+
+    def do_DELETE(self):
+        self.__handle()
+
+    def __handle(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(parse_qsl(self.rfile.read(length).decode('utf-8')))
+        with fake.lock:
+            fake.requests += 1
+            failed = fake.random.random() < fake.error_rate
+        if fake.latency:
+            time.sleep(fake.latency)
+
+        status, content = 404, {'code': 4, 'message': 'Not found', 'moreInfo': ''}
+        if failed:
+            status, content = 500, {'code': 0, 'message': 'Injected error', 'moreInfo': ''}
+        else:
+            for method, pattern, name in self.ROUTES:
+                match = re.match(pattern, url.path.lstrip('/'))
+                if method == self.command and match:
+                    status, content = 200, getattr(self, name)(fake, params, *match.groups())
+                    break
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def instruments(fake, params):
+        return {'instruments': [{'instrument': i, 'displayName': i.replace('_', '/'), 'pip': '0.0001',
+                                 'maxTradeUnits': 10000000} for i in INSTRUMENTS]}
+
+    @staticmethod
+    def prices(fake, params):
+        now = time.time()
+        instruments = params.get('instruments', 'EUR_USD').split(',')
+        return {'prices': [{'instrument': i, 'time': RestHandler.__time(now, params), 'bid': 1.1, 'ask': 1.1002}
+                           for i in instruments]}
+
+    @staticmethod
+    def candles(fake, params):
+        granularity = params.get('granularity', 'S5')
+        step = GRANULARITY_SECONDS[granularity]
+        unix = params.get('dateFormat') == 'unix'
+        # As on the server, count is ignored when both start and end are given
+        count = 5000 if 'start' in params and 'end' in params else min(int(params.get('count', 500)), 5000)
+        end = to_epoch(float(params['end']) if unix else params['end']) if 'end' in params else time.time()
+        if 'start' in params:
+            t = to_epoch(float(params['start']) if unix else params['start']) // step * step
+        else:
+            t = (end // step - count + 1) * step
+        bidask = params.get('candleFormat', 'bidask') == 'bidask'
+        candles = []
+        while t <= end and len(candles) < count:
+            price = 1.1 + (t % 3600) / 1000000.0
+            candle = {'time': RestHandler.__time(t, params)}
+            if bidask:
+                candle.update(openBid=price, openAsk=price + 0.0002, highBid=price + 0.0005, highAsk=price + 0.0007,
+                              lowBid=price - 0.0005, lowAsk=price - 0.0003, closeBid=price + 0.0001,
+                              closeAsk=price + 0.0003)
+            else:
+                candle.update(openMid=price, highMid=price + 0.0005, lowMid=price - 0.0005, closeMid=price + 0.0001)
+            candle.update(volume=10, complete=t + step <= time.time())
+            candles.append(candle)
+            t += step
+        return {'instrument': params.get('instrument'), 'granularity': granularity, 'candles': candles}
+
+    @staticmethod
+    def accounts(fake, params):
+        return {'accounts': [{'accountId': 1, 'accountName': 'Primary', 'accountCurrency': 'USD', 'marginRate': 0.05}]}
+
+    @staticmethod
+    def create_account(fake, params):
+        return {'username': 'fake', 'password': 'fake', 'accountId': fake.next_transaction_id()}
+
+    @staticmethod
+    def account(fake, params, account_id):
+        return {'accountId': int(account_id), 'accountName': 'Primary', 'balance': 100000, 'unrealizedPl': 0,
+                'realizedPl': 0, 'marginUsed': 0, 'marginAvail': 100000, 'openTrades': 0, 'openOrders': 0,
+                'marginRate': 0.05, 'accountCurrency': 'USD'}
+
+    @staticmethod
+    def collection(fake, params, account_id, kind):
+        if kind == 'transactions':
+            high = min(int(params.get('maxId', fake.transaction_id)), fake.transaction_id)
+            low = int(params.get('minId', 1))
+            ids = range(high, max(low, high - int(params.get('count', 50)) + 1) - 1, -1)
+            return {'transactions': [fake_transaction(account_id, i) for i in ids]}
+        return {kind: []}
+
+    @staticmethod
+    def create_order(fake, params, account_id):
+        price = 1.1002 if params.get('side', 'buy') == 'buy' else 1.1
+        return {'instrument': params.get('instrument'), 'time': rfc3339(time.time()), 'price': price,
+                'tradeOpened': {'id': fake.next_transaction_id(), 'units': int(params.get('units', 0)),
+                                'side': params.get('side', 'buy'), 'takeProfit': 0, 'stopLoss': 0,
+                                'trailingStop': 0},
+                'tradesClosed': [], 'tradeReduced': {}}
+
+    @staticmethod
+    def item(fake, params, account_id, kind, item_id):
+        if kind == 'transactions':
+            return fake_transaction(account_id, int(item_id))
+        return {'id': int(item_id) if item_id.isdigit() else item_id, 'instrument': 'EUR_USD', 'units': 1000,
+                'side': 'buy', 'price': 1.1, 'time': rfc3339(time.time())}
+
+    @staticmethod
+    def close(fake, params, account_id, kind, item_id):
+        return {'id': fake.next_transaction_id(), 'instrument': 'EUR_USD', 'price': 1.1,
+                'time': rfc3339(time.time())}
+
+    @staticmethod
+    def labs(fake, params, name):
+        return [] if name != 'orderbook_data' else {}
+
+    @staticmethod
+    def __time(epoch, params):
+        return str(int(epoch * 1000000)) if params.get('dateFormat') == 'unix' else rfc3339(epoch)
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """ Serves the chunked v1/prices and v1/events streams until the client disconnects """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        if url.path not in ('/v1/prices', '/v1/events'):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        rates = url.path == '/v1/prices'
+        instruments = params.get('instruments', 'EUR_USD').split(',')
+        rate = fake.tick_rate if rates else fake.event_rate
+        interval = 1.0 / rate if rate else 0.0
+        account_ids = params.get('accountIds', '1').split(',')
+        count = 0
+        next_heartbeat = time.time() + fake.heartbeat_interval
+        try:
+            while True:
+                now = time.time()
+                if now >= next_heartbeat:
+                    self.__send({'heartbeat': {'time': rfc3339(now)}})
+                    next_heartbeat = now + fake.heartbeat_interval
+                if rates:
+                    price = 1.1 + (count % 1000) / 100000.0
+                    line = {'tick': {'instrument': instruments[count % len(instruments)], 'time': rfc3339(now),
+                                     'bid': round(price, 5), 'ask': round(price + 0.0002, 5)}}
+                else:
+                    line = {'transaction': fake_transaction(account_ids[count % len(account_ids)],
+                                                            fake.next_transaction_id())}
+                self.__send(line)
+                count += 1
+                if interval:
+                    time.sleep(interval)
+        except OSError:
+            # The client disconnected
+            pass
+
+    def __send(self, data):
+        line = json.dumps(data, separators=(',', ':')).encode('utf-8') + b'\r\n'
+        self.wfile.write('{0:x}\r\n'.format(len(line)).encode('ascii') + line + b'\r\n')
@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+
+""" 延迟与吞吐量的性能指标 """
+
+import bisect
+import threading
+import collections
+
+
+# Upper bounds in seconds of the latency histogram buckets, from 50us to 30s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    """ Hook interface receiving the measurements of rest.Api and stream.Stream. Every method does nothing, a
+        collector overrides the ones it needs. Give an instance as the metrics parameter of Api or Stream; without
+        one no measurement is taken at all
+    """
+    def on_request(self, endpoint, method, status, queue_wait, http_time, decode_time):
+        """ A request completed
+            :param endpoint: Endpoint pattern, e.g. 'v1/accounts/{account_id}/orders'
+            :param method: HTTP method
+            :param status: HTTP status code, None if the request failed without a response
+            :param queue_wait: Seconds from submission until a worker sent the request
+            :param http_time: Seconds until the response was received
+            :param decode_time: Seconds spent decoding the response
+        """
+
+    def on_connection(self, kind, latency):
+        """ A request whose latency depends on the state of the pooled connections completed
+            :param kind: 'warmup' and 'keepalive' for the cheap requests opening and refreshing connections, 'first' for
+                         the first request after init, 'idle' for the first request after IDLE_SECONDS without traffic
+            :param latency: Seconds until the response was received
+        """
+
+    def on_tick(self, instrument, gap):
+        """ A price tick arrived on a rates stream
+            :param instrument: The instrument of the tick
+            :param gap: Seconds since the previous tick of the instrument, None for the first one
+        """
+
+    def add_gauge(self, name, function):
+        """ Register a value sampled when the metrics are read, e.g. queue depths
+            :param name: Name of the gauge
+            :param function: Called without arguments, returns the current value
+        """
+
+
+class Histogram:
+    """ Fixed bucket histogram of durations in seconds """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile, max for the overflow bucket """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99), 'max': self.max}
+
+
+class MetricsRecorder(Metrics):
+    """ Collects the measurements in memory: per endpoint latency histograms of each stage (queue, http, decode and
+        total), error counters by status, latency histograms of the first, after idle, warm-up and keep-alive
+        requests, per instrument tick counts, rates and inter-arrival gaps, and gauges.
+        snapshot() returns all of them as a dict, export() hands that dict to every registered exporter
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(Histogram)
+        self.errors = collections.Counter()
+        self.ticks = collections.defaultdict(Histogram)
+        self.tick_counts = collections.Counter()
+        self.connections = collections.defaultdict(Histogram)
+        self.gauges = dict()
+        self.exporters = []
+
+    def on_request(self, endpoint, method, status, queue_wait, http_time, decode_time):
+        name = method + ' ' + endpoint
+        with self.lock:
+            self.latencies[(name, 'queue')].add(queue_wait)
+            self.latencies[(name, 'http')].add(http_time)
+            self.latencies[(name, 'decode')].add(decode_time)
+            self.latencies[(name, 'total')].add(queue_wait + http_time + decode_time)
+            if status is None or status >= 400:
+                self.errors[(name, status)] += 1
+
+    def on_connection(self, kind, latency):
+        with self.lock:
+            self.connections[kind].add(latency)
+
+    def on_tick(self, instrument, gap):
+        with self.lock:
+            self.tick_counts[instrument] += 1
+            if gap is not None:
+                self.ticks[instrument].add(gap)
+
+    def add_gauge(self, name, function):
+        self.gauges[name] = function
+
+    def add_exporter(self, exporter):
+        """ Register a function called by export() with the snapshot dict """
+        self.exporters.append(exporter)
+
+    def snapshot(self):
+        """ All the metrics as a dict: 'requests', 'errors', 'connections', 'ticks' and 'gauges' """
+        with self.lock:
+            requests = collections.defaultdict(dict)
+            for (name, stage), histogram in self.latencies.items():
+                requests[name][stage] = histogram.summary()
+            errors = {'{0} {1}'.format(name, status): count for (name, status), count in self.errors.items()}
+            ticks = dict()
+            for instrument, count in self.tick_counts.items():
+                gaps = self.ticks[instrument]
+                ticks[instrument] = {'count': count, 'rate': gaps.count / gaps.total if gaps.total else 0.0,
+                                     'gap': gaps.summary()}
+            connections = {kind: histogram.summary() for kind, histogram in self.connections.items()}
+        gauges = {name: function() for name, function in self.gauges.items()}
+        return {'requests': dict(requests), 'errors': errors, 'connections': connections, 'ticks': ticks,
+                'gauges': gauges}
+
+    def export(self):
+        """ Pass a snapshot to every exporter """
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            exporter(snapshot)
+        return snapshot
+
+    def reset(self):
+        with self.lock:
+            self.latencies.clear()
+            self.errors.clear()
+            self.ticks.clear()
+            self.tick_counts.clear()
+            self.connections.clear()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+
+""" 由汇率流实时更新的最新报价簿 """
+
+import threading
+from stream import Tick
+from timeutil import TickTimeParser
+
+
+class PriceBook:
+    """ Latest bid/ask of each instrument, updated in place by a rates stream
+        Reading the latest tick of one instrument takes no lock. Updates, snapshots and waits share one condition.
+        Ticks are stored as stream.Tick objects whatever the decoding mode of the stream. A tick older than the one
+        already stored for its instrument is ignored, times are compared as epochs so that the RFC3339 prices of seed()
+        and the unix times of a stream with dateFormat='unix' can be mixed
+    """
+    def __init__(self):
+        self.prices = dict()
+        self.sequences = dict()
+        # Epoch seconds of the stored tick of each instrument
+        self.times = dict()
+        self.epoch = TickTimeParser()
+        self.condition = threading.Condition()
+        self.stream = None
+
+    def update(self, data):
+        """ Store a tick. Can be given directly as the on_stream callback of a rates stream
+            :param data: A stream.Tick, or a rates stream dict. Heartbeats are ignored
+        """
+        if not isinstance(data, Tick):
+            tick = data.get('tick')
+            if tick is None or 'bid' not in tick:
+                return
+            data = Tick(tick['instrument'], tick['time'], tick['bid'], tick['ask'])
+        with self.condition:
+            t = self.epoch(data.time)
+            current = self.times.get(data.instrument)
+            if current is not None and t < current:
+                return
+            self.times[data.instrument] = t
+            self.prices[data.instrument] = data
+            self.sequences[data.instrument] = self.sequences.get(data.instrument, 0) + 1
+            self.condition.notify_all()
+
+    def get(self, instrument):
+        """ Latest tick of an instrument, or None if no price is known yet """
+        return self.prices.get(instrument)
+
+    def snapshot(self, instruments=None):
+        """ Latest ticks of a set of instruments, all taken at the same moment
+            :param instruments: [Optional] Instruments to include. Default: all the known instruments
+        """
+        with self.condition:
+            if instruments is None:
+                return dict(self.prices)
+            return {instrument: self.prices.get(instrument) for instrument in instruments}
+
+    def wait_for_update(self, instruments, timeout=None):
+        """ Block until one of the instruments receives a new tick. Returns a snapshot of the instruments, or None on
+            timeout
+            :param instruments: Instruments to watch
+            :param timeout: [Optional] Maximum seconds to wait. Default: wait forever
+        """
+        with self.condition:
+            sequences = [(instrument, self.sequences.get(instrument, 0)) for instrument in instruments]
+            updated = self.condition.wait_for(
+                lambda: any(self.sequences.get(instrument, 0) != sequence for instrument, sequence in sequences),
+                timeout)
+            if not updated:
+                return None
+            return {instrument: self.prices.get(instrument) for instrument in instruments}
+
+    def seed(self, api, instruments):
+        """ Load the current prices through the REST API
+            :param api: An initialized rest.Api
+            :param instruments: Instruments to load, a list or a comma separated string
+        """
+        if not isinstance(instruments, str):
+            instruments = ','.join(instruments)
+        response = api.get_prices(False, instruments=instruments)
+        if response:
+            for price in response.get('prices', []):
+                self.update(Tick(price['instrument'], price['time'], price['bid'], price['ask']))
+
+    def start(self, stream, api, instruments, on_error=None, **params):
+        """ Keep the book updated from a rates stream. The book is seeded through get_prices each time the stream
+            (re)connects, so that prices missed while disconnected are recovered
+            :param stream: A rates stream.Stream, not started yet
+            :param api: An initialized rest.Api used for seeding
+            :param instruments: Instruments to follow, a list or a comma separated string
+            :param on_error: [Optional] Callback function, invoked when the stream reports an error
+            :param params: Other parameters of the stream, e.g. accountId
+        """
+        if not isinstance(instruments, str):
+            instruments = ','.join(instruments)
+        self.stream = stream
+        stream.start(self.update, on_error, on_connect=lambda: self.seed(api, instruments), instruments=instruments,
+                     **params)
+
+    def stop(self):
+        """ Stop following the rates stream """
+        if self.stream:
+            self.stream.stop()
+            self.stream = None
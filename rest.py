@@ -3,29 +3,439 @@
 import requests
 import queue
 import threading
+import time
 import json
+import re
+import collections
+import functools
+import concurrent.futures
+import columnar as columnar_module
 from threading import Event
-from exceptions import BadEnvironment
+from requests.adapters import HTTPAdapter
+from exceptions import BadEnvironment, OandaError
+from timeutil import GRANULARITY_SECONDS, to_epoch, format_time
 
 
-class ApiRequest:
+API_URLS = {
+    'sandbox': 'http://api-sandbox.oanda.com',
+    'practice': 'https://api-fxpractice.oanda.com',
+    'live': 'https://api-fxtrade.oanda.com',
+}
+
+# Maximum number of candles the server returns for one v1/candles request
+MAX_CANDLES = 5000
+
+# Decoder of the columnar candles of each candleFormat. Requests are coalesced and cached by decoder, among others,
+# so the same one must be used each time
+CANDLE_DECODERS = {candle_format: functools.partial(columnar_module.decode_candles, candle_format=candle_format)
+                   for candle_format in columnar_module.CANDLE_FIELDS}
+
+# Oanda v1 REST API 的请求频率限制, 每秒请求数
+RATE_LIMIT = 15
+
+# 预热与保活连接时发送的低开销请求
+WARMUP_ENDPOINT = 'v1/prices'
+WARMUP_PARAMS = {'instruments': 'EUR_USD'}
+
+# 超过该秒数没有任何请求后发送的第一个请求, 作为空闲后的请求报告给metrics
+IDLE_SECONDS = 30
+
+# 默认回调线程池的线程数, 用于执行ApiRequest的完成回调
+CALLBACK_WORKERS = 2
+
+# 请求优先级, 数值越小越先被处理
+PRIORITY_TRADE = 0  # 订单, 交易, 仓位的创建, 修改与关闭
+PRIORITY_QUERY = 1  # 账户, 订单, 交易, 仓位, 汇率等查询
+PRIORITY_DATA = 2   # 历史汇率与Forex Labs数据
+PRIORITY_NAMES = ('trade', 'query', 'data')
+
+TRADE_ENDPOINT = re.compile(r'^v1/accounts/([^/]+)/(orders|trades|positions)(/|$)')
+ACCOUNT_ENDPOINT = re.compile(r'^v1/accounts/([^/]+)(/[a-z_]+)?(/[^/]+)?$')
+
+# 可缓存的GET请求及其缓存有效期(秒), 以endpoint_pattern的结果为键
+# 账户相关的请求, 如'v1/accounts/{account_id}/positions', 也可以加入; 订单, 交易, 仓位的修改会使该账户的缓存失效
+CACHE_TTL = {
+    'v1/instruments': 3600,
+    'v1/accounts': 3600,
+    'labs/v1/calendar': 600,
+    'labs/v1/commitments_of_traders': 3600,
+    'labs/v1/spreads': 600,
+    'labs/v1/historical_position_ratios': 600,
+}
+
+
+def request_priority(endpoint, method='GET'):
+    """ Classify a request into one of the priority lanes
+        :param endpoint: Endpoint of the request, e.g. 'v1/candles'
+        :param method: HTTP method of the request
+    """
+    if endpoint == 'v1/candles' or endpoint.startswith('labs/'):
+        return PRIORITY_DATA
+    if method != 'GET' and TRADE_ENDPOINT.match(endpoint):
+        return PRIORITY_TRADE
+    return PRIORITY_QUERY
+
+
+def endpoint_pattern(endpoint):
+    """ Replace the identifiers of an endpoint with placeholders, e.g. 'v1/accounts/123/trades/456' becomes
+        'v1/accounts/{account_id}/trades/{id}'
+    """
+    match = ACCOUNT_ENDPOINT.match(endpoint)
+    if not match:
+        return endpoint
+    return 'v1/accounts/{account_id}' + (match.group(2) or '') + ('/{id}' if match.group(3) else '')
+
+
+class ApiRequest(concurrent.futures.Future):
     """
         封装一个API请求，交予请求处理进程处理
         在调用任意一个api函数时，如果用户选择no_wait，会得到ApiRequest的一个实例作为返回值
         用户必须自己调用wait_for_complete确保请求被处理；否则直接得到处理结果作为返回值
         对任意的api，请求成功时，处理结果包含了Oanda Web Server返回的结果，失败时为None，注意检查返回值
+        ApiRequest同时是一个concurrent.futures.Future: result()在失败时抛出异常, 服务器返回的错误为OandaError;
+        完成回调在回调线程池中执行, 不占用工作线程; 可以使用wait_any, as_completed与gather等待多个请求
+        尚未发送的请求可以cancel(); 合并的相同GET请求共享同一个ApiRequest, cancel()对共享它的所有调用者生效
     """
-    def __init__(self, endpoint, method='GET', params=None):
-        self.event = Event()
+    # Executor running the done callbacks of the requests not given one, created on first use
+    default_executor = None
+    default_executor_lock = threading.Lock()
+
+    def __init__(self, endpoint, method='GET', params=None, priority=None, decoder=json.loads):
+        super(ApiRequest, self).__init__()
+        self.executor = None
         self.endpoint = endpoint
         self.method = method
         self.params = params
+        self.priority = request_priority(endpoint, method) if priority is None else priority
+        self.decoder = decoder
         self.response = None
+        self.error = None
+        self.submitted = None
+        self.completed = None
+        # Identical pending GET requests share one ApiRequest, they are recognised by this key
+        self.key = None
+        if method == 'GET':
+            try:
+                self.key = (endpoint, tuple(sorted((params or dict()).items())), decoder)
+                hash(self.key)
+            except TypeError:
+                self.key = None
+
+    def wait_for_complete(self, timeout=None):
+        """ For any function below, if choose no wait, you must invoke this function later to retrieve response
+            Returns None if the request failed, was cancelled or did not complete within timeout
+            :param timeout: [Optional] Maximum seconds to wait. Default: wait forever
+        """
+        try:
+            return self.result(timeout)
+        except Exception:
+            return None
+
+    def add_done_callback(self, fn):
+        """ Invoke fn(request) once the request completes, on the callback executor rather than on a worker thread.
+            Runs at once if the request is already complete
+        """
+        executor = self.executor or ApiRequest.callback_executor()
+
+        def run(future):
+            try:
+                fn(future)
+            except Exception as e:
+                print("Callback exception: " + str(e))
+
+        super(ApiRequest, self).add_done_callback(lambda future: executor.submit(run, future))
+
+    @staticmethod
+    def callback_executor():
+        """ The executor shared by the requests not given one, with CALLBACK_WORKERS threads """
+        with ApiRequest.default_executor_lock:
+            if ApiRequest.default_executor is None:
+                ApiRequest.default_executor = concurrent.futures.ThreadPoolExecutor(CALLBACK_WORKERS)
+            return ApiRequest.default_executor
+
+    def complete(self):
+        """ Resolve the future from response and error, once the request was processed """
+        if self.error is None:
+            self.set_result(self.response)
+        elif isinstance(self.error, BaseException):
+            self.set_exception(self.error)
+        else:
+            self.set_exception(OandaError(self.error))
+
+    def latency(self):
+        """ Seconds from submission to completion, None while the request is pending """
+        if self.completed is None or self.submitted is None:
+            return None
+        return self.completed - self.submitted
+
+
+def wait_any(reqs, timeout=None):
+    """ Block until one of the requests completes, returns it, or None on timeout. When several are complete, the
+        first one in the list is returned
+        :param reqs: ApiRequest objects, as returned with no_wait
+        :param timeout: [Optional] Maximum seconds to wait. Default: wait forever
+    """
+    done, pending = concurrent.futures.wait(reqs, timeout, concurrent.futures.FIRST_COMPLETED)
+    for r in reqs:
+        if r in done:
+            return r
+    return None
+
+
+def as_completed(reqs, timeout=None):
+    """ Iterate over the requests as they complete, raise concurrent.futures.TimeoutError if they are not all
+        complete within timeout
+        :param reqs: ApiRequest objects, as returned with no_wait
+        :param timeout: [Optional] Maximum seconds for the whole iteration. Default: wait forever
+    """
+    return concurrent.futures.as_completed(reqs, timeout)
+
+
+def gather(reqs, timeout=None):
+    """ Wait for all the requests, returns their responses in the same order, None for the failed ones and for
+        those not complete within timeout
+        :param reqs: ApiRequest objects, as returned with no_wait
+        :param timeout: [Optional] Maximum seconds to wait for all of them. Default: wait forever
+    """
+    concurrent.futures.wait(reqs, timeout)
+    return [r.wait_for_complete(0) for r in reqs]
+
+
+class BatchItem:
+    """ Result of one request of a batch: the parameters it was given, the response, the error and the latency """
+    __slots__ = ('params', 'response', 'error', 'latency')
+
+    def __init__(self, params, response, error, latency):
+        self.params = params
+        self.response = response
+        self.error = error
+        self.latency = latency
+
+    def __repr__(self):
+        return 'BatchItem({0}, response={1}, error={2}, latency={3})'.format(self.params, self.response, self.error,
+                                                                              self.latency)
+
+
+class BatchResult:
+    """
+        批量请求的结果, items按提交顺序排列, 每一项为一个BatchItem
+        latency为从提交第一个请求到最后一个请求完成的时间
+    """
+    def __init__(self, items, latency):
+        self.items = items
+        self.latency = latency
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def ok(self):
+        """ True if every request of the batch succeeded """
+        return all(item.error is None for item in self.items)
+
+    @property
+    def errors(self):
+        """ The items that failed """
+        return [item for item in self.items if item.error is not None]
+
+
+class TokenBucket:
+    """
+        令牌桶限流, 平均每秒最多rate个请求, 允许最多burst个请求的突发
+        令牌不足时acquire按调用顺序预约之后的令牌并等待
+    """
+    def __init__(self, rate, burst=None):
+        """ Instantiates a token bucket
+            :param rate: Tokens added per second
+            :param burst: [Optional] Capacity of the bucket. Default: rate
+        """
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
 
-    def wait_for_complete(self):
-        """ For any function below, if choose no wait, you must invoke this function later to retrieve response """
-        self.event.wait()
-        return self.response
+    def acquire(self):
+        """ Take one token, sleeping until it is available """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate) - 1
+            self.stamp = now
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ResponseCache:
+    """
+        GET请求的响应缓存, 按endpoint与参数索引, 每类endpoint有各自的有效期, 超出容量时淘汰最久未使用的项
+        缓存的响应由所有调用者共享, 不要修改
+        每个账户有一个版本号, 每次失效时递增; 发送时版本号已过期的响应不会被缓存
+    """
+    def __init__(self, ttl=None, maxsize=256):
+        """ Instantiates a response cache
+            :param ttl: [Optional] dict of endpoint_pattern to time to live in seconds. Endpoints not listed are never
+                        cached. Default: CACHE_TTL
+            :param maxsize: [Optional] Maximum number of cached responses. Default: 256
+        """
+        self.ttl = dict(CACHE_TTL if ttl is None else ttl)
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        # Number of invalidations of each account
+        self.generations = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Cached response of a request key, or None if missing or expired """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def generation(self, endpoint):
+        """ Generation of the account of an endpoint, to be read when the request is sent and given to put """
+        match = ACCOUNT_ENDPOINT.match(endpoint)
+        if not match:
+            return None
+        with self.lock:
+            return self.generations.get(match.group(1), 0)
+
+    def put(self, key, endpoint, response, generation=None):
+        """ Cache the response of a request, if its endpoint has a time to live
+            :param generation: [Optional] generation(endpoint) when the request was sent. The response is not cached
+                               if the account was invalidated since, it may predate the change
+        """
+        ttl = self.ttl.get(endpoint_pattern(endpoint))
+        if ttl is None:
+            return
+        match = ACCOUNT_ENDPOINT.match(endpoint)
+        with self.lock:
+            if generation is not None and match and self.generations.get(match.group(1), 0) != generation:
+                return
+            self.entries[key] = (time.monotonic() + ttl, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, account_id):
+        """ Drop every cached response of an account """
+        prefix = 'v1/accounts/{0}'.format(account_id)
+        with self.lock:
+            self.generations[str(account_id)] = self.generations.get(str(account_id), 0) + 1
+            for key in [key for key in self.entries if key[0] == prefix or key[0].startswith(prefix + '/')]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RequestScheduler:
+    """
+        按优先级分道的请求队列, 接口与queue.Queue一致
+        工作线程总是先取优先级最高的非空队列中最早的请求, 保证交易请求不会被大量的数据请求阻塞
+        每个队列记录当前深度, 峰值深度与累计请求数
+    """
+    def __init__(self, lanes=PRIORITY_NAMES, condition=None):
+        """ Instantiates a scheduler
+            :param lanes: Names of the lanes, from the highest priority to the lowest
+            :param condition: [Optional] A threading.Condition shared with other schedulers, notified on every put, so
+                              that one set of workers can wait on all of them. Default: a new condition
+        """
+        self.names = lanes
+        self.lanes = [collections.deque() for _ in lanes]
+        self.peaks = [0] * len(lanes)
+        self.totals = [0] * len(lanes)
+        self.count = 0
+        # Requests promised to workers by reserve() but not taken yet
+        self.reserved = 0
+        self.condition = condition or threading.Condition()
+
+    def put(self, req):
+        """ Append a request to the lane matching its priority """
+        with self.condition:
+            lane = self.lanes[req.priority]
+            lane.append(req)
+            self.totals[req.priority] += 1
+            self.peaks[req.priority] = max(self.peaks[req.priority], len(lane))
+            self.count += 1
+            self.condition.notify()
+
+    def put_many(self, reqs):
+        """ Append several requests at once, the workers see either none or all of them """
+        with self.condition:
+            for req in reqs:
+                lane = self.lanes[req.priority]
+                lane.append(req)
+                self.totals[req.priority] += 1
+                self.peaks[req.priority] = max(self.peaks[req.priority], len(lane))
+            self.count += len(reqs)
+            self.condition.notify_all()
+
+    def head_priority(self):
+        """ Priority of the request get() would return, None if there is none """
+        with self.condition:
+            for priority, lane in enumerate(self.lanes):
+                if lane:
+                    return priority
+            return None
+
+    def get(self, block=True, timeout=None):
+        """ Remove and return the oldest request of the highest priority non-empty lane, raise queue.Empty if there
+            is none within timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.count > self.reserved, timeout if block else 0):
+                raise queue.Empty
+            self.count -= 1
+            for lane in self.lanes:
+                if lane:
+                    return lane.popleft()
+
+    def reserve(self, timeout=None):
+        """ Wait until a request is pending that no other worker reserved, and reserve it. The worker then waits for
+            its rate limit token and calls take(), so that the request chosen is the highest priority one at the time
+            it is sent rather than when the worker started waiting. False if there is none within timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.count > self.reserved, timeout):
+                return False
+            self.reserved += 1
+            return True
+
+    def take(self):
+        """ Remove and return the highest priority request, after a successful reserve() """
+        with self.condition:
+            self.reserved -= 1
+            self.count -= 1
+            for lane in self.lanes:
+                if lane:
+                    return lane.popleft()
+
+    def qsize(self):
+        return self.count
+
+    def empty(self):
+        return not self.count
+
+    def depths(self):
+        """ Current number of pending requests of each lane """
+        with self.condition:
+            return {name: len(lane) for name, lane in zip(self.names, self.lanes)}
+
+    def stats(self):
+        """ Current depth, peak depth and total number of requests of each lane """
+        with self.condition:
+            return {name: {'depth': len(lane), 'peak': peak, 'total': total}
+                    for name, lane, peak, total in zip(self.names, self.lanes, self.peaks, self.totals)}
 
 
 class Api:
@@ -38,42 +448,161 @@ class Api:
         5. 获取指定货币对的位置
         6. 获取交易历史记录
         7. Oanda Forex Lab 提供的功能
-        所有对API的调用运行在一个独立进程中
+        所有对API的调用由一组工作线程处理, 线程数量与HTTP连接池大小由pool_size指定
+        请求按优先级排队: 交易请求优先于查询, 查询优先于历史汇率与Forex Lab数据
+        发送频率受令牌桶限制, 相同的未完成GET请求共享同一个ApiRequest与同一次HTTP请求
+        可选的ResponseCache缓存变化缓慢的参考数据
+        init()可预先建立连接, 保活线程在空闲时发送低开销请求, 使连接保持可用
     """
-    def __init__(self, environment="practice", access_token=None, headers=None):
+    def __init__(self, environment="practice", access_token=None, headers=None, pool_size=4, rate_limit=RATE_LIMIT,
+                 coalesce=True, cache=None, metrics=None, warm_connections=0, keepalive_interval=None, session=None,
+                 scheduler=None):
         """ Instantiates a API wrapper
             :param environment: 模拟或真实环境
             :param access_token: oanda REST API access token
             :param headers:
+            :param pool_size: Number of worker threads, also the size of the HTTP connection pool. With 0 no worker is
+                              started, the requests are processed by whoever drains the scheduler through execute(),
+                              e.g. an AccountManager. Default: 4
+            :param rate_limit: Maximum requests per second sent to the server, None for no limit. Default: RATE_LIMIT
+            :param coalesce: Let identical pending GET requests share one HTTP round trip. Default: True
+            :param cache: [Optional] A ResponseCache serving repeated GET requests without a round trip. Default: None
+            :param metrics: [Optional] A metrics.Metrics receiving the latency of each request, and the queue depths
+                            as the 'queue_depth' gauge. Default: None
+            :param warm_connections: [Optional] Number of connections opened by init() with concurrent cheap requests,
+                                     at most pool_size. Default: 0
+            :param keepalive_interval: [Optional] Seconds without any request after which the keep-alive thread sends
+                                       cheap requests on the warm connections, replacing the dead ones before a real
+                                       request needs them. None for no keep-alive thread. Default: None
+            :param session: [Optional] A requests.Session shared with other Api instances, the access token and headers
+                            are then sent with each request. Default: a new session with pool_size connections
+            :param scheduler: [Optional] The RequestScheduler queuing the requests. Default: a new one
         """
-        if environment == 'sandbox':
-            self.api_url = 'http://api-sandbox.oanda.com'
-        elif environment == 'practice':
-            self.api_url = 'https://api-fxpractice.oanda.com'
-        elif environment == 'live':
-            self.api_url = 'https://api-fxtrade.oanda.com'
-        else:
+        if environment not in API_URLS:
             raise BadEnvironment(environment)
+        self.api_url = API_URLS[environment]
         self.access_token = access_token
-        self.client = requests.Session()
-        self.thread = threading.Thread(target=self.__thread_request)
-        self.working = False
-        self.request_queue = queue.Queue()
+        self.pool_size = pool_size
+        self.headers = dict()
         if self.access_token:
-            self.client.headers['Authorization'] = 'Bearer ' + self.access_token
+            self.headers['Authorization'] = 'Bearer ' + self.access_token
         if headers:
-            self.client.headers.update(headers)
+            self.headers.update(headers)
+        if session is None:
+            self.client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+            self.client.mount('http://', adapter)
+            self.client.mount('https://', adapter)
+            self.client.headers.update(self.headers)
+            # Already part of the session, not repeated in each request
+            self.request_headers = None
+        else:
+            self.client = session
+            self.request_headers = self.headers
+        self.threads = []
+        self.working = False
+        self.request_queue = scheduler or RequestScheduler()
+        self.limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.coalesce = coalesce
+        self.cache = cache
+        self.metrics = metrics
+        self.inflight = dict()
+        self.inflight_lock = threading.Lock()
+        self.warm_connections = min(warm_connections, max(pool_size, 1))
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_stop = Event()
+        self.keepalive_thread = None
+        self.last_activity = None
+        self.first_sent = False
+        if metrics is not None:
+            metrics.add_gauge('queue_depth', self.request_queue.depths)
 
 
     def init(self):
-        """ Initialize account module """
+        """ Initialize account module: open the warm connections, start the worker threads and the keep-alive thread """
         self.working = True
-        self.thread.start()
+        if self.warm_connections:
+            self.__warm(self.warm_connections, 'warmup')
+        self.threads = [threading.Thread(target=self.__thread_request) for _ in range(self.pool_size)]
+        for thread in self.threads:
+            thread.start()
+        if self.keepalive_interval:
+            self.keepalive_stop.clear()
+            self.keepalive_thread = threading.Thread(target=self.__thread_keepalive)
+            self.keepalive_thread.start()
 
     def deinit(self):
-        """ De-initialize account module """
+        """ De-initialize account module. New requests are refused, the queued ones are still processed before
+            the worker threads exit
+        """
         self.working = False
-        self.thread.join()
+        self.keepalive_stop.set()
+        if self.keepalive_thread:
+            self.keepalive_thread.join()
+            self.keepalive_thread = None
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def queue_stats(self):
+        """ Depth, peak depth and total number of requests of each priority lane of the request queue """
+        return self.request_queue.stats()
+
+    def __submit(self, r, no_wait):
+        """ Queue a request for the worker threads
+            :param r: The ApiRequest to process
+            :param no_wait: Indicate whether function will wait for request complete or return immediately
+        """
+        if not self.working:
+            return None
+        r.submitted = time.monotonic()
+        if self.cache is not None and r.key is not None:
+            cached = self.cache.get(r.key)
+            if cached is not None and r.set_running_or_notify_cancel():
+                r.response = cached
+                r.completed = r.submitted
+                r.complete()
+                return r if no_wait else cached
+        if self.coalesce and r.key is not None:
+            with self.inflight_lock:
+                pending = self.inflight.get(r.key)
+                # A cancelled request is forgotten right after, it is never shared
+                if pending is None or pending.cancelled():
+                    self.inflight[r.key] = r
+                    pending = None
+            if pending is not None:
+                return pending if no_wait else pending.wait_for_complete()
+            # Forget the request as soon as it is cancelled, rather than when a worker dequeues it. Runs on the
+            # cancelling thread, not on the callback executor
+            concurrent.futures.Future.add_done_callback(r, self.__forget)
+        self.request_queue.put(r)
+        return r if no_wait else r.wait_for_complete()
+
+    def __forget(self, req):
+        """ Stop sharing a coalesced request with new identical ones, once it is complete or cancelled """
+        with self.inflight_lock:
+            if self.inflight.get(req.key) is req:
+                del self.inflight[req.key]
+
+    def __batch(self, specs, reqs):
+        """ Queue a batch of requests at once, wait for all of them and collect their results
+            :param specs: The parameters describing each request, reported back in the BatchItem
+            :param reqs: The ApiRequest of each item
+        """
+        start = time.monotonic()
+        if self.working:
+            for r in reqs:
+                r.submitted = start
+            self.request_queue.put_many(reqs)
+        items = []
+        for spec, r in zip(specs, reqs):
+            if r.submitted is None:
+                items.append(BatchItem(spec, None, 'Api is not initialized', None))
+                continue
+            response = r.wait_for_complete()
+            items.append(BatchItem(spec, response, r.error if response is None else None, r.latency()))
+        completed = [r.completed for r in reqs if r.completed is not None]
+        return BatchResult(items, max(completed) - start if completed else 0.0)
 
 
     def get_instruments(self, account_id, no_wait, **params):
@@ -83,34 +612,85 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/rates
         """
-        if not self.working:
-            return None
         params['accountId'] = account_id
         r = ApiRequest('v1/instruments', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
-    def get_prices(self, no_wait, **params):
+    def get_prices(self, no_wait, columnar=False, **params):
         """ Fetch live prices for specified instruments that are available on the OANDA platform
             :param no_wait: Indicate whether function will wait for request complete or return immediately
+            :param columnar: [Optional] Return prices as typed arrays, see columnar.decode_prices. Default: False
             :param params: Docs: http://developer.oanda.com/rest-live/rates
         """
-        if not self.working:
-            return None
-        r = ApiRequest('v1/prices', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        if columnar:
+            params['dateFormat'] = 'unix'
+            r = ApiRequest('v1/prices', params=params, decoder=columnar_module.decode_prices)
+        else:
+            r = ApiRequest('v1/prices', params=params)
+        return self.__submit(r, no_wait)
 
-    def get_history(self, no_wait, **params):
+    def get_history(self, no_wait, columnar=False, **params):
         """ Get historical information on an instrument
             :param no_wait: Indicate whether function will wait for request complete or return immediately
+            :param columnar: [Optional] Return candles as typed arrays, see columnar.decode_candles. Default: False
             :param params: Docs: http://developer.oanda.com/rest-live/rates
         """
+        if columnar:
+            params['dateFormat'] = 'unix'
+            candle_format = params.get('candleFormat', 'bidask')
+            decoder = CANDLE_DECODERS.get(candle_format) or functools.partial(columnar_module.decode_candles,
+                                                                              candle_format=candle_format)
+            r = ApiRequest('v1/candles', params=params, decoder=decoder)
+        else:
+            r = ApiRequest('v1/candles', params=params)
+        return self.__submit(r, no_wait)
+
+    def backfill_history(self, instrument, granularity, start, end, max_concurrency=4, **params):
+        """ Get historical information on an instrument for an arbitrary long time range. The range is split into
+            chunks of at most MAX_CANDLES candles, which are fetched concurrently. Returns the response of a single
+            get_history call covering the whole range, with candles in time order and without duplicates
+            :param instrument: Required Name of the instrument
+            :param granularity: Required The time range represented by each candlestick, e.g. 'M1'
+            :param start: Required Start of the range, a datetime, an epoch timestamp or an RFC3339 string
+            :param end: Required End of the range, same types as start
+            :param max_concurrency: Maximum number of chunk requests in flight at the same time. Default: 4
+            :param params: Other parameters of get_history except count, start, end and columnar
+        """
+        if params.get('columnar'):
+            raise ValueError('backfill_history does not support columnar')
         if not self.working:
             return None
-        r = ApiRequest('v1/candles', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        params.pop('columnar', None)
+        params.pop('count', None)
+        date_format = params.get('dateFormat')
+        step = GRANULARITY_SECONDS[granularity] * MAX_CANDLES
+        begin, finish = to_epoch(start), to_epoch(end)
+
+        pending = collections.deque()
+        responses = []
+        while begin < finish:
+            if len(pending) >= max_concurrency:
+                responses.append(pending.popleft().wait_for_complete())
+            stop = min(begin + step, finish)
+            r = self.get_history(True, instrument=instrument, granularity=granularity,
+                                 start=format_time(begin, date_format), end=format_time(stop, date_format), **params)
+            if r is None:
+                return None
+            pending.append(r)
+            begin = stop
+        while pending:
+            responses.append(pending.popleft().wait_for_complete())
+
+        if None in responses:
+            return None
+        candles = []
+        seen = set()
+        for response in responses:
+            for candle in response.get('candles', []):
+                if candle['time'] not in seen:
+                    seen.add(candle['time'])
+                    candles.append(candle)
+        return {'instrument': instrument, 'granularity': granularity, 'candles': candles}
 
 
     def create_account(self, no_wait, **params):
@@ -118,22 +698,16 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/accounts
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts', method='POST', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def get_accounts(self, no_wait, **params):
         """ Get a list of accounts owned by the user.
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/accounts
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def get_account(self, account_id, no_wait, **params):
         """ Get account information.
@@ -141,11 +715,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/accounts
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}'.format(account_id), params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
 
     def get_orders(self, account_id, no_wait, **params):
@@ -155,11 +726,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/orders
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/orders'.format(account_id), params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def create_order(self, account_id, no_wait, **params):
         """ Create a new order.
@@ -167,11 +735,18 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/orders
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/orders'.format(account_id), method='POST', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
+
+    def create_orders(self, account_id, orders):
+        """ Create several orders at once. All the orders are queued together and sent concurrently by the worker
+            threads, returns a BatchResult once every order is processed
+            :param account_id: Required The account id to create the orders
+            :param orders: Required A list of dict, the parameters of each order as for create_order
+        """
+        reqs = [ApiRequest('v1/accounts/{0}/orders'.format(account_id), method='POST', params=dict(order))
+                for order in orders]
+        return self.__batch(orders, reqs)
 
     def get_order(self, account_id, order_id, no_wait, **params):
         """ Get information for an order.
@@ -180,11 +755,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/orders
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/orders/{1}'.format(account_id, order_id), params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def modify_order(self, account_id, order_id, no_wait, **params):
         """ Modify an existing order.
@@ -193,11 +765,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/orders
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/orders/{1}'.format(account_id, order_id), method='PATCH', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def close_order(self, account_id, order_id, no_wait, **params):
         """ Close an existing order.
@@ -206,11 +775,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/orders
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/orders/{1}'.format(account_id, order_id), method='DELETE', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
 
     def get_trades(self, account_id, no_wait, **params):
@@ -219,11 +785,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/trades
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/trades'.format(account_id), params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def get_trade(self, account_id, trade_id, no_wait, **params):
         """ Get information on a specific trade.
@@ -232,11 +795,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/trades
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/trades/{1}'.format(account_id, trade_id), params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def modify_trade(self, account_id, trade_id, no_wait, **params):
         """ Modify an existing trade.
@@ -245,11 +805,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/trades
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/trades/{1}'.format(account_id, trade_id), method='PATCH', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def close_trade(self, account_id, trade_id, no_wait, **params):
         """ Close an open trade.
@@ -258,11 +815,18 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/trades
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/trades/{1}'.format(account_id, trade_id), method='DELETE', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
+
+
+    def close_trades(self, account_id, trade_ids):
+        """ Close several open trades at once, returns a BatchResult once every trade is processed
+            :param account_id: Required The account id to close trades
+            :param trade_ids: Required A list of trade identifications
+        """
+        reqs = [ApiRequest('v1/accounts/{0}/trades/{1}'.format(account_id, trade_id), method='DELETE', params=dict())
+                for trade_id in trade_ids]
+        return self.__batch(trade_ids, reqs)
 
 
     def get_positions(self, account_id, no_wait, **params):
@@ -271,11 +835,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/positions
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/positions'.format(account_id), params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def get_position(self, account_id, instrument, no_wait, **params):
         """ Get the position for an instrument.
@@ -284,11 +845,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/positions
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/positions/{1}'.format(account_id, instrument), params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def close_position(self, account_id, instrument, no_wait, **params):
         """ Close an existing position.
@@ -297,11 +855,19 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/positions
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/positions/{1}'.format(account_id, instrument), method='DELETE', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
+
+
+    def close_positions(self, account_id, instruments):
+        """ Close several positions at once, returns a BatchResult once every position is processed
+            :param account_id: Required The account id to close positions
+            :param instruments: Required A list of instruments
+        """
+        reqs = [ApiRequest('v1/accounts/{0}/positions/{1}'.format(account_id, instrument), method='DELETE',
+                           params=dict())
+                for instrument in instruments]
+        return self.__batch(instruments, reqs)
 
 
     def get_transaction_history(self, account_id, no_wait, **params):
@@ -310,11 +876,8 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/transaction-history
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/transactions'.format(account_id), params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def get_transaction(self, account_id, transaction_id, no_wait):
         """ Get information for a transaction
@@ -322,11 +885,8 @@ class Api:
             :param transaction_id: Required The transaction identification
             :param no_wait: Indicate whether function will wait for request complete or return immediately
         """
-        if not self.working:
-            return None
         r = ApiRequest('v1/accounts/{0}/transactions/{1}'.format(account_id, transaction_id))
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
 
     def get_eco_calendar(self, no_wait, **params):
@@ -334,80 +894,178 @@ class Api:
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/forex-labs/
         """
-        if not self.working:
-            return None
         r = ApiRequest('labs/v1/calendar', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def get_historical_position_ratios(self, no_wait, **params):
         """ Returns up to 1 year of historical position ratios
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/forex-labs/
         """
-        if not self.working:
-            return None
         r = ApiRequest('labs/v1/historical_position_ratios', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def get_historical_spreads(self, no_wait, **params):
         """ Returns up to 1 year of spread information
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/forex-labs/
         """
-        if not self.working:
-            return None
         r = ApiRequest('labs/v1/spreads', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def get_commitments_of_traders(self, no_wait, **params):
         """ Returns up to 4 years of Commitments of Traders data from the CFTC
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/forex-labs/
         """
-        if not self.working:
-            return None
         r = ApiRequest('labs/v1/commitments_of_traders', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
     def get_orderbook(self, no_wait, **params):
         """ Returns up to 1 year of OANDA Order Book data
             :param no_wait: Indicate whether function will wait for request complete or return immediately
             :param params: Docs: http://developer.oanda.com/rest-live/forex-labs/
         """
-        if not self.working:
-            return None
         r = ApiRequest('labs/v1/orderbook_data', params=params)
-        self.request_queue.put(r)
-        return r if no_wait else r.wait_for_complete()
+        return self.__submit(r, no_wait)
 
 
+    def __update_cache(self, req, generation):
+        """ Cache a successful GET response, or invalidate the account of a successful order/trade/position change
+            :param generation: The generation of the account of a GET request when it was sent
+        """
+        if req.key is not None:
+            self.cache.put(req.key, req.endpoint, req.response, generation)
+        elif req.method != 'GET':
+            match = TRADE_ENDPOINT.match(req.endpoint)
+            if match:
+                self.cache.invalidate(match.group(1))
+
     def __thread_request(self):
-        while self.working:
-            try:
-                req = self.request_queue.get(block=True, timeout=1)
-                method = req.method.lower()
-                requests_args = dict()
-                requests_args['params' if method == 'get' else 'data'] = req.params or dict()
-                response = getattr(self.client, method)('{0}/{1}'.format(self.api_url, req.endpoint), **requests_args)
-                content = json.loads(response.content.decode('utf-8'))
-
-                if response.status_code >= 400:
-                    #raise OandaError(content)
-                    print("OandaError: {0:d} - {1}".format(response.status_code, str(content)))
-                else:
-                    req.response = content
+        """ Worker thread, keeps processing requests until the module is de-initialized and the queue is drained """
+        while True:
+            if not self.request_queue.reserve(timeout=1):
+                if self.working:
+                    continue
+                break
+            # Take the request once the token is there, a trade queued meanwhile goes first
+            if self.limiter:
+                self.limiter.acquire()
+            self.execute(self.request_queue.take())
+
+    def execute(self, req):
+        """ Send a request taken from the scheduler and complete it. Called by the worker threads, or by whoever
+            drains the scheduler when pool_size is 0. Rate limiting is left to the caller
+            :param req: The ApiRequest to process
+        """
+        if not req.set_running_or_notify_cancel():
+            # Cancelled while queued, never sent. Already forgotten by the done callback of __submit
+            return
+        sent = time.monotonic()
+        received = None
+        status = None
+        last_activity = self.last_activity
+        first = not self.first_sent
+        self.first_sent = True
+        # Read before sending, a change of the account made meanwhile then keeps the response out of the cache
+        generation = self.cache.generation(req.endpoint) if self.cache is not None and req.key is not None else None
+        try:
+            method = req.method.lower()
+            requests_args = dict()
+            requests_args['params' if method == 'get' else 'data'] = req.params or dict()
+            if self.request_headers:
+                requests_args['headers'] = self.request_headers
+            response = getattr(self.client, method)('{0}/{1}'.format(self.api_url, req.endpoint), **requests_args)
+            received = time.monotonic()
+            status = response.status_code
+
+            if response.status_code >= 400:
+                try:
+                    content = json.loads(response.content.decode('utf-8'))
+                except ValueError:
+                    content = {'code': response.status_code, 'message': response.reason}
+                print("OandaError: {0:d} - {1}".format(response.status_code, str(content)))
+                req.error = content
+            else:
+                req.response = req.decoder(response.content.decode('utf-8'))
+                if self.cache is not None:
+                    self.__update_cache(req, generation)
+
+        except requests.RequestException as e:
+            print("RequestException: " + str(e))
+            req.error = e
+        except json.JSONDecodeError as e:
+            print("JSONDecodeError: " + str(e))
+            req.error = e
+        except Exception as e:
+            # A failing decoder or cache must neither kill the worker nor leave the request pending
+            print("Exception: " + str(e))
+            req.error = e
 
+        try:
+            req.completed = time.monotonic()
+            self.last_activity = req.completed
+            if self.metrics is not None:
+                received = received or req.completed
+                self.metrics.on_request(endpoint_pattern(req.endpoint), req.method, status, sent - req.submitted,
+                                        received - sent, req.completed - received)
+                if first:
+                    self.metrics.on_connection('first', received - sent)
+                elif last_activity is not None and sent - last_activity >= IDLE_SECONDS:
+                    self.metrics.on_connection('idle', received - sent)
+        except Exception as e:
+            print("Metrics exception: " + str(e))
+        finally:
+            if self.coalesce and req.key is not None:
+                self.__forget(req)
+            req.complete()
+
+    def __warm(self, count, kind):
+        """ Send count cheap requests at once, each on its own pooled connection, so that missing connections are
+            opened and dead ones replaced
+            :param count: Number of connections to use
+            :param kind: Reported to metrics.on_connection with the latency of each request, 'warmup' or 'keepalive'
+        """
+        barrier = threading.Barrier(count)
+        url = '{0}/{1}'.format(self.api_url, WARMUP_ENDPOINT)
+
+        def warm():
+            if self.limiter:
+                self.limiter.acquire()
+            sent = time.monotonic()
+            try:
+                response = self.client.get(url, params=WARMUP_PARAMS, headers=self.request_headers, stream=True,
+                                           timeout=10)
             except requests.RequestException as e:
-                # raise OandaError(e)
                 print("RequestException: " + str(e))
-            except json.JSONDecodeError as e:
-                # raise OandaError(e)
-                print("JSONDecodeError: " + str(e))
-            except queue.Empty:
-                continue
+                barrier.abort()
+                return
+            received = time.monotonic()
+            try:
+                # Keep the connection checked out until every request has one, so that none is shared
+                barrier.wait(10)
+            except threading.BrokenBarrierError:
+                pass
+            # Reading the body returns the connection to the pool
+            response.content
+            self.last_activity = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.on_connection(kind, received - sent)
+
+        threads = [threading.Thread(target=warm) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-            req.event.set()
+    def __thread_keepalive(self):
+        """ Keep-alive thread, refreshes the warm connections whenever no request was sent for keepalive_interval """
+        interval = self.keepalive_interval
+        timeout = interval
+        while not self.keepalive_stop.wait(timeout):
+            last_activity = self.last_activity
+            idle = interval if last_activity is None else time.monotonic() - last_activity
+            if idle >= interval:
+                self.__warm(self.warm_connections or 1, 'keepalive')
+                idle = 0
+            timeout = interval - idle
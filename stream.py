@@ -1,17 +1,82 @@
 #! /usr/bin/env python
 
+import re
 import json
+import time
+import socket
+import random
 import requests
 import threading
 from exceptions import BadEnvironment
 
 
+HEARTBEAT_PREFIX = b'{"heartbeat"'
+TICK_LINE = re.compile(rb'^\{"tick":\{"instrument":"([A-Z0-9_]+)","time":"([^"]+)",'
+                       rb'"bid":([0-9.eE+-]+),"ask":([0-9.eE+-]+)\}\}$')
+INSTRUMENT_NAMES = dict()
+
+
+class Tick:
+    """ Compact price tick produced by the fast decoder, in place of the {'tick': {...}} dict of a price line """
+    __slots__ = ('instrument', 'time', 'bid', 'ask')
+
+    def __init__(self, instrument, time, bid, ask):
+        self.instrument = instrument
+        self.time = time
+        self.bid = bid
+        self.ask = ask
+
+    def __repr__(self):
+        return 'Tick({0}, {1}, {2}, {3})'.format(self.instrument, self.time, self.bid, self.ask)
+
+
+def decode_line(line):
+    """ Decode one line of a stream into a dict """
+    return json.loads(line.decode('utf-8'))
+
+
+def decode_tick(line):
+    """ Decode one line of the rates stream, price lines become Tick objects. Lines in the usual layout are parsed
+        with a regular expression instead of a full JSON parse, anything else falls back to json
+    """
+    match = TICK_LINE.match(line)
+    if match:
+        raw = match.group(1)
+        instrument = INSTRUMENT_NAMES.get(raw)
+        if instrument is None:
+            instrument = INSTRUMENT_NAMES[raw] = raw.decode('ascii')
+        return Tick(instrument, match.group(2).decode('ascii'), float(match.group(3)), float(match.group(4)))
+    data = decode_line(line)
+    tick = data.get('tick')
+    if tick is not None and 'bid' in tick:
+        return Tick(tick['instrument'], tick['time'], tick['bid'], tick['ask'])
+    return data
+
+
 class Stream:
     """ Provides functionality for HTTPS streaming
         User should provide two callback function to receive streaming data or error information
+        The connection is reopened with jittered exponential backoff when it fails or stalls, or when a callback
+        raises. Invalid lines are reported through on_error and skipped
     """
-    def __init__(self, environment, access_token, rates_stream):
-        """ Instantiates an instance of Oanda streaming API wrapper """
+    def __init__(self, environment, access_token, rates_stream, fast_decode=False, heartbeat_timeout=20,
+                 backoff_max=60, api=None, metrics=None, recorder=None):
+        """ Instantiates an instance of Oanda streaming API wrapper
+            :param environment: 模拟或真实环境
+            :param access_token: oanda REST API access token
+            :param rates_stream: True for the rates stream, False for the events stream
+            :param fast_decode: [Optional] Deliver price ticks as Tick objects decoded by a fast path instead of dicts.
+                                Only applies to the rates stream. Default: False
+            :param heartbeat_timeout: [Optional] Seconds without any line, heartbeats included, after which the
+                                      connection is considered stalled and reopened. Default: 20
+            :param backoff_max: [Optional] Upper bound in seconds of the delay between reconnection attempts, which
+                                grows exponentially with random jitter. Default: 60
+            :param api: [Optional] An initialized rest.Api. For the events stream, transactions missed while
+                        disconnected are then fetched through get_transaction_history after each reconnection
+            :param metrics: [Optional] A metrics.Metrics receiving the arrival of each price tick. Default: None
+            :param recorder: [Optional] A tick_log.TickRecorder receiving every line as received, heartbeats included,
+                             for later replay through tick_log.TickReplay. Default: None
+        """
         if environment == 'practice':
             self.api_url = 'https://stream-fxpractice.oanda.com'
         elif environment == 'live':
@@ -23,60 +88,171 @@ class Stream:
         self.client = requests.Session()
         self.client.stream = True
         self.rates_stream = rates_stream
+        self.decode = decode_tick if fast_decode and rates_stream else decode_line
+        self.heartbeat_timeout = heartbeat_timeout
+        self.backoff_max = backoff_max
+        self.api = api
+        self.metrics = metrics
+        self.recorder = recorder
+        self.last_tick_times = dict()
+        self.last_transaction_ids = dict()
         self.connected = False
+        self.stop_event = threading.Event()
+        self.response = None
         self.thread = None
 
         if self.access_token:
             self.client.headers['Authorization'] = 'Bearer ' + self.access_token
 
-    def start(self, on_stream=None, on_error=None, **params):
+    def start(self, on_stream=None, on_error=None, on_connect=None, **params):
         """ Open a streaming connection to receive real time market prices for specified instruments, or events depend
             on rates_stream True or False
             :param on_stream: [Optional] Callback function, invoked when new rate coming
             :param on_error: [Optional] Callback function, invoked when error occur
+            :param on_connect: [Optional] Callback function, invoked each time the connection is (re)established,
+                               before the first line is read
             :param params: Docs: http://developer.oanda.com/rest-live/streaming
         """
         self.connected = True
+        self.stop_event.clear()
         self.thread = threading.Thread(target=self.__thread,
-                                       args=('v1/prices' if self.rates_stream else 'v1/events', on_stream, on_error),
+                                       args=('v1/prices' if self.rates_stream else 'v1/events', on_stream, on_error,
+                                             on_connect),
                                        kwargs=params)
         self.thread.start()
 
     def stop(self):
-        """ Close streaming """
+        """ Close streaming. The connection is shut down, so this returns without waiting for the next line """
         if self.thread and self.connected:
             self.connected = False
+            self.stop_event.set()
+            self.__interrupt()
             self.thread.join()
 
-    def __thread(self, endpoint, on_stream, on_error, **params):
+    def __thread(self, endpoint, on_stream, on_error, on_connect, **params):
         """ Starts the stream with the given parameters
             :param endpoint: [Required] 'v1/prices' or 'v1/events'
             :param on_stream: [Optional] invoked when new stream data coming
             :param on_error: [Optional] invoked when error occur
+            :param on_connect: [Optional] invoked when the connection is established
             :param ignore_heartbeat: [Optional] Whether or not to display the heartbeat. Default: True
         """
         on_stream_func = on_stream if on_stream else self.__on_stream
         on_error_func = on_error if on_error else self.__on_error
         params = params or dict()
-        ignore_heartbeat = None
-        if 'ignore_heartbeat' in params:
-            ignore_heartbeat = params['ignore_heartbeat']
+        ignore_heartbeat = params.pop('ignore_heartbeat', None)
+        decode = self.decode
         requests_args = dict()
         requests_args['params'] = params
+        requests_args['timeout'] = (10, self.heartbeat_timeout)
         url = '{0}/{1}'.format(self.api_url, endpoint)
+        events = not self.rates_stream
+        measure = self.metrics is not None and self.rates_stream
+        recorder = self.recorder
+        attempts = 0
+        reconnecting = False
 
         while self.connected:
-            response = self.client.get(url, **requests_args)
-            if response.status_code != 200:
-                on_error_func(str(response.content))
-            else:
-                for line in response.iter_lines(90):
+            if attempts:
+                # Full jitter exponential backoff, the first reconnection after a healthy connection is immediate
+                if self.stop_event.wait(random.uniform(0, min(self.backoff_max, 2 ** (attempts - 1)))):
+                    break
+            attempts += 1
+            try:
+                self.response = self.client.get(url, **requests_args)
+                if self.response.status_code != 200:
+                    on_error_func(str(self.response.content))
+                    continue
+                if on_connect:
+                    on_connect()
+                if events and reconnecting and self.api:
+                    self.__backfill(on_stream_func, on_error_func)
+                reconnecting = True
+                for line in self.response.iter_lines(90):
                     if not self.connected:
                         break
-                    if line:
-                        data = json.loads(line.decode('utf-8'))
-                        if not (ignore_heartbeat and 'heartbeat' in data):
-                            on_stream_func(data)
+                    attempts = 0
+                    if line and recorder is not None:
+                        recorder.record(line)
+                    if line and not (ignore_heartbeat and line.startswith(HEARTBEAT_PREFIX)):
+                        try:
+                            data = decode(line)
+                        except ValueError as e:
+                            # A truncated or invalid line, the next ones are still delimited correctly
+                            on_error_func('Invalid line {0!r}: {1}'.format(line, e))
+                            continue
+                        if events and 'transaction' in data and not self.__track(data['transaction']):
+                            continue
+                        if measure:
+                            self.__measure(data)
+                        on_stream_func(data)
+            except requests.RequestException as e:
+                if self.connected:
+                    on_error_func(str(e))
+            except Exception as e:
+                # A failing callback must not end the stream thread: report it and reconnect
+                if self.connected:
+                    on_error_func('{0}: {1}'.format(type(e).__name__, e))
+            finally:
+                if self.response is not None:
+                    self.response.close()
+
+    def __measure(self, data):
+        """ Report the arrival of a price tick and the gap since the previous one of its instrument """
+        if isinstance(data, Tick):
+            instrument = data.instrument
+        elif 'tick' in data:
+            instrument = data['tick']['instrument']
+        else:
+            return
+        now = time.monotonic()
+        last = self.last_tick_times.get(instrument)
+        self.last_tick_times[instrument] = now
+        self.metrics.on_tick(instrument, None if last is None else now - last)
+
+    def __track(self, transaction):
+        """ Remember the last transaction id of each account. Returns False for a transaction already delivered """
+        account_id = transaction.get('accountId')
+        last_id = self.last_transaction_ids.get(account_id)
+        if last_id is not None and transaction['id'] <= last_id:
+            return False
+        self.last_transaction_ids[account_id] = transaction['id']
+        return True
+
+    def __backfill(self, on_stream, on_error):
+        """ Deliver the transactions of each known account made after the last one seen, oldest first. An account
+            whose history can not be fetched is reported through on_error
+        """
+        for account_id, last_id in list(self.last_transaction_ids.items()):
+            transactions = []
+            params = {'minId': last_id + 1, 'count': 500}
+            while True:
+                response = self.api.get_transaction_history(account_id, False, **params)
+                if response is None:
+                    on_error('Could not fetch the transactions of account {0} missed since {1}'.format(account_id,
+                                                                                                      last_id))
+                    # Pages come newest first, delivering part of them would skip the older ones for good
+                    transactions = []
+                    break
+                page = response.get('transactions', [])
+                transactions.extend(page)
+                if len(page) < params['count']:
+                    break
+                params['maxId'] = min(t['id'] for t in page) - 1
+            for transaction in sorted(transactions, key=lambda t: t['id']):
+                transaction.setdefault('accountId', account_id)
+                if self.__track(transaction):
+                    on_stream({'transaction': transaction})
+
+    def __interrupt(self):
+        """ Shut the socket of the current response down, so that a pending read returns at once """
+        connection = getattr(self.response.raw, '_connection', None) if self.response is not None else None
+        sock = getattr(connection, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def __on_stream(self, data):
         """ Default streaming data handler. Used when user doesn't provide one instead """
@@ -0,0 +1,246 @@
+#! /usr/bin/env python
+
+""" 多个订阅者共享一条汇率流连接 """
+
+import queue
+import threading
+import collections
+from stream import Stream, Tick
+
+
+# What a subscription does with a new tick when its queue is full
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # discard the oldest queued tick
+OVERFLOW_CONFLATE = 'conflate'        # keep only the latest tick of each instrument
+OVERFLOW_BLOCK = 'block'              # block the stream reader until the subscriber catches up
+
+
+class Subscription:
+    """ Bounded queue of the ticks of a set of instruments, fed by a StreamHub
+        The subscriber either pulls ticks with get(), or gives a callback run on a dedicated thread. lag() reports
+        how far behind the subscriber is
+    """
+    def __init__(self, instruments, maxsize=1000, overflow=OVERFLOW_DROP_OLDEST):
+        """ Instantiates a subscription
+            :param instruments: Instruments the subscriber is interested in
+            :param maxsize: Maximum number of queued ticks. Default: 1000
+            :param overflow: OVERFLOW_DROP_OLDEST, OVERFLOW_CONFLATE or OVERFLOW_BLOCK. Default: OVERFLOW_DROP_OLDEST
+        """
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_CONFLATE, OVERFLOW_BLOCK):
+            raise ValueError("Unknown overflow policy '{0}'".format(overflow))
+        self.instruments = frozenset(instruments)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.queue = collections.deque()
+        self.latest = dict()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = None
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.peak = 0
+
+    def put(self, tick, interrupted=None):
+        """ Queue a tick, applying the overflow policy when the queue is full. Called by the stream reader
+            :param interrupted: [Optional] A threading.Event, set when the reader is being stopped: a put blocked on a
+                                full OVERFLOW_BLOCK queue then gives up the tick, see wake()
+        """
+        with self.condition:
+            self.received += 1
+            if self.overflow == OVERFLOW_CONFLATE:
+                instrument = self.__instrument(tick)
+                if instrument in self.latest:
+                    self.latest[instrument] = tick
+                    self.conflated += 1
+                    return
+                if len(self.queue) >= self.maxsize:
+                    self.latest.pop(self.queue.popleft())
+                    self.dropped += 1
+                self.latest[instrument] = tick
+                self.queue.append(instrument)
+            else:
+                if len(self.queue) >= self.maxsize:
+                    if self.overflow == OVERFLOW_DROP_OLDEST:
+                        self.queue.popleft()
+                        self.dropped += 1
+                    else:
+                        self.condition.wait_for(lambda: len(self.queue) < self.maxsize or self.closed or
+                                                (interrupted is not None and interrupted.is_set()))
+                        if self.closed or len(self.queue) >= self.maxsize:
+                            return
+                self.queue.append(tick)
+            self.peak = max(self.peak, len(self.queue))
+            self.condition.notify_all()
+
+    def get(self, block=True, timeout=None):
+        """ Remove and return the oldest queued tick. Raise queue.Empty if there is none within timeout, returns None
+            once the subscription is closed and drained
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.queue or self.closed, timeout if block else 0):
+                raise queue.Empty
+            if not self.queue:
+                return None
+            item = self.queue.popleft()
+            if self.overflow == OVERFLOW_CONFLATE:
+                item = self.latest.pop(item)
+            self.delivered += 1
+            self.condition.notify_all()
+            return item
+
+    def lag(self):
+        """ Lag counters of the subscriber: queued ticks, peak depth, ticks received from the hub, ticks delivered to
+            the subscriber, ticks dropped on overflow and ticks replaced by a newer one when conflating
+        """
+        with self.condition:
+            return {'depth': len(self.queue), 'peak': self.peak, 'received': self.received,
+                    'delivered': self.delivered, 'dropped': self.dropped, 'conflated': self.conflated}
+
+    def start(self, callback):
+        """ Deliver the ticks to a callback, run on a dedicated thread """
+        self.thread = threading.Thread(target=self.__dispatch, args=(callback,))
+        self.thread.start()
+
+    def wake(self):
+        """ Wake up a put blocked on a full queue, so that it checks its interrupted event """
+        with self.condition:
+            self.condition.notify_all()
+
+    def close(self):
+        """ Stop delivering ticks, wake up anyone waiting on the queue """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def __dispatch(self, callback):
+        while True:
+            tick = self.get()
+            if tick is None:
+                break
+            callback(tick)
+
+    @staticmethod
+    def __instrument(tick):
+        return tick.instrument if isinstance(tick, Tick) else tick['tick']['instrument']
+
+
+class StreamHub:
+    """ Shares one rates stream connection between many subscribers
+        The connection covers the union of the instruments of all the subscriptions, and is reopened whenever that
+        union changes. The reader thread only routes each tick to the queues of the subscriptions of its instrument,
+        so a slow subscriber never stalls the connection, unless it chose OVERFLOW_BLOCK
+    """
+    def __init__(self, environment, access_token, account_id, fast_decode=True, on_error=None):
+        """ Instantiates a hub
+            :param environment: 模拟或真实环境
+            :param access_token: oanda REST API access token
+            :param account_id: The account id of the rates stream
+            :param fast_decode: [Optional] Route ticks as stream.Tick objects instead of dicts. Default: True
+            :param on_error: [Optional] Callback function, invoked when the stream reports an error
+        """
+        self.environment = environment
+        self.access_token = access_token
+        self.account_id = account_id
+        self.fast_decode = fast_decode
+        self.on_error = on_error
+        self.stream = None
+        # Set when the current stream is replaced, its reader then stops routing ticks
+        self.interrupted = None
+        self.instruments = frozenset()
+        self.subscriptions = []
+        self.routes = dict()
+        self.lock = threading.Lock()
+
+    def subscribe(self, instruments, maxsize=1000, overflow=OVERFLOW_DROP_OLDEST, callback=None):
+        """ Add a subscriber, reconnecting the stream if new instruments are needed
+            :param instruments: Instruments the subscriber is interested in, a list or a comma separated string
+            :param maxsize: Maximum number of queued ticks. Default: 1000
+            :param overflow: OVERFLOW_DROP_OLDEST, OVERFLOW_CONFLATE or OVERFLOW_BLOCK. Default: OVERFLOW_DROP_OLDEST
+            :param callback: [Optional] Deliver the ticks to this function on a dedicated thread, instead of get()
+        """
+        if isinstance(instruments, str):
+            instruments = instruments.split(',')
+        subscription = Subscription(instruments, maxsize, overflow)
+        if callback:
+            subscription.start(callback)
+        with self.lock:
+            self.subscriptions.append(subscription)
+            replaced = self.__update()
+        if replaced:
+            replaced.stop()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Remove a subscriber and close its queue """
+        # Close first, so that a reader blocked on a full OVERFLOW_BLOCK queue can not hold up the reconnection
+        subscription.close()
+        replaced = None
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+                replaced = self.__update()
+        if replaced:
+            replaced.stop()
+
+    def stop(self):
+        """ Close the stream and all the subscriptions """
+        with self.lock:
+            subscriptions, self.subscriptions = self.subscriptions, []
+        for subscription in subscriptions:
+            subscription.close()
+        with self.lock:
+            replaced = self.__update()
+        if replaced:
+            replaced.stop()
+
+    def lag(self):
+        """ Lag counters of every subscription, see Subscription.lag """
+        with self.lock:
+            return [(sorted(s.instruments), s.lag()) for s in self.subscriptions]
+
+    def __update(self):
+        """ Rebuild the routing table, reconnect if the union of the instruments changed. Called with lock held,
+            returns the replaced stream, to be stopped once the lock is released: stopping joins the reader thread,
+            which may be blocked on a subscriber
+        """
+        routes = dict()
+        for subscription in self.subscriptions:
+            for instrument in subscription.instruments:
+                routes.setdefault(instrument, []).append(subscription)
+        # The reader thread looks routes up without locking, so the table is replaced as a whole
+        self.routes = routes
+        instruments = frozenset(routes)
+        if instruments == self.instruments:
+            return None
+        self.instruments = instruments
+        replaced = self.stream
+        if replaced:
+            # Release a reader blocked on a full queue, and keep it from routing anything more
+            self.interrupted.set()
+            for subscription in self.subscriptions:
+                subscription.wake()
+            self.stream = None
+        if instruments:
+            self.interrupted = threading.Event()
+            self.stream = Stream(self.environment, self.access_token, True, fast_decode=self.fast_decode)
+            self.stream.start(self.__router(self.interrupted), self.on_error, accountId=self.account_id,
+                              instruments=','.join(sorted(instruments)), ignore_heartbeat=True)
+        return replaced
+
+    def __router(self, interrupted):
+        """ Stream callback dispatching a tick to the subscriptions of its instrument, until interrupted is set """
+        def route(data):
+            if interrupted.is_set():
+                return
+            if isinstance(data, Tick):
+                instrument = data.instrument
+            elif 'tick' in data:
+                instrument = data['tick']['instrument']
+            else:
+                return
+            for subscription in self.routes.get(instrument, ()):
+                subscription.put(data, interrupted)
+        return route
@@ -0,0 +1,184 @@
+#! /usr/bin/env python
+
+""" account_mirror.AccountMirror的离线测试, 使用fake_server.FakeOanda """
+
+import time
+import threading
+import unittest
+import rest
+from account_mirror import AccountMirror
+from fake_server import FakeOanda
+
+TIME = '2024-01-02T10:00:00.000000Z'
+
+
+class QuietStream:
+    """ Events stream sending nothing, the tests feed the mirror through update """
+    api = None
+
+    def start(self, on_stream, on_error, on_connect=None, **params):
+        self.params = params
+
+    def stop(self):
+        pass
+
+
+def transaction(transaction_id, kind, **fields):
+    fields.update(id=transaction_id, type=kind, accountId=1, time=TIME)
+    return {'transaction': fields}
+
+
+class MirrorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeOanda().start()
+        self.api = self.fake.connect(rest.Api('practice', 'token', rate_limit=None))
+        self.api.init()
+        self.mirror = AccountMirror(self.api, 1, retry_interval=0.1)
+
+    def tearDown(self):
+        self.mirror.stop()
+        self.api.deinit()
+        self.fake.stop()
+
+    def wait_synced(self):
+        deadline = time.monotonic() + 5
+        while self.mirror.status()['syncing'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+class TestTransactions(MirrorTestCase):
+    def setUp(self):
+        super(TestTransactions, self).setUp()
+        self.mirror.start(QuietStream())
+
+    def test_snapshot(self):
+        status = self.mirror.status()
+        self.assertEqual(status['sequence'], self.fake.transaction_id)
+        self.assertEqual(status['resyncs'], 1)
+        self.assertFalse(status['syncing'])
+        self.assertEqual(self.mirror.get_account()['balance'], 100000)
+        self.assertEqual(self.mirror.get_trades(), [])
+
+    def test_orders(self):
+        self.mirror.update(transaction(1001, 'LIMIT_ORDER_CREATE', instrument='EUR_USD', units=100, side='buy',
+                                       price=1.09, expiry='2024-01-03T10:00:00.000000Z'))
+        self.mirror.update(transaction(1002, 'STOP_ORDER_CREATE', instrument='USD_JPY', units=200, side='sell',
+                                       price=140.0, expiry='2024-01-03T10:00:00.000000Z'))
+        self.mirror.update(transaction(1003, 'ORDER_UPDATE', orderId=1001, price=1.08, stopLossPrice=1.07))
+        order = self.mirror.get_order(1001)
+        self.assertEqual((order['type'], order['price'], order['stopLoss'], order['units']), ('limit', 1.08, 1.07, 100))
+        self.assertEqual(self.mirror.get_order(1002)['type'], 'stop')
+        self.mirror.update(transaction(1004, 'ORDER_CANCEL', orderId=1002, reason='CLIENT_REQUEST'))
+        self.assertEqual([order['id'] for order in self.mirror.get_orders()], [1001])
+        self.assertEqual(self.mirror.get_account()['openOrders'], 1)
+        self.assertEqual(self.mirror.status()['sequence'], 1004)
+
+    def test_fill_reduce_close(self):
+        self.mirror.update(transaction(1001, 'LIMIT_ORDER_CREATE', instrument='EUR_USD', units=100, side='buy',
+                                       price=1.1, expiry='2024-01-03T10:00:00.000000Z', takeProfitPrice=1.2))
+        self.mirror.update(transaction(1002, 'ORDER_FILLED', orderId=1001, instrument='EUR_USD', units=100,
+                                       side='buy', price=1.1, tradeOpened={'id': 1002, 'units': 100},
+                                       accountBalance=100000))
+        self.assertEqual(self.mirror.get_orders(), [])
+        trade = self.mirror.get_trade(1002)
+        self.assertEqual((trade['units'], trade['price'], trade['takeProfit']), (100, 1.1, 1.2))
+        self.mirror.update(transaction(1003, 'MARKET_ORDER_CREATE', instrument='EUR_USD', units=100, side='buy',
+                                       price=1.2, tradeOpened={'id': 1003, 'units': 100}, accountBalance=100000))
+        position = self.mirror.get_position('EUR_USD')
+        self.assertEqual(position['units'], 200)
+        self.assertAlmostEqual(position['avgPrice'], 1.15)
+
+        # Selling part of the position reduces the oldest trade
+        self.mirror.update(transaction(1004, 'MARKET_ORDER_CREATE', instrument='EUR_USD', units=40, side='sell',
+                                       price=1.15, tradeReduced={'id': 1002, 'units': 40, 'pl': 2.0},
+                                       pl=2.0, accountBalance=100002))
+        self.assertEqual(self.mirror.get_trade(1002)['units'], 60)
+        self.assertEqual(self.mirror.get_position('EUR_USD')['units'], 160)
+
+        self.mirror.update(transaction(1005, 'STOP_LOSS_FILLED', tradeId=1002, instrument='EUR_USD', units=60,
+                                       side='sell', price=1.05, pl=-3.0, accountBalance=99999))
+        self.assertIsNone(self.mirror.get_trade(1002))
+        self.assertEqual(self.mirror.get_position('EUR_USD')['units'], 100)
+        self.mirror.update(transaction(1006, 'TRADE_CLOSE', tradeId=1003, instrument='EUR_USD', units=100,
+                                       side='sell', price=1.25, pl=5.0, accountBalance=100004))
+        self.assertEqual(self.mirror.get_trades(), [])
+        self.assertEqual(self.mirror.get_positions(), [])
+        account = self.mirror.get_account()
+        self.assertEqual(account['balance'], 100004)
+        self.assertEqual(account['realizedPl'], 4.0)
+        self.assertEqual(account['openTrades'], 0)
+        self.assertEqual(self.mirror.status()['resyncs'], 1)
+
+    def test_trade_update_and_account(self):
+        self.mirror.update(transaction(1001, 'MARKET_ORDER_CREATE', instrument='EUR_USD', units=10, side='sell',
+                                       price=1.1, tradeOpened={'id': 1001, 'units': 10}))
+        self.mirror.update(transaction(1002, 'TRADE_UPDATE', tradeId=1001, stopLossPrice=1.2))
+        self.mirror.update(transaction(1003, 'SET_MARGIN_RATE', rate=0.02))
+        self.mirror.update(transaction(1004, 'MARGIN_CALL_ENTER'))
+        self.assertEqual(self.mirror.get_trade(1001)['stopLoss'], 1.2)
+        self.assertEqual(self.mirror.get_position('EUR_USD')['side'], 'sell')
+        account = self.mirror.get_account()
+        self.assertEqual((account['marginRate'], account['marginCall']), (0.02, True))
+
+    def test_ignored(self):
+        # Transactions of the snapshot, of other accounts, and heartbeats
+        self.mirror.update(transaction(999, 'MARKET_ORDER_CREATE', instrument='EUR_USD', units=10, side='buy',
+                                       price=1.1, tradeOpened={'id': 999, 'units': 10}))
+        other = transaction(1001, 'MARKET_ORDER_CREATE', instrument='EUR_USD', units=10, side='buy', price=1.1,
+                            tradeOpened={'id': 1001, 'units': 10})
+        other['transaction']['accountId'] = 2
+        self.mirror.update(other)
+        self.mirror.update({'heartbeat': {'time': TIME}})
+        self.assertEqual(self.mirror.get_trades(), [])
+        self.assertEqual(self.mirror.status()['sequence'], self.fake.transaction_id)
+
+    def test_out_of_sync(self):
+        self.mirror.update(transaction(1001, 'MARKET_ORDER_CREATE', instrument='EUR_USD', units=10, side='buy',
+                                       price=1.1, tradeOpened={'id': 1001, 'units': 10}))
+        self.assertEqual(len(self.mirror.get_trades()), 1)
+        # A trade the mirror does not know: the server's state is reloaded
+        self.mirror.update(transaction(1002, 'TRADE_CLOSE', tradeId=77, instrument='EUR_USD', units=10,
+                                       side='sell', price=1.1, pl=0.0))
+        self.wait_synced()
+        status = self.mirror.status()
+        self.assertEqual(status['resyncs'], 2)
+        self.assertEqual(status['sequence'], self.fake.transaction_id)
+        # The fake server has no open trade
+        self.assertEqual(self.mirror.get_trades(), [])
+
+
+class TestSnapshot(MirrorTestCase):
+    def test_buffered_while_syncing(self):
+        stream = QuietStream()
+        self.fake.latency = 0.05
+        thread = threading.Thread(target=self.mirror.start, args=(stream,))
+        thread.start()
+        time.sleep(0.01)
+        self.mirror.update(transaction(1001, 'MARKET_ORDER_CREATE', instrument='EUR_USD', units=10, side='buy',
+                                       price=1.1, tradeOpened={'id': 1001, 'units': 10}))
+        thread.join(5)
+        self.assertEqual(stream.params, {'accountIds': 1})
+        self.assertEqual(self.mirror.get_position('EUR_USD')['units'], 10)
+
+    def test_overtaken(self):
+        # Transactions are made while the snapshot is taken, until busy is cleared
+        busy = threading.Event()
+        busy.set()
+
+        def trade():
+            while busy.is_set():
+                self.fake.next_transaction_id()
+                time.sleep(0.001)
+
+        thread = threading.Thread(target=trade)
+        thread.start()
+        threading.Timer(0.5, busy.clear).start()
+        self.mirror.start(QuietStream())
+        thread.join()
+        self.assertEqual(self.mirror.status()['sequence'], self.fake.transaction_id)
+        # Retaken with a growing delay rather than in a loop: 6 requests per attempt
+        self.assertLess(self.fake.requests, 6 * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+
+""" candle_aggregator.CandleAggregator的离线测试, 使用fake_server.FakeOanda """
+
+import unittest
+import rest
+from candle_aggregator import CandleAggregator
+from fake_server import FakeOanda
+from stream import Tick
+from timeutil import to_epoch, to_rfc3339
+
+
+def bounds(aggregator, t, granularity):
+    return tuple(to_rfc3339(value) for value in aggregator.bounds(to_epoch(t), granularity))
+
+
+class TestBounds(unittest.TestCase):
+    def setUp(self):
+        # Server defaults: days start at 17:00 America/New_York, weeks on Friday
+        self.aggregator = CandleAggregator(['M1'])
+
+    def test_minutes(self):
+        self.assertEqual(bounds(self.aggregator, '2024-01-02T10:07:31Z', 'M5'),
+                         ('2024-01-02T10:05:00Z', '2024-01-02T10:10:00Z'))
+        self.assertEqual(bounds(self.aggregator, '2024-01-02T10:05:00Z', 'M5'),
+                         ('2024-01-02T10:05:00Z', '2024-01-02T10:10:00Z'))
+        self.assertEqual(bounds(self.aggregator, '2024-01-02T10:07:31Z', 'S30'),
+                         ('2024-01-02T10:07:30Z', '2024-01-02T10:08:00Z'))
+
+    def test_daily_across_dst(self):
+        # 17:00 New York is 22:00 UTC in winter and 21:00 UTC in summer, the day of the change lasts 23 hours
+        self.assertEqual(bounds(self.aggregator, '2024-01-02T12:00:00Z', 'D'),
+                         ('2024-01-01T22:00:00Z', '2024-01-02T22:00:00Z'))
+        self.assertEqual(bounds(self.aggregator, '2024-03-10T12:00:00Z', 'D'),
+                         ('2024-03-09T22:00:00Z', '2024-03-10T21:00:00Z'))
+        self.assertEqual(bounds(self.aggregator, '2024-07-03T21:30:00Z', 'D'),
+                         ('2024-07-03T21:00:00Z', '2024-07-04T21:00:00Z'))
+
+    def test_hours(self):
+        self.assertEqual(bounds(self.aggregator, '2024-01-02T12:00:00Z', 'H4'),
+                         ('2024-01-02T10:00:00Z', '2024-01-02T14:00:00Z'))
+        # The last H4 candle of the short day is cut at its end
+        self.assertEqual(bounds(self.aggregator, '2024-03-10T20:00:00Z', 'H4'),
+                         ('2024-03-10T18:00:00Z', '2024-03-10T21:00:00Z'))
+
+    def test_weeks_and_months(self):
+        self.assertEqual(bounds(self.aggregator, '2024-07-03T12:00:00Z', 'W'),
+                         ('2024-06-28T21:00:00Z', '2024-07-05T21:00:00Z'))
+        self.assertEqual(bounds(self.aggregator, '2024-07-03T12:00:00Z', 'M'),
+                         ('2024-07-01T21:00:00Z', '2024-08-01T21:00:00Z'))
+        # Before 17:00 on the first of the month, still the previous month
+        self.assertEqual(bounds(self.aggregator, '2024-07-01T20:00:00Z', 'M'),
+                         ('2024-06-01T21:00:00Z', '2024-07-01T21:00:00Z'))
+
+    def test_utc_alignment(self):
+        aggregator = CandleAggregator(['D'], dailyAlignment=0, alignmentTimezone='UTC', weeklyAlignment='Monday')
+        self.assertEqual(bounds(aggregator, '2024-03-10T12:00:00Z', 'D'),
+                         ('2024-03-10T00:00:00Z', '2024-03-11T00:00:00Z'))
+        self.assertEqual(bounds(aggregator, '2024-03-10T12:00:00Z', 'W'),
+                         ('2024-03-04T00:00:00Z', '2024-03-11T00:00:00Z'))
+
+    def test_unknown_granularity(self):
+        self.assertRaises(ValueError, CandleAggregator, ['M7'])
+
+
+class TestUpdate(unittest.TestCase):
+    def setUp(self):
+        self.closed = []
+        self.aggregator = CandleAggregator(['M1', 'M5'], on_candle=lambda *candle: self.closed.append(candle))
+
+    def tick(self, time, bid, ask=None):
+        self.aggregator.update(Tick('EUR_USD', time, bid, bid + 0.0002 if ask is None else ask))
+
+    def test_bidask(self):
+        self.tick('2024-01-02T10:00:05Z', 1.1000)
+        self.aggregator.update({'tick': {'instrument': 'EUR_USD', 'time': '2024-01-02T10:00:20.5Z', 'bid': 1.1010,
+                                         'ask': 1.1012}})
+        self.tick('2024-01-02T10:00:40Z', 1.0990)
+        self.tick('2024-01-02T10:00:50Z', 1.1005)
+        candle = self.aggregator.current('EUR_USD', 'M1')
+        self.assertEqual(candle['time'], '2024-01-02T10:00:00.000000Z')
+        self.assertEqual((candle['openBid'], candle['highBid'], candle['lowBid'], candle['closeBid']),
+                         (1.1000, 1.1010, 1.0990, 1.1005))
+        self.assertEqual(candle['highAsk'], 1.1012)
+        self.assertEqual(candle['volume'], 4)
+        self.assertFalse(candle['complete'])
+        self.assertEqual(self.closed, [])
+
+    def test_close_on_tick_and_heartbeat(self):
+        self.tick('2024-01-02T10:00:05Z', 1.1000)
+        self.tick('2024-01-02T10:01:05Z', 1.1001)
+        self.assertEqual([(instrument, granularity) for instrument, granularity, _ in self.closed],
+                         [('EUR_USD', 'M1')])
+        self.assertTrue(self.closed[0][2]['complete'])
+        self.aggregator.update({'heartbeat': {'time': '2024-01-02T10:05:00Z'}})
+        self.assertEqual(sorted(granularity for _, granularity, _ in self.closed), ['M1', 'M1', 'M5'])
+        self.assertEqual([candle['volume'] for _, granularity, candle in self.closed if granularity == 'M5'], [2])
+        self.assertIsNone(self.aggregator.current('EUR_USD', 'M5'))
+        self.assertEqual(len(self.aggregator.completed_candles('EUR_USD', 'M1')), 2)
+
+    def test_unix_midpoint(self):
+        aggregator = CandleAggregator(['M1'], candleFormat='midpoint', dateFormat='unix')
+        aggregator.update(Tick('EUR_USD', str(int(to_epoch('2024-01-02T10:00:05Z') * 1000000)), 1.1, 1.1002))
+        candle = aggregator.current('EUR_USD', 'M1')
+        self.assertEqual(candle['time'], str(int(to_epoch('2024-01-02T10:00:00Z') * 1000000)))
+        self.assertAlmostEqual(candle['openMid'], 1.1001)
+
+
+class TestSeed(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeOanda().start()
+        self.api = self.fake.connect(rest.Api('practice', 'token', rate_limit=None))
+        self.api.init()
+
+    def tearDown(self):
+        self.api.deinit()
+        self.fake.stop()
+
+    def test_seed(self):
+        aggregator = CandleAggregator(['M1', 'M5'], history=10)
+        aggregator.seed(self.api, 'EUR_USD,USD_JPY')
+        completed = aggregator.completed_candles('USD_JPY', 'M1')
+        self.assertEqual(len(completed), 10)
+        current = aggregator.current('USD_JPY', 'M1')
+        self.assertIsNotNone(current)
+        # Seeded and aggregated candles share the server time format
+        self.assertEqual(len(current['time']), len(completed[-1]['time']))
+        self.assertEqual(to_epoch(current['time']) - to_epoch(completed[-1]['time']), 60)
+
+    def test_seed_after_deinit(self):
+        self.api.deinit()
+        aggregator = CandleAggregator(['M1'])
+        aggregator.seed(self.api, ['EUR_USD'])
+        self.assertEqual(aggregator.completed_candles('EUR_USD', 'M1'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+
+""" candle_store.CandleStore的离线测试, 使用fake_server.FakeOanda """
+
+import shutil
+import tempfile
+import unittest
+import rest
+from candle_store import CandleStore
+from fake_server import FakeOanda
+from timeutil import to_epoch
+
+START = '2024-01-02T00:13:30Z'
+END = '2024-01-02T03:13:30Z'
+
+
+class TestCandleStore(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeOanda().start()
+        self.api = self.fake.connect(rest.Api('practice', 'token', rate_limit=None))
+        self.api.init()
+        self.directory = tempfile.mkdtemp()
+        self.store = CandleStore(self.api, self.directory)
+
+    def tearDown(self):
+        self.api.deinit()
+        self.fake.stop()
+        shutil.rmtree(self.directory)
+
+    def times(self, response):
+        return [candle['time'] for candle in response['candles']]
+
+    def test_same_as_get_history(self):
+        expected = self.api.get_history(False, instrument='EUR_USD', granularity='M1', start=START, end=END)
+        response = self.store.get_history('EUR_USD', 'M1', START, END)
+        self.assertEqual(len(response['candles']), 181)
+        self.assertEqual(response['candles'], expected['candles'])
+        self.assertEqual(response['candles'][0]['time'], '2024-01-02T00:13:00.000000Z')
+
+    def test_served_from_disk(self):
+        first = self.store.get_history('EUR_USD', 'M1', START, END)
+        requests = self.fake.requests
+        again = self.store.get_history('EUR_USD', 'M1', START, END)
+        self.assertEqual(self.fake.requests, requests)
+        self.assertEqual(again, first)
+        # A range inside the stored one, unaligned as well
+        inner = self.store.get_history('EUR_USD', 'M1', '2024-01-02T01:00:59Z', '2024-01-02T01:10:00Z')
+        self.assertEqual(self.fake.requests, requests)
+        self.assertEqual(self.times(inner)[0], '2024-01-02T01:00:00.000000Z')
+        self.assertEqual(len(inner['candles']), 11)
+
+    def test_merge_overlapping_ranges(self):
+        self.store.get_history('EUR_USD', 'M1', '2024-01-02T01:00:00Z', '2024-01-02T02:00:00Z')
+        self.store.get_history('EUR_USD', 'M1', '2024-01-02T03:00:00Z', '2024-01-02T04:00:00Z')
+        requests = self.fake.requests
+        # Only the gaps before, between and after the stored ranges are fetched
+        response = self.store.get_history('EUR_USD', 'M1', '2024-01-02T00:00:00Z', '2024-01-02T05:00:00Z')
+        self.assertEqual(self.fake.requests, requests + 3)
+        times = [to_epoch(t) for t in self.times(response)]
+        self.assertEqual(times, [to_epoch('2024-01-02T00:00:00Z') + 60 * i for i in range(301)])
+        columns = self.store.columns('EUR_USD', 'M1')
+        self.assertEqual(len(columns['time']), 301)
+        self.assertEqual(len(columns['openBid']), 301)
+
+    def test_keys(self):
+        bidask = self.store.get_history('EUR_USD', 'M5', START, END)
+        midpoint = self.store.get_history('EUR_USD', 'M5', START, END, candleFormat='midpoint')
+        self.assertIn('openBid', bidask['candles'][0])
+        self.assertIn('openMid', midpoint['candles'][0])
+        self.assertEqual(self.times(bidask), self.times(midpoint))
+
+    def test_unix_date_format(self):
+        response = self.store.get_history('EUR_USD', 'M1', START, END, dateFormat='unix')
+        self.assertEqual(response['candles'][0]['time'], str(int(to_epoch('2024-01-02T00:13:00Z') * 1000000)))
+
+
+if __name__ == '__main__':
+    unittest.main()
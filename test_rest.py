@@ -0,0 +1,186 @@
+#! /usr/bin/env python
+
+""" rest.Api请求生命周期的离线测试, 使用fake_server.FakeOanda """
+
+import time
+import unittest
+import rest
+from exceptions import OandaError
+from fake_server import FakeOanda
+
+
+class ApiTestCase(unittest.TestCase):
+    """ Starts a fake server and an initialized Api pointed to it for each test """
+    latency = 0.0
+    error_rate = 0.0
+    api_params = dict()
+
+    def setUp(self):
+        self.fake = FakeOanda(latency=self.latency, error_rate=self.error_rate, seed=1).start()
+        params = dict(rate_limit=None)
+        params.update(self.api_params)
+        self.api = self.fake.connect(rest.Api('practice', 'token', **params))
+        self.api.init()
+
+    def tearDown(self):
+        self.api.deinit()
+        self.fake.stop()
+
+    @staticmethod
+    def wait_running(r):
+        """ Wait until a worker sent a request """
+        deadline = time.monotonic() + 5
+        while not r.running() and not r.done() and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+
+class TestCompletion(ApiTestCase):
+    def test_result(self):
+        r = self.api.get_account(1, True)
+        self.assertIsInstance(r, rest.ApiRequest)
+        self.assertEqual(r.result(5)['accountId'], 1)
+        self.assertIsNone(r.exception())
+        self.assertIs(r.wait_for_complete(), r.result())
+
+    def test_server_error(self):
+        self.fake.error_rate = 1.0
+        r = self.api.get_account(1, True)
+        self.assertIsInstance(r.exception(5), OandaError)
+        self.assertEqual(r.exception().code, 0)
+        self.assertRaises(OandaError, r.result)
+        self.assertIsNone(r.wait_for_complete())
+
+    def test_failing_decoder(self):
+        def decoder(text):
+            raise KeyError('decoder')
+
+        r = rest.ApiRequest('v1/prices', params={'instruments': 'EUR_USD'}, decoder=decoder)
+        self.api.request_queue.put(r)
+        self.assertIsInstance(r.exception(5), KeyError)
+        # The worker survived and the key was released
+        self.assertEqual(self.api.inflight, dict())
+        self.assertIsNotNone(self.api.get_prices(False, instruments='EUR_USD'))
+
+    def test_gather(self):
+        reqs = [self.api.get_trade(1, i, True) for i in range(10)]
+        responses = rest.gather(reqs, 5)
+        self.assertEqual([response['id'] for response in responses], list(range(10)))
+
+
+class TestCoalescing(ApiTestCase):
+    latency = 0.2
+    api_params = dict(pool_size=1)
+
+    def test_shared(self):
+        a = self.api.get_account(1, True)
+        b = self.api.get_account(1, True)
+        self.assertIs(a, b)
+        self.assertIsNotNone(a.result(5))
+        self.assertEqual(self.fake.requests, 1)
+        self.assertEqual(self.api.inflight, dict())
+
+    def test_different_params(self):
+        a = self.api.get_prices(True, instruments='EUR_USD')
+        b = self.api.get_prices(True, instruments='USD_JPY')
+        self.assertIsNot(a, b)
+
+    def test_cancelled(self):
+        # Keep the only worker busy, so that the next request stays queued
+        busy = self.api.get_trade(1, 1, True)
+        self.wait_running(busy)
+        queued = self.api.get_account(1, True)
+        self.assertTrue(queued.cancel())
+        self.assertEqual([r for r in self.api.inflight.values() if r is queued], [])
+        again = self.api.get_account(1, True)
+        self.assertIsNot(again, queued)
+        self.assertIsNotNone(again.result(5))
+        self.assertIsNotNone(busy.result(5))
+        self.assertTrue(queued.cancelled())
+        self.assertIsNone(queued.wait_for_complete())
+
+
+class TestCache(ApiTestCase):
+    api_params = dict(cache=rest.ResponseCache(ttl={'v1/accounts/{account_id}/trades': 60}))
+
+    def setUp(self):
+        self.api_params['cache'].clear()
+        super(TestCache, self).setUp()
+
+    def test_hit(self):
+        first = self.api.get_trades(1, False)
+        self.assertIs(self.api.get_trades(1, False), first)
+        self.assertEqual(self.fake.requests, 1)
+
+    def test_invalidated_by_mutation(self):
+        self.api.get_trades(1, False)
+        self.api.get_trades(2, False)
+        self.assertIsNotNone(self.api.create_order(1, False, instrument='EUR_USD', units=1, side='buy',
+                                                   type='market'))
+        self.assertEqual(self.fake.requests, 3)
+        self.api.get_trades(1, False)
+        self.assertEqual(self.fake.requests, 4)
+        # Other accounts keep their cache
+        self.api.get_trades(2, False)
+        self.assertEqual(self.fake.requests, 4)
+
+    def test_stale_response_not_cached(self):
+        # A GET sent before a change of the account and completed after its invalidation
+        cache = self.api.cache
+        r = rest.ApiRequest('v1/accounts/1/trades')
+        generation = cache.generation(r.endpoint)
+        cache.invalidate(1)
+        cache.put(r.key, r.endpoint, {'trades': []}, generation)
+        self.assertIsNone(cache.get(r.key))
+        cache.put(r.key, r.endpoint, {'trades': []}, cache.generation(r.endpoint))
+        self.assertIsNotNone(cache.get(r.key))
+
+    def test_failure_not_cached(self):
+        self.fake.error_rate = 1.0
+        self.assertIsNone(self.api.get_trades(1, False))
+        self.fake.error_rate = 0.0
+        self.assertIsNotNone(self.api.get_trades(1, False))
+        self.assertEqual(self.fake.requests, 2)
+
+
+class TestLanes(unittest.TestCase):
+    def test_scheduler_order(self):
+        scheduler = rest.RequestScheduler()
+        data = rest.ApiRequest('v1/candles', params={'count': 1})
+        query = rest.ApiRequest('v1/accounts/1')
+        trade = rest.ApiRequest('v1/accounts/1/orders', method='POST')
+        later_trade = rest.ApiRequest('v1/accounts/1/trades/2', method='DELETE')
+        for r in (data, query, trade, later_trade):
+            scheduler.put(r)
+        self.assertEqual(scheduler.depths(), {'trade': 2, 'query': 1, 'data': 1})
+        self.assertEqual([scheduler.get(block=False) for _ in range(4)], [trade, later_trade, query, data])
+        self.assertTrue(scheduler.empty())
+
+    def test_reserve_takes_highest_priority(self):
+        scheduler = rest.RequestScheduler()
+        data = rest.ApiRequest('v1/candles')
+        scheduler.put(data)
+        self.assertTrue(scheduler.reserve(0))
+        # Nothing else to reserve, but a trade queued meanwhile is taken first
+        self.assertFalse(scheduler.reserve(0))
+        trade = rest.ApiRequest('v1/accounts/1/orders', method='POST')
+        scheduler.put(trade)
+        self.assertIs(scheduler.take(), trade)
+
+
+class TestLanesApi(ApiTestCase):
+    latency = 0.1
+    api_params = dict(pool_size=1)
+
+    def test_trade_first(self):
+        busy = self.api.get_prices(True, instruments='EUR_USD')
+        self.wait_running(busy)
+        data = self.api.get_history(True, instrument='EUR_USD', granularity='M1', count=1)
+        query = self.api.get_account(1, True)
+        trade = self.api.create_order(1, True, instrument='EUR_USD', units=1, side='buy', type='market')
+        rest.gather([busy, data, query, trade], 5)
+        order = sorted((busy, data, query, trade), key=lambda r: r.completed)
+        self.assertEqual(order, [busy, trade, query, data])
+
+
+if __name__ == '__main__':
+    unittest.main()
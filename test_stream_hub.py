@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+
+""" stream_hub.Subscription溢出策略的离线测试 """
+
+import queue
+import threading
+import unittest
+from stream import Tick
+from stream_hub import OVERFLOW_BLOCK, OVERFLOW_CONFLATE, OVERFLOW_DROP_OLDEST, Subscription
+
+TIME = '2024-01-02T10:00:00.000000Z'
+
+
+def tick(instrument, bid):
+    return Tick(instrument, TIME, bid, bid + 0.0002)
+
+
+class TestOverflow(unittest.TestCase):
+    def drain(self, subscription):
+        ticks = []
+        while True:
+            try:
+                ticks.append(subscription.get(False))
+            except queue.Empty:
+                return ticks
+
+    def test_drop_oldest(self):
+        subscription = Subscription(['EUR_USD'], maxsize=3, overflow=OVERFLOW_DROP_OLDEST)
+        for i in range(5):
+            subscription.put(tick('EUR_USD', 1.0 + i))
+        self.assertEqual([t.bid for t in self.drain(subscription)], [3.0, 4.0, 5.0])
+        lag = subscription.lag()
+        self.assertEqual((lag['received'], lag['delivered'], lag['dropped'], lag['peak'], lag['depth']),
+                         (5, 3, 2, 3, 0))
+
+    def test_conflate(self):
+        subscription = Subscription(['EUR_USD', 'USD_JPY', 'GBP_USD'], maxsize=2, overflow=OVERFLOW_CONFLATE)
+        subscription.put(tick('EUR_USD', 1.1))
+        subscription.put(tick('USD_JPY', 140.1))
+        # Replaces the queued EUR_USD tick in place
+        subscription.put({'tick': {'instrument': 'EUR_USD', 'time': TIME, 'bid': 1.2, 'ask': 1.2002}})
+        self.assertEqual(subscription.lag()['conflated'], 1)
+        self.assertEqual(subscription.get(False)['tick']['bid'], 1.2)
+        subscription.put(tick('GBP_USD', 1.25))
+        # Full: the oldest instrument is dropped
+        subscription.put(tick('EUR_USD', 1.3))
+        self.assertEqual([t.bid for t in self.drain(subscription)], [1.25, 1.3])
+        self.assertEqual(subscription.lag()['dropped'], 1)
+
+    def test_block(self):
+        subscription = Subscription(['EUR_USD'], maxsize=2, overflow=OVERFLOW_BLOCK)
+        subscription.put(tick('EUR_USD', 1.0))
+        subscription.put(tick('EUR_USD', 2.0))
+        reader = threading.Thread(target=subscription.put, args=(tick('EUR_USD', 3.0),))
+        reader.start()
+        reader.join(0.1)
+        self.assertTrue(reader.is_alive())
+        self.assertEqual(subscription.get(False).bid, 1.0)
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        self.assertEqual([t.bid for t in self.drain(subscription)], [2.0, 3.0])
+        self.assertEqual(subscription.lag()['dropped'], 0)
+
+    def test_block_interrupted(self):
+        subscription = Subscription(['EUR_USD'], maxsize=1, overflow=OVERFLOW_BLOCK)
+        subscription.put(tick('EUR_USD', 1.0))
+        interrupted = threading.Event()
+        reader = threading.Thread(target=subscription.put, args=(tick('EUR_USD', 2.0), interrupted))
+        reader.start()
+        reader.join(0.1)
+        self.assertTrue(reader.is_alive())
+        interrupted.set()
+        subscription.wake()
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        # The tick was given up
+        self.assertEqual([t.bid for t in self.drain(subscription)], [1.0])
+
+    def test_close(self):
+        subscription = Subscription(['EUR_USD'], maxsize=1, overflow=OVERFLOW_BLOCK)
+        subscription.put(tick('EUR_USD', 1.0))
+        reader = threading.Thread(target=subscription.put, args=(tick('EUR_USD', 2.0),))
+        reader.start()
+        subscription.close()
+        reader.join(5)
+        self.assertFalse(reader.is_alive())
+        # Drained, then None
+        self.assertEqual(subscription.get(False).bid, 1.0)
+        self.assertIsNone(subscription.get(False))
+
+    def test_callback(self):
+        received = []
+        subscription = Subscription(['EUR_USD'])
+        subscription.start(received.append)
+        for i in range(10):
+            subscription.put(tick('EUR_USD', 1.0 + i))
+        subscription.close()
+        self.assertEqual(len(received), 10)
+        self.assertEqual(subscription.lag()['delivered'], 10)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, Subscription, ['EUR_USD'], overflow='spill')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+
+""" tick_log.TickRecorder与TickReplay的离线测试, 使用fake_server.FakeOanda """
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import stream
+from fake_server import FakeOanda
+from stream import Tick
+from tick_log import INDEX, INDEX_FILE, LOG_FILE, RECORD, TickRecorder, TickReplay, load_index, load_instruments
+
+START = 1704189600.0
+
+
+def tick_line(instrument, bid):
+    return '{{"tick":{{"instrument":"{0}","time":"2024-01-02T10:00:00.000000Z","bid":{1},"ask":{2}}}}}'.format(
+        instrument, bid, round(bid + 0.0002, 5)).encode('ascii')
+
+
+HEARTBEAT = b'{"heartbeat":{"time":"2024-01-02T10:00:00.000000Z"}}'
+
+
+class TickLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, lines, **params):
+        """ Record lines received one second apart from START """
+        recorder = TickRecorder(self.directory, **params)
+        for i, line in enumerate(lines):
+            recorder.record(line, START + i)
+        recorder.close()
+        return recorder
+
+    def play(self, replay=None, **params):
+        delivered = []
+        errors = []
+        count = (replay or TickReplay(self.directory)).play(delivered.append, errors.append, **params)
+        self.assertEqual(count, len(delivered))
+        return delivered, errors
+
+
+class TestRecordAndReplay(TickLogTestCase):
+    def setUp(self):
+        super(TestRecordAndReplay, self).setUp()
+        self.lines = [tick_line('EUR_USD', 1.1), HEARTBEAT, tick_line('USD_JPY', 140.1), tick_line('EUR_USD', 1.2),
+                      HEARTBEAT, tick_line('EUR_USD', 1.3)]
+        self.recorder = self.record(self.lines, index_interval=2)
+
+    def test_records(self):
+        self.assertEqual(self.recorder.records, 6)
+        self.assertEqual(load_instruments(self.directory), ['EUR_USD', 'USD_JPY'])
+        records = list(TickReplay(self.directory).records())
+        self.assertEqual([line for _, line in records], self.lines)
+        self.assertEqual([received for received, _ in records], [int((START + i) * 1000000) for i in range(6)])
+        self.assertEqual(len(load_index(self.directory)), 3)
+
+    def test_play(self):
+        delivered, errors = self.play()
+        self.assertEqual(len(delivered), 6)
+        self.assertEqual(delivered[0], {'tick': {'instrument': 'EUR_USD', 'time': '2024-01-02T10:00:00.000000Z',
+                                                 'bid': 1.1, 'ask': 1.1002}})
+        self.assertIn('heartbeat', delivered[1])
+        self.assertEqual(errors, [])
+
+    def test_fast_decode(self):
+        delivered, _ = self.play(TickReplay(self.directory, fast_decode=True), ignore_heartbeat=True)
+        self.assertTrue(all(isinstance(tick, Tick) for tick in delivered))
+        self.assertEqual([tick.bid for tick in delivered], [1.1, 140.1, 1.2, 1.3])
+
+    def test_instruments(self):
+        delivered, _ = self.play(instruments='EUR_USD')
+        self.assertEqual([data['tick']['bid'] for data in delivered], [1.1, 1.2, 1.3])
+        delivered, _ = self.play(instruments=['USD_JPY', 'GBP_USD'])
+        self.assertEqual([data['tick']['bid'] for data in delivered], [140.1])
+
+    def test_since_until(self):
+        # Seeks through the index, then skips the records before since
+        delivered, _ = self.play(since=START + 3, until=START + 4)
+        self.assertEqual(delivered[0]['tick']['bid'], 1.2)
+        self.assertIn('heartbeat', delivered[1])
+        self.assertEqual(len(delivered), 2)
+        delivered, _ = self.play(since=START + 10)
+        self.assertEqual(delivered, [])
+
+    def test_paced(self):
+        begin = time.monotonic()
+        delivered, _ = self.play(TickReplay(self.directory, speed=20.0))
+        self.assertEqual(len(delivered), 6)
+        self.assertGreaterEqual(time.monotonic() - begin, 5 / 20.0)
+
+    def test_append(self):
+        self.record([tick_line('GBP_USD', 1.25), tick_line('USD_JPY', 140.2)])
+        self.assertEqual(load_instruments(self.directory), ['EUR_USD', 'USD_JPY', 'GBP_USD'])
+        delivered, _ = self.play(instruments='USD_JPY')
+        self.assertEqual([data['tick']['bid'] for data in delivered], [140.1, 140.2])
+
+
+class TestRecovery(TickLogTestCase):
+    def test_partial_record(self):
+        lines = [tick_line('EUR_USD', 1.1 + i / 1000.0) for i in range(5)]
+        self.record(lines, index_interval=2)
+        log_path = os.path.join(self.directory, LOG_FILE)
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        size = os.path.getsize(log_path)
+        index_size = os.path.getsize(index_path)
+        # Crash while writing: a record cut short in the log, a partial entry and one past the end in the index
+        with open(log_path, 'ab') as f:
+            f.write(RECORD.pack(int((START + 5) * 1000000), 100, 0) + b'{"tick":')
+        with open(index_path, 'ab') as f:
+            f.write(INDEX.pack(int((START + 5) * 1000000), size + 1000) + b'\x01\x02')
+        self.assertEqual([line for _, line in TickReplay(self.directory).records()], lines)
+
+        recorder = TickRecorder(self.directory)
+        self.assertEqual(os.path.getsize(log_path), size)
+        self.assertEqual(os.path.getsize(index_path), index_size)
+        recorder.record(HEARTBEAT, START + 6)
+        recorder.close()
+        records = list(TickReplay(self.directory).records())
+        self.assertEqual([line for _, line in records], lines + [HEARTBEAT])
+
+    def test_partial_header(self):
+        self.record([tick_line('EUR_USD', 1.1)])
+        log_path = os.path.join(self.directory, LOG_FILE)
+        size = os.path.getsize(log_path)
+        with open(log_path, 'ab') as f:
+            f.write(b'\x00\x01\x02')
+        TickRecorder(self.directory).close()
+        self.assertEqual(os.path.getsize(log_path), size)
+
+    def test_invalid_line(self):
+        self.record([b'{"tick":', tick_line('EUR_USD', 1.1)])
+        delivered, errors = self.play()
+        self.assertEqual(len(delivered), 1)
+        self.assertEqual(len(errors), 1)
+
+    def test_empty(self):
+        self.assertEqual(self.play(), ([], []))
+
+
+class TestStream(TickLogTestCase):
+    def test_record_stream(self):
+        fake = FakeOanda(tick_rate=200.0, heartbeat_interval=0.1).start()
+        recorder = TickRecorder(self.directory, flush_interval=0.01)
+        received = []
+        rates = fake.connect(stream.Stream('practice', 'token', True, recorder=recorder))
+        try:
+            rates.start(received.append, None, instruments='EUR_USD,USD_JPY')
+            time.sleep(0.5)
+        finally:
+            rates.stop()
+            recorder.close()
+            fake.stop()
+        # The replay delivers what the stream did, heartbeats included
+        delivered, errors = self.play()
+        self.assertGreater(len(received), 10)
+        self.assertEqual(delivered[:len(received)], received)
+        self.assertTrue(any('heartbeat' in data for data in delivered))
+        self.assertEqual(sorted(load_instruments(self.directory)), ['EUR_USD', 'USD_JPY'])
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+
+""" transaction_export的离线测试, 使用fake_server.FakeOanda """
+
+import os
+import shutil
+import tempfile
+import unittest
+import rest
+from fake_server import FakeOanda
+from transaction_export import export_transactions, load_checkpoint, read_transactions
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        # Transaction ids of the fake server are 1 to 1000
+        self.fake = FakeOanda().start()
+        self.api = self.fake.connect(rest.Api('practice', 'token', rate_limit=None))
+        self.api.init()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'transactions.ndjson.gz')
+
+    def tearDown(self):
+        self.api.deinit()
+        self.fake.stop()
+        shutil.rmtree(self.directory)
+
+    def ids(self):
+        return [transaction['id'] for transaction in read_transactions(self.path)]
+
+    def test_export(self):
+        self.assertEqual(export_transactions(self.api, 1, self.path, page_span=100), 1000)
+        self.assertEqual(self.ids(), list(range(1, 1001)))
+        self.assertEqual(self.fake.requests, 11)
+        checkpoint = load_checkpoint(self.path)
+        self.assertEqual(checkpoint['next_id'], 1001)
+        self.assertEqual(checkpoint['size'], os.path.getsize(self.path))
+
+    def test_range(self):
+        self.assertEqual(export_transactions(self.api, 1, self.path, min_id=101, max_id=350, page_span=100), 250)
+        self.assertEqual(self.ids(), list(range(101, 351)))
+        # No request for the last id when max_id is given
+        self.assertEqual(self.fake.requests, 3)
+
+    def test_large_pages(self):
+        # Pages holding more than one request can return are completed by further requests
+        self.assertEqual(export_transactions(self.api, 1, self.path, page_span=800), 1000)
+        self.assertEqual(self.ids(), list(range(1, 1001)))
+
+    def test_append(self):
+        self.assertEqual(export_transactions(self.api, 1, self.path, max_id=300, page_span=100), 300)
+        for _ in range(20):
+            self.fake.next_transaction_id()
+        self.assertEqual(export_transactions(self.api, 1, self.path, page_span=100), 720)
+        self.assertEqual(self.ids(), list(range(1, 1021)))
+        # Nothing new
+        self.assertEqual(export_transactions(self.api, 1, self.path, page_span=100), 0)
+
+    def test_resume(self):
+        self.assertEqual(export_transactions(self.api, 1, self.path, max_id=500, page_span=100), 500)
+        # A failed request stops the export, the checkpoint stays at the last page written
+        self.fake.error_rate = 1.0
+        self.assertIsNone(export_transactions(self.api, 1, self.path, page_span=100))
+        self.assertEqual(load_checkpoint(self.path)['next_id'], 501)
+        self.fake.error_rate = 0.0
+        # Interrupted while writing a page: what follows the checkpoint is dropped
+        with open(self.path, 'ab') as f:
+            f.write(b'\x1f\x8b\x08partial')
+        self.assertEqual(export_transactions(self.api, 1, self.path, page_span=100), 500)
+        self.assertEqual(self.ids(), list(range(1, 1001)))
+
+    def test_deinit(self):
+        self.api.deinit()
+        self.assertIsNone(export_transactions(self.api, 1, self.path, max_id=500))
+        self.assertIsNone(export_transactions(self.api, 1, self.path))
+
+    def test_invalid_files(self):
+        export_transactions(self.api, 1, self.path, max_id=10)
+        self.assertRaises(ValueError, export_transactions, self.api, 2, self.path)
+        other = os.path.join(self.directory, 'other.ndjson.gz')
+        with open(other, 'wb') as f:
+            f.write(b'data')
+        self.assertRaises(ValueError, export_transactions, self.api, 1, other)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+#! /usr/bin/env python
+
+""" 按品种保存最近报价的环形缓冲区与窗口统计 """
+
+import math
+import array
+import operator
+import threading
+from itertools import chain, islice, repeat
+from stream import Tick
+from timeutil import TickTimeParser
+
+
+class TickRing:
+    """ Fixed capacity ring buffer of the ticks of one instrument: time in epoch seconds, bid and ask
+        The three columns are arrays of doubles allocated once, appending a tick only overwrites three slots. Ticks
+        older than the last one are dropped, so the times are sorted and windows by time span are found by binary
+        search
+    """
+    def __init__(self, capacity):
+        """ Instantiates an empty ring
+            :param capacity: Required Number of ticks kept, the oldest are overwritten
+        """
+        if capacity < 1:
+            raise ValueError('The capacity must be at least 1')
+        self.capacity = capacity
+        self.times = array.array('d', [0.0]) * capacity
+        self.bids = array.array('d', [0.0]) * capacity
+        self.asks = array.array('d', [0.0]) * capacity
+        # Windows slice these views, they never copy the columns
+        self.time_view = memoryview(self.times)
+        self.bid_view = memoryview(self.bids)
+        self.ask_view = memoryview(self.asks)
+        # Number of ticks ever appended, the next one goes to count % capacity
+        self.count = 0
+        self.last_time = None
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, t, bid, ask):
+        """ Add a tick, returns False if it was dropped for being older than the last one """
+        if self.last_time is not None and t < self.last_time:
+            return False
+        position = self.count % self.capacity
+        self.times[position] = t
+        self.bids[position] = bid
+        self.asks[position] = ask
+        self.last_time = t
+        self.count += 1
+        return True
+
+    def window(self, count=None, span=None):
+        """ View of the last ticks, oldest first
+            :param count: [Optional] Maximum number of ticks. Default: every tick kept
+            :param span: [Optional] Only the ticks at most span seconds older than the last one. Default: no limit
+        """
+        size = len(self)
+        first = self.count - size
+        if count is not None:
+            first = max(first, self.count - count)
+        if span is not None and size:
+            first = self.__search(first, self.last_time - span)
+        return Window(self, first, self.count)
+
+    def __search(self, low, t):
+        """ Logical index of the first tick at or after t, searching from low """
+        times = self.times
+        capacity = self.capacity
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if times[middle % capacity] < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class Window:
+    """ Zero-copy view of consecutive ticks of a TickRing, oldest first
+        A window refers to the ring's own memory, as one or two slices when it wraps around the end of the buffer. It
+        stays valid until the ring overwrites its oldest tick: check valid after a computation when the ring is still
+        being fed, or copy() the window to keep it. Statistics run over the columns with sum, min, max and map, so the
+        loops stay in C and nothing is allocated per tick
+    """
+    def __init__(self, ring, first, stop):
+        self.ring = ring
+        self.first = first
+        self.stop = stop
+        start = first % ring.capacity
+        end = start + stop - first
+        if end <= ring.capacity:
+            segments = ((start, end),)
+        else:
+            segments = ((start, ring.capacity), (0, end - ring.capacity))
+        self.times = tuple(ring.time_view[a:b] for a, b in segments)
+        self.bids = tuple(ring.bid_view[a:b] for a, b in segments)
+        self.asks = tuple(ring.ask_view[a:b] for a, b in segments)
+
+    def __len__(self):
+        return self.stop - self.first
+
+    @property
+    def valid(self):
+        """ False once the ring overwrote ticks of the window """
+        return self.ring.count - self.ring.capacity <= self.first
+
+    def time_values(self):
+        return chain.from_iterable(self.times)
+
+    def bid_values(self):
+        return chain.from_iterable(self.bids)
+
+    def ask_values(self):
+        return chain.from_iterable(self.asks)
+
+    def mids(self):
+        """ Mid prices, as an array.array of doubles """
+        return array.array('d', map(operator.mul, map(operator.add, self.bid_values(), self.ask_values()),
+                                    repeat(0.5)))
+
+    def spreads(self):
+        """ Spreads, as an array.array of doubles """
+        return array.array('d', map(operator.sub, self.ask_values(), self.bid_values()))
+
+    def copy(self):
+        """ Copy of the ticks, a dict of array.array of doubles independent of the ring """
+        return {'time': array.array('d', self.time_values()), 'bid': array.array('d', self.bid_values()),
+                'ask': array.array('d', self.ask_values())}
+
+    def stats(self):
+        """ Count, first and last time, mean, min, max and standard deviation of the mid prices and of the spreads.
+            None for an empty window
+        """
+        count = len(self)
+        if not count:
+            return None
+        times = self.times
+        return {'count': count, 'first': times[0][0], 'last': times[-1][-1], 'mid': describe(self.mids(), count),
+                'spread': describe(self.spreads(), count)}
+
+    def time_weighted_mid(self, end=None):
+        """ Average mid price, each tick weighted by the time until the next one. The ticks carry no volume, this
+            stands for a VWAP. None for an empty window
+            :param end: [Optional] Epoch seconds until which the last tick counts. Default: the time of the last tick
+        """
+        count = len(self)
+        if not count:
+            return None
+        mids = self.mids()
+        times = self.time_values()
+        durations = array.array('d', map(operator.sub, islice(self.time_values(), 1, None), times))
+        last = self.times[-1][-1]
+        if end is not None and end > last:
+            durations.append(end - last)
+        total = sum(durations)
+        if total <= 0:
+            return sum(mids) / count
+        return sum(map(operator.mul, mids, durations)) / total
+
+    def returns(self, n=None):
+        """ Tick to tick returns of the mid price, m[i] / m[i - 1] - 1, as an array.array of doubles
+            :param n: [Optional] Only the last n returns. Default: every return of the window
+        """
+        mids = self.mids()
+        if n is not None:
+            mids = mids[max(len(mids) - n - 1, 0):]
+        return array.array('d', map(operator.sub, map(operator.truediv, islice(mids, 1, None), mids),
+                                    repeat(1.0)))
+
+
+def describe(values, count):
+    """ Mean, min, max and population standard deviation of a column of doubles """
+    mean = sum(values) / count
+    deviations = array.array('d', map(operator.sub, values, repeat(mean)))
+    variance = sum(map(operator.mul, deviations, deviations)) / count
+    return {'mean': mean, 'min': min(values), 'max': max(values), 'std': math.sqrt(variance)}
+
+
+class TickHistory:
+    """ Shared store of the last ticks of every instrument of a rates stream, one TickRing per instrument
+        Memory is bounded by capacity ticks per instrument, allocated when the first tick of the instrument arrives.
+        Feed it with update as the on_stream callback of a Stream, fast_decode or not, or with start(). Windows and
+        statistics can be queried from any thread while the stream runs
+    """
+    def __init__(self, capacity=10000):
+        """ Instantiates an empty history
+            :param capacity: [Optional] Number of ticks kept per instrument. Default: 10000
+        """
+        self.capacity = capacity
+        self.rings = dict()
+        self.epoch = TickTimeParser()
+        self.lock = threading.Lock()
+        self.stream = None
+
+    def update(self, data):
+        """ Add a tick. Can be given directly as the on_stream callback of a rates stream
+            :param data: A stream.Tick, or a rates stream dict. Heartbeats are ignored
+        """
+        if isinstance(data, Tick):
+            instrument, t, bid, ask = data.instrument, data.time, data.bid, data.ask
+        elif 'tick' in data:
+            tick = data['tick']
+            instrument, t, bid, ask = tick['instrument'], tick['time'], tick['bid'], tick['ask']
+        else:
+            return
+        with self.lock:
+            ring = self.rings.get(instrument)
+            if ring is None:
+                ring = self.rings[instrument] = TickRing(self.capacity)
+            ring.append(self.epoch(t), bid, ask)
+
+    def instruments(self):
+        """ Instruments that received ticks """
+        with self.lock:
+            return list(self.rings)
+
+    def ring(self, instrument):
+        """ The TickRing of an instrument, None before its first tick """
+        return self.rings.get(instrument)
+
+    def window(self, instrument, count=None, span=None):
+        """ Window of the last ticks of an instrument, None before its first tick
+            :param instrument: Required The instrument
+            :param count: [Optional] Maximum number of ticks. Default: every tick kept
+            :param span: [Optional] Only the ticks at most span seconds older than the last one. Default: no limit
+        """
+        with self.lock:
+            ring = self.rings.get(instrument)
+            return ring.window(count, span) if ring is not None else None
+
+    def stats(self, instrument, count=None, span=None):
+        """ Window.stats of the last ticks of an instrument, with the time weighted mid price as 'twap'. None before
+            its first tick. Parameters as for window
+        """
+        window = self.window(instrument, count, span)
+        if window is None:
+            return None
+        with self.lock:
+            stats = window.stats()
+            stats['twap'] = window.time_weighted_mid()
+        return stats
+
+    def returns(self, instrument, n):
+        """ The last n tick to tick returns of the mid price of an instrument, an array.array of doubles """
+        window = self.window(instrument, n + 1)
+        if window is None:
+            return array.array('d')
+        with self.lock:
+            return window.returns()
+
+    def start(self, stream, instruments, on_error=None, **params):
+        """ Follow a rates stream
+            :param stream: A rates stream.Stream, not started yet
+            :param instruments: Instruments to follow, a list or a comma separated string
+            :param on_error: [Optional] Callback function, invoked when the stream reports an error
+            :param params: Other parameters of the stream, e.g. accountId
+        """
+        if not isinstance(instruments, str):
+            instruments = ','.join(instruments)
+        self.stream = stream
+        stream.start(self.update, on_error, instruments=instruments, ignore_heartbeat=True, **params)
+
+    def stop(self):
+        """ Stop following the rates stream """
+        if self.stream:
+            self.stream.stop()
+            self.stream = None
@@ -0,0 +1,297 @@
+#! /usr/bin/env python
+
+""" 汇率流的二进制记录与高速回放 """
+
+import os
+import re
+import json
+import mmap
+import time
+import struct
+import bisect
+import threading
+import collections
+from stream import HEARTBEAT_PREFIX, decode_line, decode_tick
+from timeutil import to_epoch
+
+# A log record is this header followed by the raw stream line: arrival time in epoch microseconds, length of the line
+# and id of its instrument, NO_INSTRUMENT for heartbeats, events and anything that is not a price tick
+RECORD = struct.Struct('<qIH')
+# An entry of the sparse index: arrival time of a record and its offset in the log
+INDEX = struct.Struct('<qQ')
+NO_INSTRUMENT = 0xFFFF
+LOG_FILE = 'ticks.log'
+INDEX_FILE = 'ticks.idx'
+INSTRUMENTS_FILE = 'instruments.json'
+TICK_INSTRUMENT = re.compile(rb'^\{"tick":\{"instrument":"([A-Z0-9_]+)"')
+
+
+def load_instruments(directory):
+    """ Instrument names of a log, indexed by instrument id """
+    path = os.path.join(directory, INSTRUMENTS_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_index(directory):
+    """ Sparse index of a log, a list of (time, offset). Entries past the end of the log are dropped """
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        data = f.read()
+    log_path = os.path.join(directory, LOG_FILE)
+    size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+    return [entry for entry in INDEX.iter_unpack(data[:len(data) - len(data) % INDEX.size]) if entry[1] < size]
+
+
+class TickRecorder:
+    """ Append-only binary log of the lines of a stream, see RECORD
+        record() only queues the line, so the stream reader thread never waits for the disk. A writer thread appends
+        the queued lines every flush_interval seconds, together with an entry of the sparse time index every
+        index_interval records and the instruments sidecar. Give an instance as the recorder parameter of
+        stream.Stream. Recording into an existing log appends to it, dropping a record cut short by a crash
+    """
+    def __init__(self, directory, flush_interval=0.1, index_interval=1024):
+        """ Instantiates a recorder and starts its writer thread
+            :param directory: Directory of the log, created if it does not exist
+            :param flush_interval: [Optional] Seconds between two writes of the queued lines. Default: 0.1
+            :param index_interval: [Optional] Number of records between two entries of the index. Default: 1024
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.index_interval = index_interval
+        self.instruments = load_instruments(directory)
+        # Keyed by the raw bytes of the name, as matched in the lines
+        self.instrument_ids = {name.encode('ascii'): i for i, name in enumerate(self.instruments)}
+        self.offset = self.__recover()
+        self.log = open(os.path.join(directory, LOG_FILE), 'ab')
+        self.index = open(os.path.join(directory, INDEX_FILE), 'ab')
+        self.unindexed = index_interval
+        self.records = 0
+        self.pending = collections.deque()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__thread)
+        self.thread.start()
+
+    def record(self, line, received=None):
+        """ Queue a line for writing, never blocks
+            :param line: A line of the stream as received, bytes without the line break
+            :param received: [Optional] Arrival time of the line in epoch seconds. Default: now
+        """
+        self.pending.append((int((time.time() if received is None else received) * 1000000), line))
+
+    def close(self):
+        """ Write the lines still queued, stop the writer thread and close the log """
+        self.stop_event.set()
+        self.thread.join()
+        self.log.close()
+        self.index.close()
+
+    def __thread(self):
+        while True:
+            stopping = self.stop_event.wait(self.flush_interval)
+            self.__write()
+            if stopping:
+                break
+
+    def __write(self):
+        """ Append every queued line to the log """
+        pending = self.pending
+        if not pending:
+            return
+        chunks = []
+        entries = []
+        new_instrument = False
+        while pending:
+            received, line = pending.popleft()
+            instrument_id = NO_INSTRUMENT
+            match = TICK_INSTRUMENT.match(line)
+            if match:
+                instrument_id = self.instrument_ids.get(match.group(1))
+                if instrument_id is None:
+                    instrument_id = self.instrument_ids[match.group(1)] = len(self.instruments)
+                    self.instruments.append(match.group(1).decode('ascii'))
+                    new_instrument = True
+            if self.unindexed >= self.index_interval:
+                entries.append(INDEX.pack(received, self.offset))
+                self.unindexed = 0
+            self.unindexed += 1
+            chunks.append(RECORD.pack(received, len(line), instrument_id))
+            chunks.append(line)
+            self.offset += RECORD.size + len(line)
+            self.records += 1
+        # A reader must never see an instrument id or an index entry before what they refer to
+        if new_instrument:
+            self.__save_instruments()
+        self.log.write(b''.join(chunks))
+        self.log.flush()
+        if entries:
+            self.index.write(b''.join(entries))
+            self.index.flush()
+
+    def __save_instruments(self):
+        path = os.path.join(self.directory, INSTRUMENTS_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.instruments, f)
+        os.replace(path + '.tmp', path)
+
+    def __recover(self):
+        """ Truncate the log after its last complete record and the index after its last valid entry. Returns the size
+            of the log
+        """
+        log_path = os.path.join(self.directory, LOG_FILE)
+        if not os.path.exists(log_path):
+            return 0
+        entries = load_index(self.directory)
+        with open(os.path.join(self.directory, INDEX_FILE), 'ab') as f:
+            f.truncate(len(entries) * INDEX.size)
+        with open(log_path, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = entries[-1][1] if entries else 0
+            f.seek(offset)
+            while offset + RECORD.size <= size:
+                received, length, instrument_id = RECORD.unpack(f.read(RECORD.size))
+                if offset + RECORD.size + length > size:
+                    break
+                offset += RECORD.size + length
+                f.seek(offset)
+            f.truncate(offset)
+        return offset
+
+
+class TickReplay:
+    """ Replays a log written by TickRecorder, with the start/stop interface of stream.Stream
+        The log is read through memory mapping and every line is decoded the same way as by a Stream, so the same
+        callbacks run unchanged on recorded data. Lines are delivered at the recorded pace scaled by speed, or as fast
+        as possible. play() runs the replay on the calling thread, start() on a dedicated one
+    """
+    def __init__(self, directory, speed=None, fast_decode=False):
+        """ Instantiates a replay of a log
+            :param directory: Directory of the log written by TickRecorder
+            :param speed: [Optional] 1 for real time, N for N times faster, None for as fast as possible. Default: None
+            :param fast_decode: [Optional] Deliver price ticks as stream.Tick objects instead of dicts. Default: False
+        """
+        self.directory = directory
+        self.speed = speed
+        self.decode = decode_tick if fast_decode else decode_line
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self, on_stream=None, on_error=None, on_connect=None, **params):
+        """ Replay the log on a dedicated thread
+            :param on_stream: [Optional] Callback function, invoked for each replayed line
+            :param on_error: [Optional] Callback function, invoked when a line can not be decoded
+            :param on_connect: [Optional] Callback function, invoked once before the first line
+            :param params: Parameters of play: instruments, since, until and ignore_heartbeat. Other stream parameters
+                           such as accountId are ignored
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.play, args=(on_stream, on_error, on_connect), kwargs=params)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the replay """
+        self.stop_event.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def play(self, on_stream=None, on_error=None, on_connect=None, instruments=None, since=None, until=None,
+             ignore_heartbeat=None, **params):
+        """ Replay the log on the calling thread, returns the number of lines delivered
+            :param on_stream: [Optional] Callback function, invoked for each replayed line
+            :param on_error: [Optional] Callback function, invoked when a line can not be decoded
+            :param on_connect: [Optional] Callback function, invoked once before the first line
+            :param instruments: [Optional] Only replay the ticks of these instruments, a list or a comma separated
+                                string. Heartbeats and events are then skipped too. Default: every line
+            :param since: [Optional] Skip the lines received before this time, a datetime, an epoch timestamp or an
+                          RFC3339 string. Default: from the beginning of the log
+            :param until: [Optional] Stop after the lines received at this time, same types as since. Default: until
+                          the end of the log
+            :param ignore_heartbeat: [Optional] Skip the heartbeats. Default: False
+        """
+        on_stream = on_stream if on_stream else self.__on_stream
+        on_error = on_error if on_error else self.__on_error
+        decode = self.decode
+        speed = self.speed
+        stop_event = self.stop_event
+        delivered = 0
+        first = origin = None
+        if on_connect:
+            on_connect()
+        for received, line in self.records(instruments, since, until):
+            if stop_event.is_set():
+                break
+            if ignore_heartbeat and line.startswith(HEARTBEAT_PREFIX):
+                continue
+            if speed:
+                if first is None:
+                    first, origin = received, time.monotonic()
+                delay = (received - first) / 1000000.0 / speed - (time.monotonic() - origin)
+                if delay > 0 and stop_event.wait(delay):
+                    break
+            try:
+                data = decode(line)
+            except ValueError as e:
+                on_error(str(e))
+                continue
+            on_stream(data)
+            delivered += 1
+        return delivered
+
+    def records(self, instruments=None, since=None, until=None):
+        """ Iterate over the raw records of the log, yields (arrival time in epoch microseconds, line)
+            :param instruments: [Optional] Only the ticks of these instruments, a list or a comma separated string
+            :param since: [Optional] Start time, a datetime, an epoch timestamp or an RFC3339 string
+            :param until: [Optional] End time, same types as since
+        """
+        path = os.path.join(self.directory, LOG_FILE)
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return
+        if isinstance(instruments, str):
+            instruments = instruments.split(',')
+        ids = None
+        if instruments is not None:
+            names = load_instruments(self.directory)
+            ids = frozenset(i for i, name in enumerate(names) if name in instruments)
+        begin = None if since is None else int(to_epoch(since) * 1000000)
+        end = None if until is None else int(to_epoch(until) * 1000000)
+
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = len(data)
+            offset = self.__seek(begin) if begin is not None else 0
+            unpack = RECORD.unpack_from
+            header = RECORD.size
+            while offset + header <= size:
+                received, length, instrument_id = unpack(data, offset)
+                start = offset + header
+                offset = start + length
+                if offset > size or (end is not None and received > end):
+                    break
+                if (begin is not None and received < begin) or (ids is not None and instrument_id not in ids):
+                    continue
+                yield received, data[start:offset]
+        finally:
+            data.close()
+
+    def __seek(self, begin):
+        """ Offset of the last indexed record received before begin """
+        entries = load_index(self.directory)
+        position = bisect.bisect_left([received for received, offset in entries], begin)
+        return entries[position - 1][1] if position else 0
+
+    @staticmethod
+    def __on_stream(data):
+        """ Default replay data handler. Used when user doesn't provide one instead """
+        print('replay: ' + str(data))
+
+    @staticmethod
+    def __on_error(error_str):
+        """ Default replay error handler. Used when user doesn't provide one instead """
+        print('replay error: ' + error_str)
@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+
+""" 时间格式转换与K线周期的辅助函数 """
+
+import calendar
+from datetime import datetime, timedelta, timezone
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+# Shortest possible duration of each candle granularity, in seconds. Weekly and monthly candles use their minimum
+# length (7 and 28 days), so a time range never holds more candles than range / duration
+GRANULARITY_SECONDS = {
+    'S5': 5, 'S10': 10, 'S15': 15, 'S30': 30,
+    'M1': 60, 'M2': 120, 'M3': 180, 'M4': 240, 'M5': 300, 'M10': 600, 'M15': 900, 'M30': 1800,
+    'H1': 3600, 'H2': 7200, 'H3': 10800, 'H4': 14400, 'H6': 21600, 'H8': 28800, 'H12': 43200,
+    'D': 86400, 'W': 604800, 'M': 2419200,
+}
+
+
+def parse_rfc3339(value):
+    """ Parse an Oanda RFC3339 timestamp, e.g. '2016-04-20T17:41:04.066398Z', into an aware UTC datetime """
+    microsecond = 0
+    if len(value) > 20 and value[19] == '.':
+        fraction = value[20:].rstrip('Z')
+        microsecond = int((fraction + '000000')[:6])
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]), microsecond, timezone.utc)
+
+
+def from_microseconds(value):
+    """ Convert an epoch timestamp in microseconds, the unix dateFormat of Oanda responses, into an aware UTC
+        datetime without loss of precision
+    """
+    return EPOCH + timedelta(microseconds=value)
+
+
+def to_datetime(value):
+    """ Convert a datetime, an epoch timestamp in seconds or an RFC3339 string into an aware UTC datetime. Naive
+        datetime objects are taken as UTC
+    """
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc)
+    return parse_rfc3339(value)
+
+
+def to_epoch(value):
+    """ Convert any value accepted by to_datetime into an epoch timestamp in seconds """
+    dt = to_datetime(value)
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1000000.0
+
+
+def to_rfc3339(value):
+    """ Format any value accepted by to_datetime as an RFC3339 string accepted by Oanda """
+    dt = to_datetime(value)
+    if dt.microsecond:
+        return dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def format_time(value, date_format=None):
+    """ Format a time parameter the way Oanda expects it for the given dateFormat
+        :param value: Any value accepted by to_datetime
+        :param date_format: 'unix' or 'RFC3339', the dateFormat parameter of the request. Default: RFC3339
+    """
+    if date_format == 'unix':
+        return str(int(to_epoch(value)))
+    return to_rfc3339(value)
+
+
+class TickTimeParser:
+    """ Converts the times of stream ticks, RFC3339 strings or unix microseconds, into epoch seconds. The conversion
+        of the whole seconds is cached, as consecutive ticks mostly share it. Not thread safe, use one per reader
+    """
+    def __init__(self):
+        self.prefix = None
+        self.second = None
+
+    def __call__(self, value):
+        if not isinstance(value, str):
+            return value
+        if 'T' not in value:
+            return int(value) / 1000000.0
+        prefix = value[:19]
+        if prefix != self.prefix:
+            self.second = to_epoch(prefix + 'Z')
+            self.prefix = prefix
+        fraction = value[20:].rstrip('Z') if len(value) > 20 and value[19] == '.' else None
+        if fraction:
+            return self.second + int(fraction) / 10.0 ** len(fraction)
+        return self.second
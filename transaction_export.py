@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+
+""" 并发, 可断点续传的交易记录批量导出 """
+
+import os
+import gzip
+import json
+import collections
+
+# Maximum count of a transaction history request
+PAGE_COUNT = 500
+
+
+def load_checkpoint(path):
+    """ Checkpoint of an export: the next transaction id to fetch and the size of the file holding everything before
+        it. None if the export never ran
+    """
+    if not os.path.exists(path + '.checkpoint'):
+        return None
+    with open(path + '.checkpoint') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    with open(path + '.checkpoint.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.checkpoint.tmp', path + '.checkpoint')
+
+
+def export_transactions(api, account_id, path, min_id=1, max_id=None, page_span=PAGE_COUNT, max_concurrency=4,
+                        compresslevel=6):
+    """ Export the transaction history of an account to a gzip compressed newline delimited JSON file, oldest first
+        The id range is split into pages of page_span ids, fetched concurrently and written in order as they
+        complete, each page as a separate gzip member, so only the pages in flight are held in memory. A checkpoint
+        is saved next to the file after each page: an interrupted export resumes from it, and running the export
+        again later only appends the transactions made since. Returns the number of transactions written, or None
+        if a request failed, in which case the export can be resumed
+        :param api: An initialized rest.Api
+        :param account_id: Required The account id to export
+        :param path: Required Path of the output file. The checkpoint is path + '.checkpoint'
+        :param min_id: [Optional] First transaction id of the export, ignored when resuming. Default: 1
+        :param max_id: [Optional] Last transaction id of the export. Default: the last transaction of the account
+        :param page_span: [Optional] Number of ids covered by one request. Spans up to 500 ids never need a second
+                          request, larger spans mean fewer requests for accounts with sparse ids. Default: 500
+        :param max_concurrency: [Optional] Maximum number of requests in flight at the same time. Default: 4
+        :param compresslevel: [Optional] gzip compression level. Default: 6
+    """
+    checkpoint = load_checkpoint(path)
+    if checkpoint is not None and str(checkpoint['account_id']) != str(account_id):
+        raise ValueError("'{0}' holds an export of account {1}".format(path, checkpoint['account_id']))
+    if checkpoint is None:
+        if os.path.exists(path) and os.path.getsize(path):
+            raise ValueError("'{0}' already exists and has no checkpoint".format(path))
+        checkpoint = {'account_id': account_id, 'next_id': min_id, 'size': 0}
+    if max_id is None:
+        response = api.get_transaction_history(account_id, False, count=1)
+        if response is None:
+            return None
+        transactions = response.get('transactions', [])
+        max_id = transactions[0]['id'] if transactions else 0
+
+    written = 0
+    pending = collections.deque()
+    low = checkpoint['next_id']
+    with open(path, 'ab') as f:
+        if f.tell() < checkpoint['size']:
+            raise ValueError("'{0}' is shorter than its checkpoint".format(path))
+        # Drop whatever was written after the last checkpoint
+        f.truncate(checkpoint['size'])
+        f.seek(checkpoint['size'])
+        while low <= max_id or pending:
+            if low <= max_id and len(pending) < max_concurrency:
+                high = min(low + page_span - 1, max_id)
+                pending.append((low, high, api.get_transaction_history(account_id, True, minId=low, maxId=high,
+                                                                       count=PAGE_COUNT)))
+                low = high + 1
+                continue
+            page_low, page_high, r = pending.popleft()
+            transactions = complete_page(api, account_id, page_low, r.wait_for_complete() if r else None)
+            if transactions is None:
+                return None
+            if transactions:
+                lines = ''.join(json.dumps(t, separators=(',', ':')) + '\n' for t in transactions)
+                f.write(gzip.compress(lines.encode('utf-8'), compresslevel))
+                f.flush()
+                os.fsync(f.fileno())
+                written += len(transactions)
+            checkpoint['next_id'] = page_high + 1
+            checkpoint['size'] = f.tell()
+            save_checkpoint(path, checkpoint)
+    return written
+
+
+def read_transactions(path):
+    """ Iterate over the transactions of an exported file, oldest first """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def complete_page(api, account_id, low, response):
+    """ Transactions of a page in ascending order, fetching the rest of the page when it held more than one request
+        can return. None if a request failed
+        :param low: First id of the page
+        :param response: Response of the first request of the page
+    """
+    if response is None:
+        return None
+    transactions = response.get('transactions', [])
+    page = transactions
+    while len(page) >= PAGE_COUNT:
+        response = api.get_transaction_history(account_id, False, minId=low, maxId=min(t['id'] for t in page) - 1,
+                                               count=PAGE_COUNT)
+        if response is None:
+            return None
+        page = response.get('transactions', [])
+        transactions.extend(page)
+    transactions.sort(key=lambda t: t['id'])
+    return transactions